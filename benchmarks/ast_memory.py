@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Measure how much memory a large, validated document tree needs.
+
+Usage: python benchmarks/ast_memory.py [number of commands]
+
+The tree is built with the same node constructors the parser uses, with
+all strings being distinct objects, as they would be coming out of the
+parser.
+"""
+
+import sys
+import types
+
+from wsconfig.parsing import Command, Selector, TagExpr, Or, And
+from wsconfig.plugins import Plugin
+from wsconfig.script import validate
+
+
+class BenchPlugin(Plugin):
+    name = 'bench'
+    def run(self, arguments, state):
+        pass
+
+
+def fresh(s):
+    # Defeat the compiler's constant sharing, like the parser would.
+    return ''.join(list(s))
+
+
+def build(num_commands, per_selector=10):
+    document = []
+    for i in range(num_commands // per_selector):
+        commands = [Command([fresh('bench'), 'package%d' % (i * per_selector + j)])
+                    for j in range(per_selector)]
+        expr = TagExpr(Or([And([fresh('sys:linux'), fresh('Development')])]))
+        document.append(Selector(expr, commands))
+    return document
+
+
+def deep_size(obj, seen=None):
+    """Sum of ``sys.getsizeof`` over all objects reachable from ``obj``,
+    not following into classes, modules or functions.
+    """
+    seen = set() if seen is None else seen
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, types.ModuleType,
+                types.FunctionType, types.MethodType, types.ClassType)):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return size
+
+
+def main(argv):
+    num_commands = int(argv[1]) if len(argv) > 1 else 100000
+    document = build(num_commands)
+    parsed = deep_size(document)
+    validate(document, '', {'bench': BenchPlugin})
+    validated = deep_size(document)
+    print '%d commands' % num_commands
+    print '  parsed:    %8.1f MB' % (parsed / 1024.0 / 1024)
+    print '  validated: %8.1f MB' % (validated / 1024.0 / 1024)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
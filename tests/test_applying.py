@@ -1,12 +1,22 @@
 """Test that given a configuration, we do the right thing.
 """
 
+import os
+from os import path
+import sys
+import subprocess
+import shutil
+import tempfile
+import json
+from StringIO import StringIO
 from textwrap import dedent
 from nose.tools import assert_raises
-from wsconfig.parsing import parse_string
+from wsconfig.parsing import parse_string, Command
 from wsconfig.plugins import Plugin
 from wsconfig.script import (
     firstpass, find_variables, apply_document, validate, ConfigError)
+from wsconfig.checkpoint import Checkpoint
+from wsconfig.events import bus, JsonlWriter, Log, CommandStart
 
 
 class TestValidation(object):
@@ -163,3 +173,230 @@ class TestApply(object):
             '@@foo@@': '1', '@@bar@@': '2'
         }) == [['1', '2']]
 
+
+
+class TestCheckpoint(object):
+    """Test resuming an interrupted apply."""
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = path.join(self.tmp, 'checkpoint')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def apply(self, text, checkpoint, interrupt_at=None):
+        class InterruptPlugin(Plugin):
+            name = 'interruptible'
+            log = []
+            def run(self, args, state):
+                if args == [interrupt_at]:
+                    raise KeyboardInterrupt()
+                self.log.append(args)
+
+        document = parse_string(dedent(text))
+        validate(document, '', {'interruptible': InterruptPlugin})
+        try:
+            apply_document(document, set(), {'variables': {}},
+                           checkpoint=checkpoint)
+        except KeyboardInterrupt:
+            pass
+        return InterruptPlugin.log
+
+    def test_resume(self):
+        text = 'interruptible 1\ninterruptible 2\ninterruptible 3'
+        assert self.apply(text, Checkpoint(self.filename, 'doc'),
+                          interrupt_at='2') == [['1']]
+        checkpoint = Checkpoint(self.filename, 'doc', resume=True)
+        assert checkpoint.completed == {0}
+        assert self.apply(text, checkpoint) == [['2'], ['3']]
+        # Once completed, the log is removed
+        assert not path.exists(self.filename)
+
+    def test_invalidated(self):
+        text = 'interruptible 1\ninterruptible 2'
+        self.apply(text, Checkpoint(self.filename, 'doc'), interrupt_at='2')
+        assert Checkpoint(self.filename, 'other', resume=True).completed == set()
+
+    def test_variables(self):
+        old_cache = os.environ.get('WSCONFIG_CACHE')
+        os.environ['WSCONFIG_CACHE'] = self.tmp
+        try:
+            def checkpoint(variables):
+                return Checkpoint.for_document(
+                    'config', 'interruptible @@a@@', set(), variables,
+                    resume=True)
+            first = checkpoint({'@@a@@': '1'})
+            first.done(0)
+            first.close()
+            second = checkpoint({'@@a@@': '1'})
+            second.close()
+            assert second.completed == set([0])
+            # With another value, the command would expand differently
+            third = checkpoint({'@@a@@': '2'})
+            third.close()
+            assert third.completed == set()
+        finally:
+            if old_cache is None:
+                del os.environ['WSCONFIG_CACHE']
+            else:
+                os.environ['WSCONFIG_CACHE'] = old_cache
+
+    def test_no_resume(self):
+        text = 'interruptible 1\ninterruptible 2'
+        self.apply(text, Checkpoint(self.filename, 'doc'), interrupt_at='2')
+        assert Checkpoint(self.filename, 'doc').completed == set()
+
+
+class TestEvents(object):
+    """Test the events an apply reports."""
+
+    def apply(self, text, **kwargs):
+        class EventPlugin(Plugin):
+            name = 'evented'
+            def run(self, args, state):
+                pass
+
+        document = parse_string(dedent(text))
+        validate(document, '', {'evented': EventPlugin})
+        stream = StringIO()
+        writer = JsonlWriter(stream)
+        bus.subscribe(writer)
+        try:
+            apply_document(document, set(), {'variables': {}}, **kwargs)
+        finally:
+            bus.unsubscribe(writer)
+        writer.flush()
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_apply(self):
+        events = self.apply('evented 1\nfoo { evented 2 }\nevented 3')
+        assert [e['event'] for e in events] == [
+            'RunStart', 'CommandStart', 'CommandEnd',
+            'CommandStart', 'CommandEnd', 'RunEnd']
+        assert events[0]['commands'] == 2
+        assert events[2]['command'] == ['evented', '1']
+        assert events[2]['duration'] >= 0
+        assert events[-1]['failed'] is False
+
+    def test_dry_run(self):
+        events = self.apply('evented 1', dry_run=True)
+        assert events[1]['event'] == 'CommandSkip'
+        assert events[1]['reason'] == 'dry-run'
+
+    def test_not_utf8(self):
+        stream = StringIO()
+        writer = JsonlWriter(stream)
+        writer(Log('caf\xe9'))
+        writer(CommandStart(0, Command(['evented', '\xff']), ['\xff']))
+        writer.flush()
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        assert events[0]['text'] == u'caf\ufffd'
+        assert events[1]['args'] == [u'\ufffd']
+
+    def test_command_output(self):
+        # Output of commands does not end up among the events
+        tmp = tempfile.mkdtemp()
+        try:
+            config = path.join(tmp, 'config')
+            with open(config, 'w') as f:
+                f.write('$ echo hello-from-child\n')
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'wsconfig.script', '--log-format',
+                 'jsonl', config, 'apply'],
+                stdin=open(os.devnull), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=dict(os.environ, WSCONFIG_CACHE=path.join(tmp, 'cache')))
+            stdout, stderr = process.communicate()
+        finally:
+            shutil.rmtree(tmp)
+        events = [json.loads(line) for line in stdout.splitlines()]
+        assert events[-1]['event'] == 'RunEnd'
+        assert 'hello-from-child' in stderr
+
+
+class TestGuards(object):
+    """Test ``creates`` and ``unless``."""
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def apply(self, text, **kwargs):
+        ran = []
+        class GuardedPlugin(Plugin):
+            name = 'guarded'
+            def run(self, args, state):
+                ran.append(args[0])
+
+        document = parse_string(dedent(text))
+        validate(document, path.join(self.dir, 'config'),
+                 {'guarded': GuardedPlugin})
+        skipped = []
+        def collect(event):
+            if event.__class__.__name__ == 'CommandSkip':
+                skipped.append((event.args[0], event.reason))
+        bus.subscribe(collect)
+        try:
+            apply_document(document, set(), {'variables': {}}, **kwargs)
+        finally:
+            bus.unsubscribe(collect)
+        return ran, skipped
+
+    def test_invalid(self):
+        for text in ['creates a', 'creates a\nfoo { guarded 1 }',
+                     'creates a\ndefine foo\nguarded 1', 'creates\nguarded 1',
+                     'creates a b\nguarded 1', 'unless\nguarded 1']:
+            document = parse_string(text)
+            assert_raises(ConfigError, validate, document, '',
+                          {'guarded': Plugin})
+
+    def test_creates(self):
+        open(path.join(self.dir, 'exists'), 'w').close()
+        ran, skipped = self.apply('''
+            creates exists
+            guarded 1
+            creates missing
+            guarded 2
+            guarded 3
+            ''')
+        assert ran == ['2', '3']
+        assert skipped == [('1', '%s exists' % path.join(self.dir, 'exists'))]
+
+    def test_unless(self):
+        ran, skipped = self.apply('''
+            unless "test -d ."
+            guarded 1
+            unless false
+            guarded 2
+            ''')
+        assert ran == ['2']
+        assert skipped == [('1', '"test -d ." succeeds')]
+
+    def test_probes_run_once(self):
+        ran, skipped = self.apply('''
+            unless "echo >> count; true"
+            guarded 1
+            unless "echo >> count; true"
+            creates missing
+            guarded 2
+            ''')
+        assert ran == []
+        with open(path.join(self.dir, 'count')) as f:
+            assert len(f.readlines()) == 1
+
+    def test_dry_run(self):
+        ran, skipped = self.apply('''
+            unless true
+            guarded 1
+            guarded 2
+            ''', dry_run=True)
+        assert ran == []
+        assert skipped == [('1', '"true" succeeds'), ('2', 'dry-run')]
+
+    def test_variables(self):
+        document = parse_string('creates @@dir@@/x\nguarded 1')
+        validate(document, '', {'guarded': Plugin})
+        assert find_variables(document, set()) == {'@@dir@@'}
@@ -0,0 +1,82 @@
+"""Test applying documents to an in-memory backend."""
+
+from textwrap import dedent
+from nose.tools import assert_raises
+
+from wsconfig.backends import MemoryBackend
+from wsconfig.fscache import StatCache, FILE, DIR, LINK, MISSING
+from wsconfig.parsing import parse_string
+from wsconfig.plugins import Plugin, ApplyError
+from wsconfig.script import validate, apply_document
+
+
+class TestMemoryBackend(object):
+
+    def setup(self):
+        self.backend = MemoryBackend()
+        self.backend.add_file('/config/vimrc', 'set nocp\n')
+        self.backend.add_link('/config', '/home/me/dotfiles')
+
+    def test_lookups(self):
+        assert self.backend.lstat_kind('/home/me/dotfiles') is LINK
+        assert self.backend.stat_kind('/home/me/dotfiles') is DIR
+        assert self.backend.stat_kind('/home/me/dotfiles/vimrc') is FILE
+        assert self.backend.stat_kind('/home/me/missing') is MISSING
+        assert self.backend.read('/home/me/dotfiles/vimrc') == 'set nocp\n'
+        assert sorted(self.backend.list_kinds('/home/me')) == [
+            ('dotfiles', LINK)]
+
+    def test_changes(self):
+        fs = StatCache(self.backend)
+        fs.makedirs('/home/me/.vim/colors')
+        fs.symlink('../dotfiles/vimrc', '/home/me/.vim/vimrc')
+        assert fs.exists('/home/me/.vim/vimrc')
+        fs.unlink('/home/me/.vim/vimrc')
+        assert_raises(OSError, fs.unlink, '/home/me/.vim/vimrc')
+        assert_raises(OSError, fs.symlink, 'x', '/nowhere/link')
+        assert self.backend.operations == [
+            ('makedirs', '/home/me/.vim/colors'),
+            ('symlink', '../dotfiles/vimrc', '/home/me/.vim/vimrc'),
+            ('unlink', '/home/me/.vim/vimrc')]
+
+
+class TestApply(object):
+
+    def apply(self, text, backend, failed=None):
+        failed = [] if failed is None else failed
+        document = parse_string(dedent(text))
+        validate(document, '/config/wsconfig.conf', Plugin.PLUGINS)
+        apply_document(document, set(), {'variables': {}, 'backend': backend,
+                                         'post_apply': []},
+                       on_failure=lambda error: not failed.append(error))
+
+    def test_operations(self):
+        backend = MemoryBackend()
+        backend.add_file('/config/vimrc')
+        backend.add_file('/home/me/.bashrc', 'export A=1\n')
+        self.apply('''
+            link vimrc /home/me/.vimrc
+            link vimrc /home/me/.vimrc
+            mkdir /home/me/src /home/me/src
+            ensure_line /home/me/.bashrc "export A=1"
+            ensure_line /home/me/.bashrc "export B=2"
+            $ make install
+            ''', backend)
+        assert backend.operations == [
+            ('symlink', '../../config/vimrc', '/home/me/.vimrc'),
+            ('makedirs', '/home/me/src'),
+            ('append', '/home/me/.bashrc', 'export B=2\n'),
+            ('run', ' make install')]
+        assert backend.read('/home/me/.bashrc') == \
+            'export A=1\nexport B=2\n'
+
+    def test_failing_command(self):
+        failed = []
+        backend = MemoryBackend(
+            handler=lambda cmdline: 1 if 'fail' in cmdline else 0)
+        self.apply('''
+            $ fail
+            $ succeed
+            ''', backend, failed)
+        assert backend.operations == [('run', ' fail'), ('run', ' succeed')]
+        assert [error.returncode for error in failed] == [1]
@@ -0,0 +1,42 @@
+"""Test checking many files at once."""
+
+from os import path
+import shutil
+import tempfile
+
+from wsconfig.batch import check_files
+from wsconfig.script import main
+
+
+class TestCheckFiles(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.files = []
+        for name, content in [('good', 'Foo { mkdir a }'),
+                              ('plugin', 'Foo { nosuch a }'),
+                              ('syntax', 'Foo { mkdir a'),
+                              ('also_good', 'Bar { }')]:
+            filename = path.join(self.tmp, name)
+            with open(filename, 'w') as f:
+                f.write(content)
+            self.files.append(filename)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_pool(self):
+        results = list(check_files(self.files, set(), jobs=2))
+        assert [filename for filename, _, _ in results] == self.files
+        assert [error is None for _, error, _ in results] == [
+            True, False, False, True]
+        assert 'not a valid plugin' in results[1][1]
+        assert results[3][2] == {'Bar'}
+
+    def test_serial(self):
+        assert list(check_files(self.files, set(), jobs=1)) == \
+            list(check_files(self.files, set(), jobs=2))
+
+    def test_exit_code(self):
+        assert main(['wsconfig', '--validate'] + self.files) == 1
+        assert main(['wsconfig', '--validate', self.files[0]]) == 0
@@ -0,0 +1,84 @@
+"""Test applying only some of the commands of a document."""
+
+from textwrap import dedent
+from nose.tools import assert_raises
+
+from wsconfig.parsing import parse_string
+from wsconfig.plugins import Plugin
+from wsconfig.script import validate, apply_document
+from wsconfig.nodes import Command
+from wsconfig.filters import CommandIndex, parse_names, parse_lines, \
+    FilterError
+
+
+class FilteredPlugin(Plugin):
+    name = 'filtered'
+    log = []
+    def run(self, args, state):
+        self.log.append(args[0])
+
+
+class OtherPlugin(FilteredPlugin):
+    name = 'other'
+
+
+DOCUMENT = dedent('''\
+    filtered 1
+    other 2
+    define Foo
+    Foo {
+        filtered 4
+        other 5
+    }
+    Bar {
+        filtered 8
+    }
+    ''')
+
+
+class TestFilters(object):
+
+    def setup(self):
+        del FilteredPlugin.log[:]
+        self.document = parse_string(DOCUMENT)
+        self.index = validate(self.document, '', {
+            'filtered': FilteredPlugin, 'other': OtherPlugin})
+
+    def apply(self, **filters):
+        apply_document(self.document, set(), {'variables': {}},
+                       only=self.index.select(**filters))
+        return FilteredPlugin.log
+
+    def test_only(self):
+        # The define still takes effect
+        assert self.apply(only=['filtered']) == ['1', '4']
+
+    def test_skip(self):
+        assert self.apply(skip=['filtered']) == ['2', '5']
+
+    def test_lines(self):
+        assert self.apply(lines=[(2, 5)]) == ['2', '4']
+        del FilteredPlugin.log[:]
+        assert self.apply(lines=[(None, 1), (6, None)]) == ['1', '5']
+
+    def test_combined(self):
+        assert self.apply(only=['filtered', 'other'], skip=['other'],
+                          lines=[(3, None)]) == ['4']
+
+    def test_index(self):
+        assert len(self.index.by_plugin['filtered']) == 3
+        assert self.index.lines == [1, 2, 5, 6, 9]
+
+    def test_no_line_numbers(self):
+        # Like the commands of a plan
+        index = CommandIndex([Command(['filtered', '1'])])
+        assert_raises(FilterError, index.select, lines=[(1, 1)])
+        assert len(index.select(only=['filtered'])) == 1
+
+    def test_parse(self):
+        assert parse_names('link, ensure_line') == ['link', 'ensure_line']
+        assert parse_lines('100-200,-5,300-,42') == [
+            (100, 200), (None, 5), (300, None), (42, 42)]
+        assert_raises(FilterError, parse_lines, 'a-b')
+        assert_raises(FilterError, parse_lines, '')
+        assert_raises(FilterError, parse_names, ',')
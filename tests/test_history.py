@@ -0,0 +1,77 @@
+"""Test the run history."""
+
+from os import path
+import shutil
+import tempfile
+
+from wsconfig.history import History
+from wsconfig.nodes import Command
+from wsconfig.parsing import parse_string
+from wsconfig.plugins import Plugin
+from wsconfig.script import validate, apply_document
+from wsconfig.events import bus, Progress
+
+
+class TestHistory(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.history = History('doc', path.join(self.tmp, 'history'))
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_estimate(self):
+        slow, fast = Command(['$', 'slow']), Command(['$', 'fast'])
+        assert self.history.estimate(0, slow) is None
+        self.history.record(0, slow, 10, 'ok')
+        self.history.record(0, slow, 20, 'ok')
+        self.history.record(0, slow, 100, 'error')
+        self.history.record(1, fast, 1, 'ok')
+        assert self.history.estimate(0, slow) == 15
+        # The same command elsewhere
+        assert self.history.estimate(5, fast) == 1
+        # Another document
+        self.history.commit()
+        other = History('other', self.history.filename)
+        assert other.estimate(0, slow) == 15
+
+        unknown = Command(['$', 'unknown'])
+        assert self.history.estimates(
+            [(0, fast), (1, unknown), (0, slow)]) == [1, None, 15]
+
+        assert self.history.slowest()[0] == ('$', ['slow'], 15, 2)
+        assert self.history.failing() == [('$', ['slow'], 1, 3)]
+
+    def test_one_query(self):
+        queries = []
+        class Connection(object):
+            def execute(inner, *args):
+                queries.append(args[0])
+                return db.execute(*args)
+        db, self.history.db = self.history.db, Connection()
+        commands = [(i, Command(['$', str(i)])) for i in range(10)]
+        assert self.history.estimates(commands) == [None] * 10
+        assert len(queries) == 1
+
+    def test_apply(self):
+        class HistoryPlugin(Plugin):
+            name = 'historic'
+            def run(self, args, state):
+                pass
+
+        document = parse_string('historic 1\nhistoric 2')
+        validate(document, '', {'historic': HistoryPlugin})
+        apply_document(document, set(), {'variables': {}},
+                       history=self.history)
+        events = []
+        bus.subscribe(events.append)
+        try:
+            apply_document(document, set(), {'variables': {}},
+                           history=self.history)
+        finally:
+            bus.unsubscribe(events.append)
+        progress = [e for e in events if isinstance(e, Progress)]
+        assert [(e.done, e.total) for e in progress] == [(0, 2), (1, 2)]
+        assert progress[0].remaining >= progress[1].remaining >= 0
+        assert len(History(None, self.history.filename).slowest()) == 2
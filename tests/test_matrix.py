@@ -0,0 +1,54 @@
+"""Test evaluating a document for many tag sets at once.
+"""
+
+from textwrap import dedent
+from wsconfig.parsing import parse_string
+from wsconfig.script import traverse_document
+from wsconfig.matrix import evaluate_matrix, group_plans, expand_matrix
+
+
+DOCUMENT = '''
+sys:linux { cmd linux }
+sys:osx, Dev { cmd osx-or-dev }
+Dev !Vm {
+    cmd dev
+    define python
+}
+python { cmd python }
+Vm { define python }
+python sys:linux { cmd python-linux }
+!sys:osx Dev Vm { nested { cmd nested } }
+define nested
+'''
+
+
+def expected_plan(document, tags):
+    return [command for _, command, _ in traverse_document(document, tags)
+            if command]
+
+
+class TestMatrix(object):
+
+    def test_matches_traversal(self):
+        document = parse_string(dedent(DOCUMENT))
+        tag_sets = expand_matrix(
+            document, [{'sys:linux'}, {'sys:osx'}, set()], ['Dev', 'Vm'])
+        assert len(tag_sets) == 12
+        plans = evaluate_matrix(document, tag_sets)
+        for tags, plan in zip(tag_sets, plans):
+            assert plan == expected_plan(document, set(tags)), tags
+
+    def test_discovers_public_tags(self):
+        document = parse_string(dedent(DOCUMENT))
+        tag_sets = expand_matrix(document, [{'sys:osx'}])
+        assert set(tag_sets) == {
+            frozenset(['sys:osx']), frozenset(['sys:osx', 'Dev']),
+            frozenset(['sys:osx', 'Vm']), frozenset(['sys:osx', 'Dev', 'Vm'])}
+
+    def test_grouping(self):
+        document = parse_string('foo { cmd foo }\ncmd all')
+        tag_sets = [{'foo'}, set(), {'bar'}, {'foo', 'bar'}]
+        groups = group_plans(tag_sets, evaluate_matrix(document, tag_sets))
+        assert [tags for _, tags in groups] == [
+            [{'foo'}, {'foo', 'bar'}], [set(), {'bar'}]]
+        assert evaluate_matrix(document, []) == []
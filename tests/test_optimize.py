@@ -0,0 +1,123 @@
+"""Test the optimizer.
+"""
+
+import os
+from os import path
+import shutil
+import tempfile
+from textwrap import dedent
+from wsconfig.parsing import parse_string
+from wsconfig.optimize import optimize, optimize_file
+
+
+def process(text, sys_tags=('sys:linux',)):
+    document, report = optimize(list(parse_string(dedent(text))), sys_tags)
+    return document
+
+
+def same(a, b, sys_tags=('sys:linux',)):
+    return process(a, sys_tags) == list(parse_string(dedent(b)))
+
+
+class TestOptimize(object):
+
+    def test_specialize(self):
+        assert same('sys:osx { cmd }', '')
+        assert same('!sys:linux { cmd }', '')
+        assert same('sys:linux { cmd }', 'cmd')
+        assert same('sys:linux Foo { cmd }', 'Foo { cmd }')
+        assert same('sys:osx Foo, Bar sys:linux { cmd }', 'Bar { cmd }')
+        assert same('sys:osx, Foo { sys:linux { cmd } }', 'Foo { cmd }')
+        # Nothing is known about other tags
+        assert same('Foo, Bar { cmd }', 'Foo, Bar { cmd }')
+
+    def test_defined_sys_tags_are_not_known(self):
+        assert same('define sys:osx\nsys:osx { cmd }',
+                    'define sys:osx\nsys:osx { cmd }')
+
+    def test_ineffective_defines(self):
+        assert same('foo { cmd }\ndefine foo', 'foo { cmd }')
+        assert same('define foo\nfoo { cmd }', 'define foo\nfoo { cmd }')
+        assert same('define foo bar\nfoo { cmd }', 'define foo bar\nfoo { cmd }')
+        # Selectors removed as dead do not count
+        assert same('define foo\nsys:osx foo { cmd }', '')
+
+    def test_merge(self):
+        assert same('foo { a }\nfoo { b }', 'foo { a\nb }')
+        assert same('foo { a }\nfoo { bar { b } }\nfoo { bar { c } }',
+                    'foo { a\nbar { b\nc } }')
+        # Not if the first block may change the outcome of the second
+        assert same('!foo { define foo }\n!foo { b }',
+                    '!foo { define foo }\n!foo { b }')
+        # Nor if a guard would end up in front of a command of the second
+        assert same('foo { a\ncreates /x }\nfoo { b }',
+                    'foo { a\ncreates /x }\nfoo { b }')
+        assert same('creates /x\nsys:linux { cmd }',
+                    'creates /x\nsys:linux { cmd }')
+
+    def test_dedup(self):
+        assert same('dpkg a b\ndpkg b c', 'dpkg a b\ndpkg c')
+        assert same('dpkg a\nfoo { dpkg a\nsudo pip a }', 'dpkg a\nfoo { sudo pip a }')
+        # Only if the earlier command always runs before
+        assert same('foo { dpkg a }\ndpkg a', 'foo { dpkg a }\ndpkg a')
+
+    def test_dedup_options(self):
+        # Options and their values are not packages
+        assert same('pip --venv b y\npip b', 'pip --venv b y\npip b')
+        assert same('pip --wheelhouse w q\npip --wheelhouse w q w',
+                    'pip --wheelhouse w q\npip --wheelhouse w w')
+        assert same('brew --HEAD a\nbrew --HEAD a b',
+                    'brew --HEAD a\nbrew --HEAD b')
+        # dpkg installs every argument as a package
+        assert same('dpkg -t a\ndpkg -t a b', 'dpkg -t a\ndpkg b')
+        assert same('dpkg -t a\ndpkg -t a', 'dpkg -t a')
+        # Packages in different virtualenvs are different
+        assert same('pip --venv a x\npip x\npip --venv a x\npip --venv b x',
+                    'pip --venv a x\npip x\npip --venv b x')
+
+    def test_dedup_guards(self):
+        # Guards of a removed command are removed with it
+        assert same('dpkg foo\ncreates /nonexistent\ndpkg foo\n$ rm -rf x',
+                    'dpkg foo\n$ rm -rf x')
+        assert same('dpkg a\nunless "true"\ndpkg a b',
+                    'dpkg a\nunless "true"\ndpkg b')
+        # As are timeouts for the command only
+        assert same('dpkg a\ntimeout --next 5\ndpkg a\n$ make',
+                    'dpkg a\n$ make')
+        assert same('dpkg a\ntimeout 5\ndpkg a\n$ make',
+                    'dpkg a\ntimeout 5\n$ make')
+        # A guarded command may not run, so it installs nothing for sure
+        assert same('creates /x\ndpkg a\ndpkg a',
+                    'creates /x\ndpkg a\ndpkg a')
+
+    def test_report(self):
+        document, report = optimize(
+            list(parse_string('sys:osx { cmd }\ndpkg a a')), ['sys:linux'])
+        assert len(report) == 2
+
+
+class TestCache(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.old_cache = os.environ.get('WSCONFIG_CACHE')
+        os.environ['WSCONFIG_CACHE'] = self.tmp
+
+    def teardown(self):
+        if self.old_cache is None:
+            del os.environ['WSCONFIG_CACHE']
+        else:
+            os.environ['WSCONFIG_CACHE'] = self.old_cache
+        shutil.rmtree(self.tmp)
+
+    def test_broken_cache(self):
+        filename = path.join(self.tmp, 'config')
+        with open(filename, 'w') as f:
+            f.write('sys:linux { cmd }')
+        expected = optimize_file(filename, ['sys:linux'])
+        # Like a cache written by a version with other classes
+        cached = path.join(self.tmp, 'optimized')
+        for name in os.listdir(cached):
+            with open(path.join(cached, name), 'wb') as f:
+                f.write('cwsconfig.nodes\nNoSuchNode\n.')
+        assert optimize_file(filename, ['sys:linux']) == expected
@@ -6,6 +6,8 @@ from pyparsing import ParseException, ParseSyntaxException
 from nose.tools import assert_raises
 
 from wsconfig.parsing import parse_string, Command, Selector, TagExpr, Or, And
+from wsconfig.scan import scan_string, ScanError
+from wsconfig.script import firstpass
 
 
 def parse(text):
@@ -220,3 +222,133 @@ class TestParseWhitespace(object):
        $:
         foo
        ''')
+
+
+class TestNodes(object):
+
+    def test_equality_is_structural(self):
+        # Attributes added by validate do not affect equality
+        a, b = Command(['cmd', 'arg']), Command(['cmd', 'arg'])
+        a.plugin = object()
+        assert a == b
+        assert a != Command(['cmd', 'other'])
+
+    def test_interned(self):
+        a, b = parse('foo { cmd }\nfoo { cmd }')
+        assert a.tagexpr.expr.items[0].items[0] is \
+               b.tagexpr.expr.items[0].items[0]
+        assert a.items[0].argv[0] is b.items[0].argv[0]
+
+    def test_lineno(self):
+        document = parse('''\
+            cmd 1
+            # comment
+
+            foo {
+                $: echo
+                   echo
+                cmd 2 }
+            ''')
+        assert document[0].lineno == 1
+        assert [c.lineno for c in document[1].items] == [5, 7]
+
+    def test_lineno_threads(self):
+        # Every parse counts the lines of its own string
+        import threading
+        results = {}
+        def run(n):
+            for i in range(20):
+                document = parse_string('\n' * n + 'cmd 1\ncmd 2')
+                results.setdefault(n, set()).add(
+                    tuple(c.lineno for c in document))
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == dict((n, set([(n + 1, n + 2)])) for n in range(4))
+
+    def test_pickle(self):
+        import pickle
+        document = parse('foo bar, !qux { cmd "a b" }')
+        assert pickle.loads(pickle.dumps(document, 2)) == document
+        # Line numbers are not part of equality, but --lines needs them
+        loaded = pickle.loads(pickle.dumps(parse('cmd 1\n\ncmd 2'), 2))
+        assert [c.lineno for c in loaded] == [1, 3]
+
+
+class TestScan(object):
+    """The scanner must find the same selectors and defines as the
+    parser does.
+    """
+
+    documents = [
+        'Foo { }',
+        'Foo Bar, !qux { log 42 }\nBaz {}',
+        'sys:linux Foo, sys:macos Bar { Nested { define X } }',
+        'define Foo\nFoo { define "Bar" }\nBar { }',
+        # Braces in shell commands and quoted strings
+        '$ echo "{"\nFoo { $ echo }',
+        'log "a { b" \'}\'\nFoo {}',
+        # Comments
+        'Foo { # Bar {\n}\nlog 1 # define Qux\n# Baz {}',
+        # Multiline shell, including lines that look like selectors
+        dedent('''
+        Foo {
+            $: if true; then
+                 Bar {
+               fi
+            Baz { }
+        }
+        $:
+          Qux {
+          }
+        Last {}
+        '''),
+    ]
+
+    def skeleton(self, items):
+        result = []
+        for item in items:
+            if isinstance(item, Selector):
+                result.append(Selector(item.tagexpr,
+                                       self.skeleton(item.items)))
+            elif item.argv[0] == 'define':
+                result.append(item)
+        return result
+
+    def test_same_as_parser(self):
+        for text in self.documents:
+            parsed = list(parse_string(text))
+            scanned = scan_string(text)
+            assert self.skeleton(parsed) == scanned
+            for tags in (set(), {'sys:linux'}, {'Foo'}):
+                assert firstpass(scanned, tags) == firstpass(parsed, tags)
+
+    def test_errors(self):
+        assert_raises(ScanError, scan_string, 'Foo {')
+        assert_raises(ScanError, scan_string, '}')
+        assert_raises(ScanError, scan_string, 'Foo "bar" {}')
+
+    def test_imports(self):
+        # Listing tags imports neither the parser nor what plugins use
+        import sys, subprocess, tempfile, os
+        fd, filename = tempfile.mkstemp()
+        try:
+            os.write(fd, 'Foo { dpkg a }\n')
+            os.close(fd)
+            output = subprocess.check_output([sys.executable, '-c', dedent('''\
+                import sys
+                from wsconfig.script import main
+                main(['wsconfig', sys.argv[1]])
+                print ' '.join(sorted(sys.modules))
+                '''), filename])
+        finally:
+            os.unlink(filename)
+        modules = output.splitlines()[-1].split()
+        assert 'wsconfig.scan' in modules
+        for module in ('pyparsing', 'wsconfig.parsing', 'wsconfig.cache',
+                       'wsconfig.sync', 'wsconfig.linktree',
+                       'wsconfig.settings', 'wsconfig.gitrepo',
+                       'wsconfig.backends', 'urllib2', 'ctypes'):
+            assert module not in modules, module
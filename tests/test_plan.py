@@ -0,0 +1,86 @@
+"""Test compiling a document into a plan, and applying it."""
+
+import os
+from os import path
+import shutil
+import tempfile
+from textwrap import dedent
+
+from wsconfig.parsing import parse_string
+from wsconfig.plugins import Plugin
+from wsconfig.script import validate, apply_document, main
+from wsconfig.plan import compile_plan, write_plan, load_plan
+
+
+class PlannedPlugin(Plugin):
+    name = 'planned'
+    log = []
+    def run(self, args, state):
+        self.log.append((self.basedir, self.sudo, args))
+
+
+class TestPlan(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = path.join(self.tmp, 'plan.json')
+        del PlannedPlugin.log[:]
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def compile(self, text, tags, variables):
+        document = parse_string(dedent(text))
+        validate(document, path.join(self.tmp, 'src', 'config'),
+                 {'planned': PlannedPlugin})
+        plan = compile_plan(document, tags, variables)
+        with open(self.filename, 'w') as f:
+            write_plan(plan, f)
+        return plan
+
+    def test_compile(self):
+        plan = self.compile('''
+            define Bar
+            Foo { planned @@x@@ }
+            Bar { sudo planned "a b" }
+            Qux { planned never }
+        ''', {'Foo'}, {'@@x@@': '1'})
+        assert [c['argv'] for c in plan['commands']] == [
+            ['planned', '1'], ['sudo', 'planned', 'a b']]
+        assert plan['commands'][0]['basedir'] == path.join(self.tmp, 'src')
+        assert plan['tags'] == ['Foo']
+
+    def test_apply(self):
+        self.compile('planned @@x@@\nsudo planned 2', set(),
+                     {'@@x@@': '@@y@@'})
+        document, tags, variables = load_plan(
+            self.filename, {'planned': PlannedPlugin})
+        apply_document(document, tags, {'variables': variables})
+        basedir = path.join(self.tmp, 'src')
+        assert PlannedPlugin.log == [
+            (basedir, False, ['@@y@@']), (basedir, True, ['2'])]
+
+    def test_guards(self):
+        open(path.join(self.tmp, 'exists'), 'w').close()
+        self.compile('''
+            creates ../@@x@@
+            planned 1
+            planned 2
+        ''', set(), {'@@x@@': 'exists'})
+        document, tags, variables = load_plan(
+            self.filename, {'planned': PlannedPlugin})
+        apply_document(document, tags, {'variables': variables})
+        assert [args for _, _, args in PlannedPlugin.log] == [['2']]
+
+    def test_apply_plan_option(self):
+        self.compile('planned 1', set(), {})
+        cache = os.environ.get('WSCONFIG_CACHE')
+        os.environ['WSCONFIG_CACHE'] = path.join(self.tmp, 'cache')
+        try:
+            assert main(['wsconfig', '--apply-plan', self.filename]) == 0
+        finally:
+            if cache is None:
+                del os.environ['WSCONFIG_CACHE']
+            else:
+                os.environ['WSCONFIG_CACHE'] = cache
+        assert [args for _, _, args in PlannedPlugin.log] == [['1']]
@@ -1 +1,916 @@
 # XXX Add tests for the actual plugins.
+
+import os
+import sys
+from os import path
+import plistlib
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import BaseHTTPServer
+from textwrap import dedent
+from nose.tools import assert_raises
+
+from wsconfig.cache import (
+    DownloadCache, CacheError, ContentManifest, file_sha256, cache_base,
+    sudo_ids)
+from wsconfig.events import bus, FileUpdate
+from wsconfig.fscache import StatCache
+from wsconfig.parsing import parse_string
+from wsconfig.plugins import (
+    Plugin, FetchPlugin, LinkPlugin, MkdirPlugin, DpkgPlugin, PipPlugin,
+    ShellPlugin, TemplatePlugin, SyncPlugin, LinkTreePlugin, ServicePlugin,
+    SettingPlugin, GitPlugin, TimeoutPlugin, ApplyError, ApplyTimeout,
+    stat_cache)
+from wsconfig.backends import MemoryBackend
+from wsconfig.gitrepo import find_git_dir, read_head, tag_commit
+from wsconfig.linktree import link_tree, LinkManifest, LinkConflict
+from wsconfig.prefetch import Prefetcher
+from wsconfig.sync import sync, copy_file
+from wsconfig.script import validate, apply_document, find_variables
+from wsconfig.checkpoint import Checkpoint
+
+
+class TempDirTest(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.old_path = os.environ['PATH']
+        self.old_cache = os.environ.get('WSCONFIG_CACHE')
+
+    def teardown(self):
+        os.environ['PATH'] = self.old_path
+        if self.old_cache is None:
+            os.environ.pop('WSCONFIG_CACHE', None)
+        else:
+            os.environ['WSCONFIG_CACHE'] = self.old_cache
+        shutil.rmtree(self.tmp)
+
+    def use_cache(self):
+        """Have wsconfig use a cache within the temporary directory."""
+        os.environ['WSCONFIG_CACHE'] = path.join(self.tmp, 'cache')
+
+    def stub_command(self, name, script=''):
+        """Put an executable ``name`` on the PATH that records the
+        arguments it is called with, then runs ``script``. Returns a
+        function that returns the recorded calls.
+        """
+        bindir = path.join(self.tmp, 'bin')
+        log = path.join(self.tmp, '%s.log' % name)
+        filename = self.create('bin/%s' % name,
+            '#!/bin/sh\necho "$@" >> "%s"\n%s\n' % (log, script))
+        os.chmod(filename, 0755)
+        os.environ['PATH'] = bindir + os.pathsep + self.old_path
+        def calls():
+            if not path.exists(log):
+                return []
+            return open(log).read().splitlines()
+        return calls
+
+    def create(self, name, content):
+        filename = path.join(self.tmp, name)
+        if not path.exists(path.dirname(filename)):
+            os.makedirs(path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(content)
+        return filename
+
+
+class ETagHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves ``body`` with an ETag, counting the requests made."""
+
+    body = 'served content'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.getheader('If-None-Match'))
+        if self.headers.getheader('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *a):
+        pass
+
+
+class TestDownloadCache(TempDirTest):
+
+    def setup(self):
+        TempDirTest.setup(self)
+        self.cache = DownloadCache(path.join(self.tmp, 'cache'))
+
+    def test_file_url(self):
+        source = self.create('source', 'hello')
+        cached = self.cache.get('file://%s' % source)
+        assert open(cached).read() == 'hello'
+        # Content-addressed
+        assert path.basename(cached) == file_sha256(source)
+
+    def test_sha256_pin(self):
+        source = self.create('source', 'hello')
+        url = 'file://%s' % source
+        assert_raises(CacheError, self.cache.get, url, '0' * 64)
+
+        digest = file_sha256(source)
+        self.cache.get(url, digest)
+        # Once cached, a pinned download does not hit the url at all
+        os.unlink(source)
+        assert open(self.cache.get(url, digest)).read() == 'hello'
+
+    def test_conditional_request(self):
+        ETagHandler.requests = []
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), ETagHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/file' % server.server_port
+            first = self.cache.get(url)
+            second = self.cache.get(url)
+        finally:
+            server.shutdown()
+        assert first == second
+        assert open(second).read() == ETagHandler.body
+        assert ETagHandler.requests == [None, '"v1"']
+
+    def test_lru_eviction(self):
+        self.cache.max_size = 10
+        a = self.cache.get('file://%s' % self.create('a', 'a' * 6))
+        b = self.cache.get('file://%s' % self.create('b', 'b' * 6))
+        assert not path.exists(a)
+        assert path.exists(b)
+
+    def test_parallel(self):
+        urls = ['file://%s' % self.create(name, name * 100)
+                for name in 'abcdefgh']
+        threads = [threading.Thread(target=self.cache.get, args=(url,))
+                   for url in urls]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # No download lost the index entries of another
+        index = self.cache._load_index()
+        assert sorted(index['urls']) == sorted(urls)
+        assert len(index['objects']) == len(urls)
+
+    def test_sudo_user(self):
+        os.environ.pop('WSCONFIG_CACHE', None)
+        old_environ = dict(os.environ)
+        old_getuid = os.getuid
+        os.environ.update(SUDO_USER='nobody', SUDO_UID='65534',
+                          SUDO_GID='65534', XDG_CACHE_HOME='')
+        os.getuid = lambda: 0
+        try:
+            assert sudo_ids() == (65534, 65534)
+            # The cache of the user who ran sudo, not that of root
+            assert cache_base() == path.join(
+                path.expanduser('~nobody'), '.cache', 'wsconfig')
+        finally:
+            os.getuid = old_getuid
+            os.environ.clear()
+            os.environ.update(old_environ)
+
+
+class TestFetchPlugin(TempDirTest):
+
+    def test_fetch(self):
+        self.use_cache()
+        source = self.create('source', 'hello')
+        FetchPlugin.impl([self.tmp, 'file://%s' % source, 'out/'])
+        assert open(path.join(self.tmp, 'out', 'source')).read() == 'hello'
+
+        assert_raises(ApplyError, FetchPlugin.impl,
+            [self.tmp, '--sha256', '0' * 64, 'file://%s' % source, 'out'])
+
+
+class TestTemplatePlugin(TempDirTest):
+
+    def test_template(self):
+        self.create('tmpl', 'name=@@name@@\nkeep=@@unknown@@\n')
+        dst = path.join(self.tmp, 'out')
+        events = []
+        def run(name):
+            state = {'variables': {'@@name@@': name}, 'content_manifest':
+                     ContentManifest(path.join(self.tmp, 'manifest'))}
+            TemplatePlugin(self.tmp).run(['tmpl', 'out'], state)
+        bus.subscribe(events.append)
+        try:
+            run('a')
+            assert open(dst).read() == 'name=a\nkeep=@@unknown@@\n'
+            mtime = os.stat(dst).st_mtime
+            run('a')
+            assert os.stat(dst).st_mtime == mtime
+            run('b')
+            assert open(dst).read() == 'name=b\nkeep=@@unknown@@\n'
+        finally:
+            bus.unsubscribe(events.append)
+        assert [e.changed for e in events if isinstance(e, FileUpdate)] == \
+            [True, False, True]
+
+    def test_manifest(self):
+        manifest = ContentManifest(path.join(self.tmp, 'manifest'))
+        filename = self.create('file', 'abc')
+        assert manifest.matches(filename, 'abc')
+        assert not manifest.matches(filename, 'abd')
+        assert not manifest.matches(filename, 'abcd')
+        # Once recorded, the file is not read again
+        os.chmod(filename, 0)
+        assert ContentManifest(manifest.filename).matches(filename, 'abc')
+
+    def test_variables(self):
+        self.create('tmpl', '@@a@@ @@b@@')
+        document = parse_string('template tmpl out')
+        validate(document, path.join(self.tmp, 'config'),
+                 {'template': TemplatePlugin})
+        assert find_variables(document, set()) == {'@@a@@', '@@b@@'}
+
+
+class TestSync(TempDirTest):
+
+    def setup(self):
+        TempDirTest.setup(self)
+        self.create('src/a', 'a')
+        self.create('src/sub/b', 'b')
+        os.symlink('a', path.join(self.tmp, 'src', 'link'))
+        self.src = path.join(self.tmp, 'src')
+        self.dst = path.join(self.tmp, 'dst')
+
+    def test_copy_file(self):
+        data = os.urandom(100000)
+        filename = self.create('big', data)
+        os.utime(filename, (1000000000.5, 1000000000.5))
+        assert copy_file(filename, path.join(self.tmp, 'copy'))
+        assert open(path.join(self.tmp, 'copy'), 'rb').read() == data
+        assert os.stat(path.join(self.tmp, 'copy')).st_mtime == 1000000000.5
+
+    def test_lazy_libc(self):
+        # The C library is only loaded to copy a file, and only once
+        filename = self.create('file', 'data')
+        output = subprocess.check_output([sys.executable, '-c', dedent('''\
+            import sys
+            from wsconfig import sync
+            print 'ctypes' in sys.modules
+            sync.copy_file(sys.argv[1], sys.argv[1] + '.copy')
+            sync.libc_function('sendfile')
+            sync.libc_function('copy_file_range')
+            print len(sync.loaded_libc)
+            '''), filename])
+        assert output.split() == ['False', '1']
+        assert open(filename + '.copy').read() == 'data'
+
+    def test_sync(self):
+        changes = sync(self.src, self.dst)
+        assert sorted(name[len(self.dst):] for _, name in changes) == [
+            '', '/a', '/link', '/sub', '/sub/b']
+        assert open(path.join(self.dst, 'sub', 'b')).read() == 'b'
+        assert os.readlink(path.join(self.dst, 'link')) == 'a'
+        # Nothing changed, nothing to do
+        assert sync(self.src, self.dst) == []
+
+        self.create('src/sub/b', 'bb')
+        os.unlink(path.join(self.src, 'a'))
+        assert sync(self.src, self.dst) == [
+            ('copied', path.join(self.dst, 'sub', 'b'))]
+        assert path.exists(path.join(self.dst, 'a'))
+        assert sync(self.src, self.dst, delete=True) == [
+            ('deleted', path.join(self.dst, 'a'))]
+
+    def test_checksum(self):
+        manifest = ContentManifest(path.join(self.tmp, 'manifest'))
+        sync(self.src, self.dst, manifest=manifest)
+        # Only the modification time changed
+        os.utime(path.join(self.src, 'a'), (0, 0))
+        assert sync(self.src, self.dst, manifest=manifest) == []
+        assert sync(self.src, self.dst) != []
+
+    def test_plugin(self):
+        SyncPlugin(self.tmp).run(['--delete', 'src', 'dst'], {})
+        assert open(path.join(self.dst, 'a')).read() == 'a'
+        assert_raises(ApplyError, SyncPlugin(self.tmp).run,
+                      ['--bogus', 'src', 'dst'], {})
+
+
+class TestLinkTree(TempDirTest):
+
+    def setup(self):
+        TempDirTest.setup(self)
+        self.create('vim/.vimrc', '')
+        self.create('vim/.vim/colors/dark.vim', '')
+        self.create('git/.gitconfig', '')
+        self.create('home/.profile', '')
+        self.home = path.join(self.tmp, 'home')
+        self.manifest = LinkManifest(path.join(self.tmp, 'linktree.json'))
+
+    def link(self, package):
+        return [(action, filename[len(self.home) + 1:]) for action, filename
+                in link_tree(path.join(self.tmp, package), self.home,
+                             manifest=self.manifest)]
+
+    def test_fold(self):
+        assert self.link('vim') == [('linked', '.vim'), ('linked', '.vimrc')]
+        # A whole directory is linked
+        assert os.readlink(path.join(self.home, '.vim')) == '../vim/.vim'
+        assert self.link('vim') == []
+
+    def test_unfold(self):
+        self.link('vim')
+        self.create('colors/.vim/colors/light.vim', '')
+        assert self.link('colors') == [
+            ('unfolded', '.vim'), ('unfolded', '.vim/colors'),
+            ('linked', '.vim/colors/light.vim'),
+            ('linked', '.vim/colors/dark.vim')]
+        assert path.isdir(path.join(self.home, '.vim', 'colors'))
+        assert os.readlink(path.join(self.home, '.vim/colors/dark.vim')) == \
+            '../../../vim/.vim/colors/dark.vim'
+        assert os.readlink(path.join(self.home, '.vim/colors/light.vim')) == \
+            '../../../colors/.vim/colors/light.vim'
+
+    def test_unfold_other_link(self):
+        # A link made by the user to a directory outside of any tree
+        self.create('data/local/bin/tool', '')
+        os.symlink(path.join(self.tmp, 'data/local'),
+                   path.join(self.home, '.local'))
+        self.create('bin/.local/bin/script', '')
+        assert_raises(LinkConflict, self.link, 'bin')
+        assert path.islink(path.join(self.home, '.local'))
+
+    def test_conflict(self):
+        self.create('git/.profile', '')
+        assert_raises(LinkConflict, self.link, 'git')
+        # Nothing was changed
+        assert not path.lexists(path.join(self.home, '.gitconfig'))
+
+    def test_removed(self):
+        self.link('vim')
+        os.unlink(path.join(self.tmp, 'vim', '.vimrc'))
+        assert self.link('vim') == [('unlinked', '.vimrc')]
+
+    def test_plugin(self):
+        self.use_cache()
+        LinkTreePlugin(self.tmp).run(['git', 'home'], {})
+        assert_raises(ApplyError, LinkTreePlugin(self.tmp).run,
+                      ['missing', 'home'], {})
+        assert path.islink(path.join(self.home, '.gitconfig'))
+
+
+class TestStatCache(TempDirTest):
+
+    def test_prefetch(self):
+        for name in 'abcd':
+            self.create(name, '')
+        cache = StatCache()
+        lstat_calls = []
+        original_lstat = os.lstat
+        def counting_lstat(filename):
+            lstat_calls.append(filename)
+            return original_lstat(filename)
+        os.lstat = counting_lstat
+        try:
+            for name in 'abcd':
+                assert cache.exists(path.join(self.tmp, name))
+            # After a few lookups, the directory was listed, so we know
+            # without asking that a file does not exist.
+            calls = len(lstat_calls)
+            assert not cache.exists(path.join(self.tmp, 'missing'))
+            assert len(lstat_calls) == calls
+        finally:
+            os.lstat = original_lstat
+
+    def test_changes(self):
+        cache = StatCache()
+        link = path.join(self.tmp, 'sub', 'link')
+        assert not cache.exists(link)
+        cache.makedirs(path.dirname(link))
+        assert cache.isdir(path.dirname(link))
+        cache.symlink('target', link)
+        assert cache.islink(link) and not cache.exists(link)
+        assert cache.readlink(link) == 'target'
+        self.create('sub/target', '')
+        cache.invalidate(path.join(self.tmp, 'sub', 'target'))
+        assert cache.exists(link)
+        cache.unlink(link)
+        assert not cache.lexists(link)
+
+
+class TestLinkPlugin(TempDirTest):
+
+    def test_link(self):
+        self.create('src', 'content')
+        fs = StatCache()
+        dst = path.join(self.tmp, 'a', 'b', 'dst')
+        LinkPlugin.impl([self.tmp, 'src', dst], fs=fs)
+        assert os.readlink(dst) == path.join('..', '..', 'src')
+        # Already linked
+        assert LinkPlugin.impl([self.tmp, 'src', dst], fs=fs) is None
+        # Something else is in the way
+        self.create('other', '')
+        assert LinkPlugin.impl([self.tmp, 'other', dst], fs=fs) == 1
+        LinkPlugin.impl([self.tmp, '-f', 'other', dst], fs=fs)
+        assert open(dst).read() == ''
+
+
+class TestMkdirPlugin(TempDirTest):
+
+    def test_mkdir(self):
+        state = {}
+        MkdirPlugin(self.tmp).run(['a/b', 'a/b'], state)
+        assert path.isdir(path.join(self.tmp, 'a', 'b'))
+        assert state['stat_cache'].isdir(path.join(self.tmp, 'a'))
+
+    def test_after_external_command(self):
+        # A package manager, say, creates the directory behind our back
+        calls = self.stub_command('installer', 'mkdir -p "$1"')
+        state = {}
+        target = path.join(self.tmp, 'created')
+        assert not stat_cache(state).exists(target)
+        UnprivilegedDpkgPlugin(self.tmp).execute_proc(
+            ['installer', target], state)
+        MkdirPlugin(self.tmp).run(['created'], state)
+        assert calls() == [target]
+
+
+class TestPipPlugin(TempDirTest):
+
+    def setup(self):
+        TempDirTest.setup(self)
+        # Installing from the wheelhouse works if there are wheels in it;
+        # "building" them puts one there.
+        self.pip = self.stub_command('pip', dedent('''
+            case "$1 $2" in
+                "install --no-index") ls "$4"/*.whl > /dev/null 2>&1 || exit 1;;
+                "wheel --wheel-dir") touch "$3/pkg.whl";;
+            esac'''))
+        self.virtualenv = self.stub_command('virtualenv', dedent('''
+            mkdir -p "$1/bin"
+            cp "%s" "$1/bin/pip"''' % path.join(self.tmp, 'bin', 'pip')))
+
+    def test_wheelhouse(self):
+        wheelhouse = path.join(self.tmp, 'wheels')
+        plugin = PipPlugin(self.tmp, sudo=False)
+        plugin.run(['--wheelhouse', 'wheels', 'a', 'b'], {})
+        assert self.pip() == [
+            'install --no-index --find-links %s a b' % wheelhouse,
+            'wheel --wheel-dir %s --find-links %s a b' % (
+                wheelhouse, wheelhouse),
+            'install --no-index --find-links %s a b' % wheelhouse]
+        # The wheels are there now
+        plugin.run(['--wheelhouse', 'wheels', 'a', 'b'], {})
+        assert len(self.pip()) == 4
+
+    def test_venv(self):
+        # Not run as root, even though pip is by default
+        plugin = PipPlugin(self.tmp)
+        plugin.run(['--venv', 'env', 'a'], {})
+        plugin.run(['--venv', 'env', 'b'], {})
+        assert self.virtualenv() == [path.join(self.tmp, 'env')]
+        assert self.pip() == ['install a', 'install b']
+
+    def test_invalid(self):
+        assert_raises(ApplyError, PipPlugin(self.tmp).run, ['--venv'], {})
+        assert_raises(ApplyError, PipPlugin(self.tmp).run,
+                      ['--venv', 'env'], {})
+
+
+class UnprivilegedServicePlugin(ServicePlugin):
+    name = 'service_nosudo'
+    sudo = False
+
+
+class TestServicePlugin(TempDirTest):
+
+    def setup(self):
+        TempDirTest.setup(self)
+        self.systemctl = self.stub_command('systemctl', dedent('''
+            [ "$1" = show ] || exit 0
+            for unit in "$@"; do
+                case "$unit" in
+                    show|--*|bad) ;;
+                    running|running.service) state="running enabled active";;
+                    disabled) state="disabled disabled inactive";;
+                    alias.socket) state="real enabled active"; alias=" $unit";;
+                    *) state="$unit enabled failed";;
+                esac
+                [ -n "$state" ] || continue
+                set -- $state
+                printf 'Id=%s.service\\nNames=%s.service%s\\n' "$1" "$1" "$alias"
+                printf 'UnitFileState=%s\\nActiveState=%s\\n\\n' "$2" "$3"
+                state= alias=
+            done'''))
+
+    def test_batched(self):
+        plugin = UnprivilegedServicePlugin(self.tmp)
+        state = {}
+        plugin.run(['running', 'disabled', 'stopped'], state)
+        plugin.run(['disabled', 'running'], state)
+        assert self.systemctl() == [
+            'show --property=Id,Names,UnitFileState,ActiveState -- '
+            'running disabled stopped',
+            'enable -- disabled',
+            'start -- disabled stopped']
+
+    def test_by_name(self):
+        # Units are matched by name, not by the order of the output
+        plugin = UnprivilegedServicePlugin(self.tmp)
+        plugin.run(['bad', 'alias.socket', 'running.service'], {})
+        assert self.systemctl()[1:] == ['enable -- bad', 'start -- bad']
+
+    def test_options(self):
+        plugin = UnprivilegedServicePlugin(self.tmp)
+        plugin.run(['--enable', 'disabled'], {})
+        assert self.systemctl()[1:] == ['enable -- disabled']
+        assert_raises(ApplyError, plugin.run, ['--restart', 'a'], {})
+
+    def test_one_snapshot(self):
+        document = parse_string('service a\nfoo { service b }\nservice c')
+        validate(document, self.tmp, {'service': UnprivilegedServicePlugin})
+        apply_document(document, set(), {'variables': {}})
+        assert self.systemctl() == [
+            'show --property=Id,Names,UnitFileState,ActiveState -- a c',
+            'start -- a', 'start -- c']
+
+
+class TestSettingPlugin(TempDirTest):
+
+    def apply(self, text, tags, **kw):
+        document = parse_string(dedent(text))
+        validate(document, self.tmp, {'setting': SettingPlugin,
+                                      '$': ShellPlugin})
+        apply_document(document, tags, {'variables': {}},
+                       on_failure=lambda e: False, **kw)
+
+    def test_dconf(self):
+        loaded = path.join(self.tmp, 'loaded')
+        dconf = self.stub_command('dconf', dedent('''
+            case "$1" in
+                dump) printf "[interface]\\ngtk-theme='Adwaita'\\n";;
+                load) cat >> "%s";;
+            esac''' % loaded))
+        self.apply('''
+            setting /org/gnome/desktop/interface/gtk-theme string Adwaita
+            setting /org/gnome/desktop/interface/font-size int 12
+            setting /org/gnome/desktop/wm/preferences/focus bool yes
+            ''', {'sys:linux'})
+        # One read for all keys, one write for the values that change
+        assert dconf() == ['dump /org/gnome/desktop/', 'load /']
+        assert open(loaded).read() == dedent('''\
+            [org/gnome/desktop/interface]
+            font-size=12
+
+            [org/gnome/desktop/wm/preferences]
+            focus=true
+
+            ''')
+
+    def test_gconf(self):
+        loaded = path.join(self.tmp, 'loaded')
+        gconftool = self.stub_command('gconftool-2', dedent('''
+            case "$1" in
+                --dump) echo '<gconfentryfile><entrylist base="/apps/wm">
+                    <entry><key>theme</key><value><string>Clearlooks</string>
+                    </value></entry></entrylist></gconfentryfile>';;
+                --load) cp "$2" "%s";;
+            esac''' % loaded))
+        self.apply('''
+            setting --store gconf /apps/wm/theme string Clearlooks
+            setting --store gconf /apps/wm/workspaces int 4
+            ''', {'sys:linux'})
+        assert [call.split()[0] for call in gconftool()] == [
+            '--dump', '--load']
+        assert '<key>workspaces</key><value><int>4</int>' in open(
+            loaded).read()
+
+    def test_defaults(self):
+        # Values that another program writes in the meantime are kept
+        domain = path.join(self.tmp, 'com.example.plist')
+        self.stub_command('defaults', dedent('''
+            case "$1" in
+                export) cat "%(domain)s" 2>/dev/null || true;;
+                import) cat > "%(domain)s";;
+                write) "%(python)s" -c 'if 1:
+                    import os, sys, plistlib
+                    values = plistlib.readPlist(sys.argv[1]) \\
+                        if os.path.exists(sys.argv[1]) else {}
+                    values[sys.argv[2]] = sys.argv[3]
+                    plistlib.writePlist(values, sys.argv[1])
+                    ' "%(domain)s" "$3" "$4";;
+            esac''' % {'domain': domain, 'python': sys.executable}))
+        self.apply('''
+            setting com.example/a string 1
+            $ defaults write com.example b 2
+            setting com.example/c string 3
+            ''', {'sys:macos'})
+        assert plistlib.readPlist(domain) == {'a': '1', 'b': '2', 'c': '3'}
+
+    def test_flushed(self):
+        # Pending values are written before another command runs; those
+        # that fail to be written do not complete
+        dconf = self.stub_command('dconf', dedent('''
+            if [ "$1" = load ] && grep -q fail; then
+                exit 1
+            fi'''))
+        checkpoint = Checkpoint(path.join(self.tmp, 'checkpoint'), 'id')
+        self.apply('''
+            setting /a int 1
+            setting /b int 2
+            $ dconf read /a
+            setting /c string fail
+            ''', {'sys:linux'}, checkpoint=checkpoint)
+        assert dconf() == ['dump /', 'load /', 'read /a', 'load /']
+        assert checkpoint.completed == set([0, 1, 2])
+
+    def test_nothing_to_do(self):
+        dconf = self.stub_command('dconf', 'echo "[/]"; echo "a=true"')
+        self.apply('setting /a bool true', {'sys:linux'})
+        assert dconf() == ['dump /']
+
+    def test_write_fails(self):
+        self.stub_command('dconf', 'test "$1" = dump || exit 1')
+        plugin = SettingPlugin(self.tmp)
+        state = {'tags': {'sys:linux'}}
+        plugin.run(['/a', 'bool', 'true'], state)
+        assert_raises(ApplyError, plugin.flush, state)
+
+    def test_invalid(self):
+        plugin = SettingPlugin(self.tmp)
+        state = {'tags': {'sys:linux'}}
+        for arguments in [['/a', 'bool'], ['/a', 'list', 'x'],
+                          ['--store', 'registry', '/a', 'int', '1']]:
+            assert_raises(ApplyError, plugin.run, arguments, state)
+        assert_raises(ApplyError, plugin.run, ['/a', 'int', '1'], {})
+
+
+class TestGitPlugin(TempDirTest):
+
+    def setup(self):
+        TempDirTest.setup(self)
+        self.git('init', '-q', 'work')
+        self.commit('first')
+        self.git('-C', 'work', 'tag', '-a', '-m', 'Release', 'v1')
+        self.git('clone', '-q', '--bare', 'work', 'upstream.git')
+        self.url = 'file://%s' % path.join(self.tmp, 'upstream.git')
+
+    def git(self, *args):
+        subprocess.check_call(
+            ['git', '-c', 'user.name=Test', '-c', 'user.email=test@test'] +
+            list(args), cwd=self.tmp)
+
+    def rev_parse(self, repo, rev='HEAD'):
+        return subprocess.check_output(
+            ['git', '-C', path.join(self.tmp, repo), 'rev-parse',
+             '%s^{commit}' % rev]).strip()
+
+    def commit(self, name):
+        self.create('work/%s' % name, name)
+        self.git('-C', 'work', 'add', name)
+        self.git('-C', 'work', 'commit', '-q', '-m', name)
+
+    def publish(self, name):
+        self.commit(name)
+        self.git('-C', 'work', 'push', '-q', '--tags',
+                 path.join(self.tmp, 'upstream.git'), 'master')
+
+    def test_clone_and_fetch(self):
+        GitPlugin(self.tmp).run([self.url, 'clone'], {})
+        gitdir = find_git_dir(path.join(self.tmp, 'clone'))
+        assert read_head(gitdir) == ('master', self.rev_parse('clone'))
+
+        self.publish('second')
+        GitPlugin(self.tmp).run([self.url, 'clone'], {})
+        assert path.exists(path.join(self.tmp, 'clone', 'second'))
+        assert read_head(gitdir) == ('master', self.rev_parse('work'))
+
+    def test_pinned(self):
+        first = self.rev_parse('work')
+        GitPlugin(self.tmp).run(['--ref', 'v1', self.url, 'tagged'], {})
+        GitPlugin(self.tmp).run(['--ref', first, self.url, 'commit'], {})
+        assert self.rev_parse('tagged') == self.rev_parse('commit') == first
+        assert tag_commit(find_git_dir(path.join(self.tmp, 'tagged')),
+                          'v1') == first
+
+        # Checked out already; git does not even run
+        self.publish('second')
+        backend = MemoryBackend()
+        for arguments in (['--ref', 'v1', self.url, 'tagged'],
+                          ['--ref', first, self.url, 'commit']):
+            plugin = GitPlugin(self.tmp)
+            plugin.backend = backend
+            plugin.run(arguments, {'backend': backend})
+        assert backend.operations == []
+
+        # A new pin is fetched
+        self.git('-C', 'work', 'tag', 'v2')
+        self.git('-C', 'work', 'push', '-q', '--tags',
+                 path.join(self.tmp, 'upstream.git'), 'master')
+        GitPlugin(self.tmp).run(['--ref', 'v2', self.url, 'tagged'], {})
+        assert self.rev_parse('tagged') == self.rev_parse('work')
+
+    def test_branch(self):
+        self.git('-C', 'work', 'branch', 'stable')
+        self.git('-C', 'work', 'push', '-q',
+                 path.join(self.tmp, 'upstream.git'), 'stable')
+        GitPlugin(self.tmp).run([self.url, 'clone'], {})
+        GitPlugin(self.tmp).run(['--ref', 'stable', self.url, 'clone'], {})
+        gitdir = find_git_dir(path.join(self.tmp, 'clone'))
+        assert read_head(gitdir)[0] == 'stable'
+
+    def test_shallow_and_reference(self):
+        self.publish('second')
+        GitPlugin(self.tmp).run(['--depth', '1', self.url, 'shallow'], {})
+        assert path.exists(path.join(self.tmp, 'shallow', '.git', 'shallow'))
+
+        GitPlugin(self.tmp).run(
+            ['--reference', 'upstream.git', self.url, 'borrowed'], {})
+        alternates = path.join(self.tmp, 'borrowed', '.git', 'objects',
+                               'info', 'alternates')
+        assert open(alternates).read().strip() == \
+            path.join(self.tmp, 'upstream.git', 'objects')
+
+    def test_prefetch(self):
+        document = parse_string(dedent('''\
+            git %(url)s one
+            git --ref v1 %(url)s two
+            unless true
+            git %(url)s skipped
+            ''') % {'url': self.url})
+        validate(document, path.join(self.tmp, 'config'), {'git': GitPlugin})
+        apply = lambda: apply_document(document, set(), {'variables': {}},
+                                       prefetcher=Prefetcher(2),
+                                       on_failure=lambda e: False)
+        apply()
+        assert self.rev_parse('one') == self.rev_parse('two', 'v1')
+        # Not cloned ahead of its guard
+        assert not path.exists(path.join(self.tmp, 'skipped'))
+
+        self.publish('second')
+        apply()
+        assert self.rev_parse('one') == self.rev_parse('work')
+
+    def test_invalid(self):
+        assert_raises(ApplyError, GitPlugin(self.tmp).run, [self.url], {})
+        assert_raises(ApplyError, GitPlugin(self.tmp).run,
+                      ['--depth', 'all', self.url, 'clone'], {})
+        short = self.rev_parse('work')[:7]
+        assert_raises(ApplyError, GitPlugin(self.tmp).run,
+                      ['--ref', short, self.url, 'clone'], {})
+
+
+class UnprivilegedDpkgPlugin(DpkgPlugin):
+    name = 'dpkg_nosudo'
+    sudo = False
+
+
+class TestPrefetch(TempDirTest):
+
+    def test_prefetcher(self):
+        prefetcher = Prefetcher(1)
+        done = []
+        prefetcher.submit('a', lambda: done.append('a'))
+        prefetcher.submit('a', lambda: done.append('again'))
+        prefetcher.submit('fails', lambda: 1 / 0)
+        prefetcher.jobs['fails'].finished.wait()
+        # Both jobs ran, in order, by the one thread
+        assert prefetcher.claim('a') is True
+        assert done == ['a']
+        assert prefetcher.claim('fails') is False
+        assert prefetcher.claim('unknown') is False
+        prefetcher.shutdown()
+        assert 'again' not in done
+
+    def test_claim_cancels(self):
+        prefetcher = Prefetcher(1)
+        started, release = threading.Event(), threading.Event()
+        done = []
+        prefetcher.submit('busy', lambda: (started.set(), release.wait()))
+        prefetcher.submit('queued', lambda: done.append('queued'))
+        started.wait()
+        # Not started yet, so the foreground does it instead
+        assert prefetcher.claim('queued') is False
+        release.set()
+        assert prefetcher.claim('busy') is True
+        prefetcher.shutdown()
+        assert done == []
+
+    def test_dpkg(self):
+        calls = self.stub_command('apt-get')
+        document = parse_string(
+            'dpkg_nosudo a b\n$ sleep 0.5\ndpkg_nosudo c')
+        validate(document, self.tmp,
+                 {'dpkg_nosudo': UnprivilegedDpkgPlugin, '$': ShellPlugin})
+        apply_document(document, set(), {'variables': {}},
+                       prefetcher=Prefetcher(2))
+
+        installs = [call for call in calls() if '--download-only' not in call]
+        assert installs == ['install -y a', 'install -y b', 'install -y c']
+        # The download for "c" happened in the background, while the
+        # shell command ran.
+        assert calls().index('install --download-only -y -q c') < \
+               calls().index('install -y c')
+
+
+class TestTimeout(TempDirTest):
+
+    def is_running(self, pid):
+        try:
+            with open('/proc/%d/status' % pid) as f:
+                return '\tZ' not in f.read()
+        except IOError:
+            return False
+
+    def test_kill_group(self):
+        pidfile = path.join(self.tmp, 'pid')
+        plugin = ShellPlugin(self.tmp)
+        started = time.time()
+        with assert_raises(ApplyTimeout):
+            plugin.run(['sleep 30 & echo $! > %s; wait' % pidfile],
+                       {'timeout': 0.5})
+        assert time.time() - started < 5
+        # What the shell started was killed along with it
+        pid = int(open(pidfile).read())
+        for i in range(20):
+            if not self.is_running(pid):
+                break
+            time.sleep(0.1)
+        assert not self.is_running(pid)
+
+    def test_kill_background(self):
+        # As started by the jobs of a Prefetcher
+        pidfile = path.join(self.tmp, 'pid')
+        plugin = ShellPlugin(self.tmp)
+        errors = []
+        def job():
+            try:
+                plugin.execute_quietly(
+                    ['sh', '-c', 'sleep 30 & echo $! > %s; wait' % pidfile],
+                    0.5)
+            except ApplyTimeout, e:
+                errors.append(e)
+        thread = threading.Thread(target=job)
+        thread.start()
+        thread.join(10)
+        assert len(errors) == 1
+        assert errors[0].process.pid != os.getpgrp()
+        pid = int(open(pidfile).read())
+        for i in range(20):
+            if not self.is_running(pid):
+                break
+            time.sleep(0.1)
+        assert not self.is_running(pid)
+
+    def timeouts(self, text, only=None, **kwargs):
+        """Apply ``text``, and return the arguments and timeout of every
+        ``timed`` command that ran. ``only`` are the arguments of the
+        commands to run.
+        """
+        ran = []
+        class TimedPlugin(Plugin):
+            name = 'timed'
+            def run(self, arguments, state):
+                ran.append((arguments, state['timeout']))
+        document = parse_string(dedent(text))
+        validate(document, path.join(self.tmp, 'config'),
+                 {'timeout': TimeoutPlugin, 'timed': TimedPlugin})
+        if only is not None:
+            kwargs['only'] = set(id(command) for command in document
+                                 if list(command.args) in only)
+        apply_document(document, set(),
+                       {'variables': {}, 'timeouts': {None: 30.0}}, **kwargs)
+        return ran
+
+    def test_configuration(self):
+        assert self.timeouts('''\
+            timed 1
+            timeout 60
+            timed 2
+            timeout 5 timed
+            timed 3
+            timeout --next 1
+            timed 4
+            timed 5
+            ''') == [(['1'], 30.0), (['2'], 60.0), (['3'], 5.0),
+                      (['4'], 1.0), (['5'], 5.0)]
+
+    def test_skipped(self):
+        text = '''\
+            timeout 600
+            timed 1
+            timeout --next 1
+            timed 2
+            timed 3
+            '''
+        # Resuming after the timeout commands ran
+        checkpoint = Checkpoint(path.join(self.tmp, 'checkpoint'), 'id')
+        checkpoint.completed = set([0, 1, 2])
+        assert self.timeouts(text, checkpoint=checkpoint) == [
+            (['2'], 1.0), (['3'], 600.0)]
+
+        # Filtering out the timeout commands, and the command that
+        # "--next" is for
+        assert self.timeouts(text, only=[['3']]) == [(['3'], 600.0)]
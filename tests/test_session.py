@@ -0,0 +1,91 @@
+"""Test the embeddable session."""
+
+import os
+from os import path
+import shutil
+import tempfile
+
+from nose.tools import assert_raises
+
+from wsconfig.plugins import Plugin, ApplyError
+from wsconfig.events import bus, CommandEnd, CommandFail, RunEnd
+from wsconfig.script import ConfigError
+from wsconfig.session import Session
+
+
+class SessionPlugin(Plugin):
+    name = 'sessioned'
+    log = []
+    def run(self, args, state):
+        if args == ['fail']:
+            raise ApplyError('failed')
+        self.log.append(args)
+
+
+class TestSession(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.filename = path.join(self.tmp, 'config')
+        self.write('define Base\nBase { Dev { sessioned @@x@@ } }\n')
+        self.session = Session(self.filename, variables={'@@x@@': '1'},
+                               sys_tags={'sys:linux'},
+                               plugins={'sessioned': SessionPlugin})
+        del SessionPlugin.log[:]
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, text, mtime=None):
+        with open(self.filename, 'w') as f:
+            f.write(text)
+        if mtime:
+            os.utime(self.filename, (mtime, mtime))
+
+    def test_discover_and_plan(self):
+        assert self.session.discover_tags() == {'Dev'}
+        plan = self.session.plan(['Dev'])
+        assert [c['argv'] for c in plan] == [['sessioned', '1']]
+        # Memoized
+        assert self.session.plan(['Dev']) is plan
+        assert self.session.plan() == []
+
+        # Changes to the file are picked up
+        self.write('Other { sessioned 2 }\nsessioned 3\n', mtime=1000)
+        assert self.session.discover_tags() == {'Other'}
+        assert [c['argv'] for c in self.session.plan(['Dev'])] == [
+            ['sessioned', '3']]
+
+    def test_missing_variables(self):
+        self.session.variables.clear()
+        assert self.session.missing_variables(['Dev']) == {'@@x@@'}
+        assert_raises(ConfigError, self.session.plan, ['Dev'])
+
+    def test_apply(self):
+        self.write('sessioned fail\nsessioned @@x@@\n', mtime=1000)
+        events = []
+        failures = self.session.apply(observer=events.append)
+        assert SessionPlugin.log == [['1']]
+        assert len(failures) == 1 and failures[0].outcome == 'error'
+        assert [e.__class__ for e in events
+                if isinstance(e, (CommandEnd, CommandFail))] == [
+            CommandFail, CommandEnd]
+
+        del SessionPlugin.log[:]
+        self.session.apply(keep_going=False)
+        assert SessionPlugin.log == []
+
+    def test_other_handlers(self):
+        # Handlers subscribed while a session applies are kept
+        self.write('sessioned 1\n')
+        events = []
+        def observer(event):
+            if not events:
+                bus.subscribe(events.append)
+        try:
+            self.session.apply(observer=observer)
+            assert bus.handlers[-1] == events.append
+        finally:
+            bus.unsubscribe(events.append)
+        # It got the rest of the run's events
+        assert RunEnd in [event.__class__ for event in events]
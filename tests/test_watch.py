@@ -0,0 +1,82 @@
+"""Test detecting which commands need to run again in watch mode.
+"""
+
+from textwrap import dedent
+from wsconfig.parsing import parse_string
+from wsconfig.plugins import Plugin, ApplyError
+from wsconfig.script import validate
+from wsconfig.watch import (
+    reached_commands, changed_commands, completed_commands)
+
+
+class WatchPlugin(Plugin):
+    name = 'watched'
+    def run(self, arguments, state):
+        pass
+
+
+class SourcedPlugin(WatchPlugin):
+    name = 'sourced'
+    def sources(self, arguments):
+        if not arguments:
+            raise ApplyError('sourced needs a file')
+        return [arguments[0]]
+
+
+def parse(text):
+    document = parse_string(dedent(text))
+    validate(document, '', {'watched': WatchPlugin, 'sourced': SourcedPlugin})
+    return document
+
+
+def changed(old, new, tags=None):
+    """Return the argv of the commands in ``new`` that need to run."""
+    documents = [parse(old), parse(new)]
+    ids = changed_commands(reached_commands(documents[0], tags or set()),
+                           reached_commands(documents[1], tags or set()))
+    result = []
+    def collect(items):
+        for item in items:
+            if hasattr(item, 'argv'):
+                if id(item) in ids:
+                    result.append(list(item.args))
+            else:
+                collect(item.items)
+    collect(documents[1])
+    return result
+
+
+class TestChangedCommands(object):
+
+    def test_unchanged(self):
+        assert changed('watched 1\nwatched 2', 'watched 1\nwatched 2') == []
+
+    def test_added_and_modified(self):
+        assert changed('watched 1\nwatched 2',
+                       'watched 1\nwatched 3\nwatched 4') == [['3'], ['4']]
+
+    def test_duplicates(self):
+        assert changed('watched 1', 'watched 1\nwatched 1') == [['1']]
+
+    def test_selector_changed(self):
+        assert changed('foo { watched 1 }', 'foo, bar { watched 1 }',
+                       {'foo'}) == [['1']]
+
+    def test_define(self):
+        # Commands that become reachable need to run
+        assert changed('foo { watched 1 }',
+                       'define foo\nfoo { watched 1 }') == [['1']]
+
+    def test_invalid_sources(self):
+        # Not run, instead of stopping the watch
+        document = parse('sourced\nsourced /nonexistent\nwatched 1')
+        assert sorted(reached_commands(document, set())) == sorted(
+            [id(document[1]), id(document[2])])
+
+    def test_failed(self):
+        document = parse('watched 1\nwatched 2')
+        current = reached_commands(document, set())
+        changed = changed_commands({}, current)
+        # The second command failed, it runs again next time
+        previous = completed_commands(current, changed, set([id(document[0])]))
+        assert changed_commands(previous, current) == set([id(document[1])])
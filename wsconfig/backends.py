@@ -0,0 +1,286 @@
+"""Where plugins make their changes: the file system and external commands.
+
+Plugins do not call ``os`` or ``subprocess`` themselves for the operations
+in a backend, but go through the one in the state of the run (see
+``backend_of``), mostly by way of the ``StatCache``. ``RealBackend`` is
+the machine wsconfig runs on. ``MemoryBackend`` is a file system kept in
+a dict, which runs no commands at all, but records every change and
+command; a document applied to it shows exactly what it would do, and
+takes no time doing it::
+
+    backend = MemoryBackend()
+    backend.add_dir('/home/me')
+    apply_document(document, tags, {'variables': {}, 'backend': backend})
+    assert backend.operations == [('symlink', 'dotfiles/vimrc',
+                                   '/home/me/.vimrc'), ...]
+"""
+
+import os
+from os import path
+import errno
+from StringIO import StringIO
+
+from .fscache import scandir, kind_of, MISSING, FILE, DIR, LINK, OTHER, \
+    UNKNOWN
+from .process import spawn, spawn_background, wait
+
+
+__all__ = ('RealBackend', 'MemoryBackend', 'real')
+
+
+class RealBackend(object):
+    """The local file system, and processes."""
+
+    def lstat_kind(self, filename):
+        """Return the kind of ``filename``, not following symlinks, or
+        ``MISSING``.
+        """
+        try:
+            return kind_of(os.lstat(filename).st_mode)
+        except OSError:
+            return MISSING
+
+    def stat_kind(self, filename):
+        """Return the kind of ``filename``, following symlinks."""
+        try:
+            return kind_of(os.stat(filename).st_mode)
+        except OSError:
+            return MISSING
+
+    def list_kinds(self, directory):
+        """Return a list of (name, kind) tuples for the entries of
+        ``directory``; kinds can be ``UNKNOWN`` where they are not known
+        without another lookup. Raises ``OSError``.
+        """
+        if not scandir:
+            return [(name, UNKNOWN) for name in os.listdir(directory)]
+        entries = []
+        for entry in scandir(directory):
+            if entry.is_symlink():
+                kind = LINK
+            elif entry.is_dir(follow_symlinks=False):
+                kind = DIR
+            elif entry.is_file(follow_symlinks=False):
+                kind = FILE
+            else:
+                kind = OTHER
+            entries.append((entry.name, kind))
+        return entries
+
+    def readlink(self, filename):
+        return os.readlink(filename)
+
+    def makedirs(self, directory):
+        os.makedirs(directory)
+
+    def symlink(self, target, filename):
+        os.symlink(target, filename)
+
+    def unlink(self, filename):
+        os.unlink(filename)
+
+    def read(self, filename):
+        """Return the content of ``filename``. Raises ``IOError``."""
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def append(self, filename, data):
+        """Add ``data`` to the end of ``filename``, creating it if
+        necessary.
+        """
+        with open(filename, 'ab') as f:
+            f.write(data)
+
+    def spawn(self, cmdline, *a, **kw):
+        """Start ``cmdline``, see ``process.spawn``. Pass ``background``
+        for commands started by other threads than the main one.
+        """
+        if kw.pop('background', False):
+            return spawn_background(cmdline, *a, **kw)
+        return spawn(cmdline, *a, **kw)
+
+    def wait(self, process, timeout=None):
+        return wait(process, timeout)
+
+
+real = RealBackend()
+
+
+class MemoryProcess(object):
+    """What ``MemoryBackend.spawn`` returns in place of a ``Popen``."""
+
+    def __init__(self, returncode, output=''):
+        self.pid = None
+        self.returncode = returncode
+        self.stdout = StringIO(output)
+
+
+class MemoryBackend(object):
+    """A file system in memory, in which commands do nothing.
+
+    Changes and commands are recorded in ``operations``, as tuples like
+    ``('symlink', target, filename)`` or ``('run', cmdline)``. The number
+    of lookups is counted in ``lookups``. To have commands fail, or
+    produce output, pass a ``handler``, which is called with the command
+    line and returns the exit code, or a 2-tuple (exit code, output).
+    """
+
+    # How many symlinks are followed before giving up, like ELOOP
+    max_links = 40
+
+    def __init__(self, handler=None):
+        # Absolute path -> (kind, content of files or target of links)
+        self.entries = {'/': (DIR, None)}
+        self.operations = []
+        self.lookups = 0
+        self.handler = handler
+
+    # Setting up the initial content; these are not recorded
+
+    def add_dir(self, directory):
+        directory = path.abspath(directory)
+        while directory not in self.entries:
+            self.entries[directory] = (DIR, None)
+            directory = path.dirname(directory)
+
+    def add_file(self, filename, content=''):
+        filename = path.abspath(filename)
+        self.add_dir(path.dirname(filename))
+        self.entries[filename] = (FILE, content)
+
+    def add_link(self, target, filename):
+        filename = path.abspath(filename)
+        self.add_dir(path.dirname(filename))
+        self.entries[filename] = (LINK, target)
+
+    # Looking up paths
+
+    def resolve(self, filename, follow=True):
+        """Return the path ``filename`` refers to once symlinks in it
+        are followed (not the last one, unless ``follow``), or ``None``
+        if it does not exist.
+        """
+        self.lookups += 1
+        links = 0
+        parts = path.abspath(filename).split(os.sep)[1:]
+        current = '/'
+        while parts:
+            name = parts.pop(0)
+            if not name:
+                continue
+            candidate = path.join(current, name)
+            kind, data = self.entries.get(candidate, (MISSING, None))
+            if kind is LINK and (parts or follow):
+                links += 1
+                if links > self.max_links:
+                    return None
+                target = path.normpath(path.join(current, data))
+                parts = target.split(os.sep)[1:] + parts
+                current = '/'
+                continue
+            if kind is MISSING or (parts and kind is not DIR):
+                return None
+            current = candidate
+        return current
+
+    def entry(self, filename, follow=True):
+        resolved = self.resolve(filename, follow)
+        if resolved is None:
+            return None, (MISSING, None)
+        return resolved, self.entries[resolved]
+
+    def lstat_kind(self, filename):
+        return self.entry(filename, follow=False)[1][0]
+
+    def stat_kind(self, filename):
+        return self.entry(filename)[1][0]
+
+    def list_kinds(self, directory):
+        resolved, (kind, _) = self.entry(directory)
+        if kind is not DIR:
+            raise self.error(errno.ENOTDIR, directory)
+        prefix = resolved.rstrip(os.sep) + os.sep
+        return [(name[len(prefix):], entry[0])
+                for name, entry in self.entries.items()
+                if name.startswith(prefix) and
+                os.sep not in name[len(prefix):] and name != prefix]
+
+    def readlink(self, filename):
+        _, (kind, target) = self.entry(filename, follow=False)
+        if kind is not LINK:
+            raise self.error(errno.EINVAL, filename)
+        return target
+
+    def read(self, filename):
+        _, (kind, content) = self.entry(filename)
+        if kind is not FILE:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), filename)
+        return content
+
+    # Changes
+
+    @staticmethod
+    def error(code, filename):
+        return OSError(code, os.strerror(code), filename)
+
+    def parent(self, filename):
+        """Return the resolved path of ``filename``, such that it can be
+        created in its (existing) parent directory.
+        """
+        directory, kind = self.entry(path.dirname(path.abspath(filename)))
+        if kind[0] is not DIR:
+            raise self.error(errno.ENOENT, filename)
+        return path.join(directory, path.basename(filename))
+
+    def makedirs(self, directory):
+        directory = path.abspath(directory)
+        if self.lstat_kind(directory) is not MISSING:
+            raise self.error(errno.EEXIST, directory)
+        self.operations.append(('makedirs', directory))
+        missing = []
+        while self.lstat_kind(directory) is MISSING:
+            missing.append(directory)
+            directory = path.dirname(directory)
+        for directory in reversed(missing):
+            self.entries[self.parent(directory)] = (DIR, None)
+
+    def symlink(self, target, filename):
+        filename = path.abspath(filename)
+        if self.lstat_kind(filename) is not MISSING:
+            raise self.error(errno.EEXIST, filename)
+        resolved = self.parent(filename)
+        self.operations.append(('symlink', target, filename))
+        self.entries[resolved] = (LINK, target)
+
+    def unlink(self, filename):
+        filename = path.abspath(filename)
+        resolved, (kind, _) = self.entry(filename, follow=False)
+        if kind is MISSING:
+            raise self.error(errno.ENOENT, filename)
+        if kind is DIR:
+            raise self.error(errno.EISDIR, filename)
+        self.operations.append(('unlink', filename))
+        del self.entries[resolved]
+
+    def append(self, filename, data):
+        filename = path.abspath(filename)
+        resolved, (kind, content) = self.entry(filename)
+        if kind is MISSING:
+            try:
+                resolved, content = self.parent(filename), ''
+            except OSError, e:
+                raise IOError(e.errno, e.strerror, filename)
+        elif kind is not FILE:
+            raise IOError(errno.EISDIR, os.strerror(errno.EISDIR), filename)
+        self.operations.append(('append', filename, data))
+        self.entries[resolved] = (FILE, content + data)
+
+    def spawn(self, cmdline, *a, **kw):
+        self.operations.append(('run', cmdline))
+        result = self.handler(cmdline) if self.handler else 0
+        if isinstance(result, tuple):
+            return MemoryProcess(*result)
+        return MemoryProcess(result)
+
+    def wait(self, process, timeout=None):
+        return False
@@ -0,0 +1,60 @@
+"""Check many documents at once, like a CI job does for a repository of
+host configurations.
+
+Each file is parsed, validated and given a first pass in a pool of
+worker processes. The grammar is built before the pool starts, so the
+workers inherit it, and they stay alive for all files, rather than
+paying interpreter startup and grammar construction for every one.
+"""
+
+import multiprocessing
+
+from .plugins import Plugin
+from .script import validate, firstpass
+
+
+__all__ = ('check_file', 'check_files')
+
+
+def check_file(args):
+    """Check one document. Returns a 3-tuple (filename, error, found
+    tags), where ``error`` is ``None`` if the file is fine.
+    """
+    filename, tags = args
+    from .parsing import parse_file
+    try:
+        document = parse_file(filename)
+        validate(document, filename, Plugin.__class__.PLUGINS)
+        found_tags = firstpass(document, tags)
+    except Exception, e:
+        return filename, '%s: %s' % (e.__class__.__name__, e), None
+    return filename, None, found_tags
+
+
+def check_files(filenames, tags, jobs=None):
+    """Check ``filenames``, assuming ``tags`` to be set; yields the result
+    of ``check_file`` for each, in order.
+
+    ``jobs`` is the number of worker processes, by default one per CPU.
+    """
+    # Import the parser before the workers fork, so they do not each
+    # have to build the grammar.
+    from . import parsing
+
+    work = [(filename, tags) for filename in filenames]
+    jobs = min(jobs or multiprocessing.cpu_count(), len(work))
+    if jobs <= 1:
+        for item in work:
+            yield check_file(item)
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap(check_file, work):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -0,0 +1,339 @@
+"""A content-addressed cache for downloaded files.
+
+Files are stored below ``objects/``, named after the sha256 of their content,
+so the same file downloaded from different urls (or by different machines
+sharing a home directory) is only stored once. An index remembers, for each
+url, the object it resolved to, as well as the ``ETag`` and ``Last-Modified``
+headers the server sent, such that subsequent requests can be conditional.
+
+The cache belongs to the user running wsconfig, also for the commands that
+run as root via sudo: the path is that of the invoking user, and the files
+written are given to them.
+"""
+
+import os
+from os import path
+import errno
+import hashlib
+import json
+import tempfile
+import threading
+import time
+import urllib2
+
+
+__all__ = ('cache_dir', 'CacheError', 'DownloadCache', 'ContentManifest')
+
+
+def cache_dir(*parts):
+    """Return the path to a directory within the wsconfig cache, creating
+    it if necessary.
+
+    The location can be changed via the ``WSCONFIG_CACHE`` environment
+    variable; otherwise ``$XDG_CACHE_HOME/wsconfig`` is used. Under sudo,
+    that is the cache of the user who ran sudo.
+    """
+    directory = path.join(cache_base(), *parts)
+    makedirs(directory)
+    return directory
+
+
+def cache_base():
+    """Return the path of the wsconfig cache, see ``cache_dir``."""
+    base = os.environ.get('WSCONFIG_CACHE')
+    if not base:
+        home = '~%s' % os.environ['SUDO_USER'] if sudo_ids() else '~'
+        base = path.join(os.environ.get('XDG_CACHE_HOME') or
+                         path.join(path.expanduser(home), '.cache'),
+                         'wsconfig')
+    return base
+
+
+def sudo_ids():
+    """Return the user and group id of the user who ran sudo, if we run
+    as root via sudo, or ``None``.
+    """
+    if os.getuid() != 0 or not os.environ.get('SUDO_USER') or \
+            'SUDO_UID' not in os.environ:
+        return None
+    return int(os.environ['SUDO_UID']), int(os.environ['SUDO_GID'])
+
+
+def give_to_user(filename):
+    """Give ``filename``, in the cache, to the user who ran sudo, such
+    that they can still change it when not running as root.
+    """
+    ids = sudo_ids()
+    if ids:
+        os.chown(filename, *ids)
+
+
+def makedirs(directory):
+    """Create ``directory`` and its parents, if they do not exist."""
+    if path.isdir(directory):
+        return
+    parent = path.dirname(directory)
+    if parent != directory:
+        makedirs(parent)
+    try:
+        os.mkdir(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    else:
+        give_to_user(directory)
+
+
+def file_sha256(filename):
+    """Return the sha256 hexdigest of a file's content."""
+    hash = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(DownloadCache.block_size), ''):
+            hash.update(block)
+    return hash.hexdigest()
+
+
+class CacheError(Exception):
+    pass
+
+
+class DownloadCache(object):
+    """Download urls into a local cache directory.
+
+    ``max_size`` is the total number of bytes the cached objects may use;
+    once exceeded, the least recently used objects are evicted.
+    """
+
+    block_size = 64 * 1024
+    max_size = 1024 * 1024 * 1024
+
+    # Downloads may run in parallel, from the threads of a ``Prefetcher``;
+    # the index is read and written again by one of them at a time.
+    index_lock = threading.Lock()
+
+    def __init__(self, directory=None, max_size=None):
+        self.directory = directory or cache_dir('downloads')
+        makedirs(self.directory)
+        if max_size is not None:
+            self.max_size = max_size
+        self.index_file = path.join(self.directory, 'index.json')
+
+    def object_path(self, digest):
+        return path.join(self.directory, 'objects', digest[:2], digest)
+
+    def get(self, url, sha256=None):
+        """Return the local path of the content at ``url``.
+
+        If ``sha256`` is given, and an object with that hash is already
+        in the cache, no request is made at all. Otherwise, the download
+        is verified against it.
+        """
+        index = self._load_index()
+        sha256 = sha256.lower() if sha256 else None
+
+        if sha256 and path.exists(self.object_path(sha256)):
+            return self._use(sha256)
+
+        entry = index['urls'].get(url)
+        if entry and not path.exists(self.object_path(entry['sha256'])):
+            entry = None
+
+        request = urllib2.Request(url)
+        if entry:
+            if entry.get('etag'):
+                request.add_header('If-None-Match', entry['etag'])
+            if entry.get('last_modified'):
+                request.add_header('If-Modified-Since', entry['last_modified'])
+
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, e:
+            if e.code == 304 and entry:
+                return self._use(entry['sha256'], sha256)
+            raise CacheError('Failed to fetch %s: HTTP %s' % (url, e.code))
+        except (urllib2.URLError, IOError), e:
+            raise CacheError('Failed to fetch %s: %s' % (url, e))
+
+        try:
+            headers = response.info()
+            etag = headers.getheader('ETag')
+            last_modified = headers.getheader('Last-Modified')
+            # Not every handler supports conditional requests (file:// does
+            # not); if the validators did not change, the content did not.
+            if entry and last_modified and not etag and \
+                    last_modified == entry.get('last_modified') and \
+                    headers.getheader('Content-Length') == \
+                        str(index['objects'][entry['sha256']]['size']):
+                return self._use(entry['sha256'], sha256)
+            digest, size = self._store(response, sha256)
+        finally:
+            response.close()
+
+        # Read the index again, it may have changed during the download
+        with self.index_lock:
+            index = self._load_index()
+            index['urls'][url] = {'sha256': digest, 'etag': etag,
+                                  'last_modified': last_modified}
+            index['objects'][digest] = {'size': size, 'used': time.time()}
+            self._evict(index, keep=digest)
+            self._save_index(index)
+        return self.object_path(digest)
+
+    def _use(self, digest, expected=None):
+        if expected and digest != expected:
+            raise CacheError('Checksum mismatch: expected %s, got %s' % (
+                expected, digest))
+        with self.index_lock:
+            index = self._load_index()
+            if digest not in index['objects']:
+                index['objects'][digest] = {
+                    'size': path.getsize(self.object_path(digest))}
+            index['objects'][digest]['used'] = time.time()
+            self._save_index(index)
+        return self.object_path(digest)
+
+    def _store(self, response, expected=None):
+        """Stream ``response`` into a temporary file, then move it to its
+        content-addressed location.
+        """
+        hash = hashlib.sha256()
+        size = 0
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.fetch-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: response.read(self.block_size), ''):
+                    hash.update(block)
+                    size += len(block)
+                    f.write(block)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = hash.hexdigest()
+            if expected and digest != expected:
+                raise CacheError('Checksum mismatch: expected %s, got %s' % (
+                    expected, digest))
+            target = self.object_path(digest)
+            makedirs(path.dirname(target))
+            give_to_user(tmpname)
+            os.rename(tmpname, target)
+        except:
+            if path.exists(tmpname):
+                os.unlink(tmpname)
+            raise
+        return digest, size
+
+    def _evict(self, index, keep=None):
+        """Remove the least recently used objects until the cache fits
+        into ``max_size``.
+        """
+        objects = index['objects']
+        total = sum(o['size'] for o in objects.values())
+        for digest in sorted(objects, key=lambda d: objects[d].get('used', 0)):
+            if total <= self.max_size:
+                break
+            if digest == keep:
+                continue
+            try:
+                os.unlink(self.object_path(digest))
+            except OSError:
+                pass
+            total -= objects.pop(digest)['size']
+        for url, entry in index['urls'].items():
+            if entry['sha256'] not in objects:
+                del index['urls'][url]
+
+    def _load_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'urls': {}, 'objects': {}}
+
+    def _save_index(self, index):
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.index-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f)
+        give_to_user(tmpname)
+        os.rename(tmpname, self.index_file)
+
+
+class ContentManifest(object):
+    """Remembers the sha256 of files wsconfig wrote (or hashed), along with
+    their size and modification time.
+
+    To check whether a file still has the content we want to write, the
+    manifest is asked first; only if the file was changed since (or was
+    not written by us), it is read, in blocks, and compared with the
+    content directly, stopping at the first difference.
+    """
+
+    block_size = DownloadCache.block_size
+
+    def __init__(self, filename=None):
+        self.filename = filename or path.join(cache_dir(), 'manifest.json')
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def matches(self, filename, content):
+        """Return ``True`` if ``filename`` exists with ``content``."""
+        filename = path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if st.st_size != len(content):
+            return False
+        entry = self.entries.get(filename)
+        if entry and entry[:2] == [st.st_size, st.st_mtime]:
+            return entry[2] == hashlib.sha256(content).hexdigest()
+
+        try:
+            with open(filename, 'rb') as f:
+                for offset in xrange(0, len(content), self.block_size):
+                    if f.read(self.block_size) != \
+                            content[offset:offset + self.block_size]:
+                        return False
+        except IOError:
+            return False
+        self.record(filename, content)
+        return True
+
+    def digest(self, filename):
+        """Return the sha256 of ``filename``, which is only read if it
+        changed since it was last hashed. Call ``save`` when done.
+        """
+        filename = path.abspath(filename)
+        st = os.stat(filename)
+        entry = self.entries.get(filename)
+        if entry and entry[:2] == [st.st_size, st.st_mtime]:
+            return entry[2]
+        digest = file_sha256(filename)
+        self.entries[filename] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    def remember(self, filename, digest):
+        """``filename`` has content with the sha256 ``digest``. Call
+        ``save`` when done.
+        """
+        filename = path.abspath(filename)
+        try:
+            st = os.stat(filename)
+        except OSError:
+            self.entries.pop(filename, None)
+        else:
+            self.entries[filename] = [st.st_size, st.st_mtime, digest]
+
+    def record(self, filename, content):
+        """``filename`` now has ``content``."""
+        self.remember(filename, hashlib.sha256(content).hexdigest())
+        self.save()
+
+    def save(self):
+        fd, tmpname = tempfile.mkstemp(dir=path.dirname(self.filename),
+                                       prefix='.manifest-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f)
+        give_to_user(tmpname)
+        os.rename(tmpname, self.filename)
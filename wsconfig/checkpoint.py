@@ -0,0 +1,90 @@
+"""Remember which commands of an apply run completed, so an interrupted
+run can be resumed.
+
+The log is a text file with the position of one completed command per
+line. Its first line identifies the document, and the tags and variables
+the run used; a log written for a different document, or with different
+tags or variables, is discarded.
+Writes are only fsync'ed every couple of commands or seconds, so keeping
+the log costs next to nothing. At worst, a crash means that the last few
+commands run once more, which they need to support anyway.
+"""
+
+import os
+from os import path
+import hashlib
+import time
+
+from .cache import cache_dir
+
+
+__all__ = ('Checkpoint',)
+
+
+class Checkpoint(object):
+
+    sync_every = 20
+    sync_interval = 2.0
+
+    def __init__(self, filename, identity, resume=False):
+        self.filename = filename
+        self.identity = identity
+        self.completed = set()
+        if resume:
+            self.completed = self._read()
+        self.file = open(filename, 'w')
+        self.file.write('%s\n' % identity)
+        for position in sorted(self.completed):
+            self.file.write('%d\n' % position)
+        self.sync()
+
+    @classmethod
+    def for_document(cls, filename, source, tags, variables=None,
+                     resume=False):
+        """Return the checkpoint for applying ``filename`` (whose content
+        is ``source``) with ``tags``, and the ``variables`` the commands
+        are expanded with.
+        """
+        # The empty string separates the tags from the variables
+        identity = hashlib.sha256('\0'.join(
+            [source] + sorted(tags) + [''] +
+            sorted('%s=%s' % item for item in (variables or {}).items())
+        )).hexdigest()
+        name = hashlib.sha1(path.abspath(filename)).hexdigest()
+        return cls(path.join(cache_dir('checkpoints'), name), identity, resume)
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return set()
+        if lines[0] != self.identity:
+            return set()
+        # The last line may have been written partially.
+        return set(int(line) for line in lines[1:-1] if line.isdigit())
+
+    def done(self, position):
+        """Record the command at ``position`` as completed."""
+        self.completed.add(position)
+        self.file.write('%d\n' % position)
+        self.pending += 1
+        if self.pending >= self.sync_every or \
+                time.time() - self.last_sync >= self.sync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        if not self.file.closed:
+            self.sync()
+            self.file.close()
+
+    def finish(self):
+        """The run completed, the log is no longer needed."""
+        self.close()
+        os.unlink(self.filename)
@@ -0,0 +1,203 @@
+"""Report what is happening during a run.
+
+Code that has something to report emits an event on ``bus``; handlers
+subscribed to the bus decide how to present it. By default, that is the
+``HumanRenderer``, which prints what wsconfig always printed. For
+machines, the ``JsonlWriter`` writes one JSON object per event.
+
+Events are small slotted objects; emitting one costs a function call per
+handler, so there is no need to be stingy with them.
+"""
+
+import sys
+import json
+import time
+import atexit
+
+
+__all__ = ('bus', 'EventBus', 'HumanRenderer', 'JsonlWriter',
+           'Message', 'Log', 'RunStart', 'RunEnd', 'CommandStart',
+           'CommandEnd', 'CommandSkip', 'CommandFail', 'Progress',
+           'FileUpdate',
+           'Reminders')
+
+
+class Event(object):
+    __slots__ = ('time',)
+    def __init__(self, *args):
+        self.time = time.time()
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+    def fields(self):
+        result = {'time': self.time}
+        for name in self.__slots__:
+            result[name] = getattr(self, name)
+        return result
+
+class Message(Event):
+    """Informational output of wsconfig itself."""
+    __slots__ = ('text',)
+
+class Log(Event):
+    """A plugin says what it is doing."""
+    __slots__ = ('text',)
+
+class RunStart(Event):
+    __slots__ = ('commands',)
+
+class RunEnd(Event):
+    __slots__ = ('duration', 'failed')
+
+class CommandStart(Event):
+    __slots__ = ('position', 'command', 'args')
+
+class CommandEnd(Event):
+    __slots__ = ('position', 'command', 'args', 'duration')
+
+class CommandSkip(Event):
+    """A command did not run. ``reason`` is ``dry-run``, ``completed``
+    (in a previous, resumed run) or ``filtered``, or explains why a
+    guard skipped the command.
+    """
+    __slots__ = ('position', 'command', 'args', 'duration', 'reason')
+
+class CommandFail(Event):
+    """``outcome`` says how the command failed, usually ``error``."""
+    __slots__ = ('position', 'command', 'args', 'duration', 'error',
+                 'outcome')
+
+class Progress(Event):
+    """``done`` of ``total`` commands ran; the rest is estimated to take
+    ``remaining`` seconds, if known.
+    """
+    __slots__ = ('done', 'total', 'remaining')
+
+class FileUpdate(Event):
+    """A command made sure ``filename`` has the right content; ``changed``
+    says whether it had to write it.
+    """
+    __slots__ = ('filename', 'changed')
+
+class Reminders(Event):
+    __slots__ = ('reminders',)
+
+
+class EventBus(object):
+
+    def __init__(self, *handlers):
+        self.handlers = list(handlers)
+
+    def subscribe(self, handler):
+        self.handlers.append(handler)
+
+    def unsubscribe(self, handler):
+        self.handlers.remove(handler)
+
+    def emit(self, event):
+        for handler in self.handlers:
+            handler(event)
+
+    def flush(self):
+        """Make sure buffered events are written, for example before
+        the user is asked something.
+        """
+        for handler in self.handlers:
+            if hasattr(handler, 'flush'):
+                handler.flush()
+
+
+class HumanRenderer(object):
+    """Print events for a human to read."""
+
+    # Skips that are not worth mentioning
+    quiet_skips = ('completed', 'filtered')
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def __call__(self, event):
+        handler = getattr(self, 'on_%s' % event.__class__.__name__, None)
+        if handler:
+            stream = self.stream or sys.stdout
+            handler(event, stream)
+            stream.flush()
+
+    def on_Message(self, event, stream):
+        stream.write('%s\n' % event.text)
+
+    def on_Log(self, event, stream):
+        stream.write('\n====> %s\n' % event.text)
+
+    def on_CommandSkip(self, event, stream):
+        if event.reason == 'dry-run':
+            stream.write('%s\n' % event.command)
+        elif event.reason not in self.quiet_skips:
+            stream.write('Skipping %s: %s\n' % (event.command, event.reason))
+
+    def on_CommandFail(self, event, stream):
+        stream.write('%s\n' % event.error)
+
+    def on_Progress(self, event, stream):
+        if event.remaining is None:
+            stream.write('\n[%d/%d]' % (event.done + 1, event.total))
+        else:
+            minutes, seconds = divmod(int(event.remaining + 0.5), 60)
+            stream.write('\n[%d/%d, about %s left]' % (
+                event.done + 1, event.total,
+                '%dm %02ds' % (minutes, seconds) if minutes
+                else '%ds' % seconds))
+
+    def on_FileUpdate(self, event, stream):
+        if not event.changed:
+            stream.write('%s is up to date\n' % event.filename)
+
+    def on_Reminders(self, event, stream):
+        stream.write('\nATTENTION! Do not forget to: \n')
+        for reminder in event.reminders:
+            stream.write(' * %s\n' % reminder)
+        stream.write('\n')
+
+
+def decoded(value):
+    """Return ``value`` with its byte strings decoded as UTF-8. Output
+    and file names need not be UTF-8; what is not is replaced.
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, (list, tuple)):
+        return [decoded(item) for item in value]
+    if isinstance(value, dict):
+        return dict((decoded(k), decoded(v)) for k, v in value.items())
+    return value
+
+
+class JsonlWriter(object):
+    """Write events as JSON lines, in batches."""
+
+    buffer_size = 64
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = []
+        atexit.register(self.flush)
+
+    def __call__(self, event):
+        data = event.fields()
+        data['event'] = event.__class__.__name__
+        if 'command' in data:
+            data['command'] = list(data['command'].argv)
+        if 'error' in data:
+            data['error'] = '%s' % data['error']
+        self.buffer.append(json.dumps(decoded(data)))
+        if len(self.buffer) >= self.buffer_size or \
+                isinstance(event, (CommandFail, RunEnd)):
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write('\n'.join(self.buffer) + '\n')
+            self.stream.flush()
+            del self.buffer[:]
+
+
+bus = EventBus(HumanRenderer())
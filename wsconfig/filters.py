@@ -0,0 +1,110 @@
+"""Apply only some of the commands of a document.
+
+``validate`` builds a ``CommandIndex`` of all the commands in a document,
+by plugin name and by line, whether their selectors match or not. From
+that, the commands an ``apply --only``, ``--skip`` or ``--lines`` should
+run are looked up directly, rather than by testing every command of the
+document against the filters.
+
+Filtered commands are skipped, but the document is still traversed as a
+whole, so the tags that ``define`` commands set apply as usual.
+"""
+
+from bisect import bisect_left, bisect_right
+
+
+__all__ = ('CommandIndex', 'FilterError', 'parse_names', 'parse_lines')
+
+
+class FilterError(ValueError):
+    pass
+
+
+class CommandIndex(object):
+
+    def __init__(self, commands=()):
+        # Plugin name -> commands
+        self.by_plugin = {}
+        # Sorted line numbers, and the command on each
+        self.lines = []
+        self.by_line = []
+        self.unsorted = False
+        self.all = []
+        for command in commands:
+            self.add(command)
+
+    def add(self, command):
+        self.all.append(command)
+        self.by_plugin.setdefault(command.command, []).append(command)
+        if getattr(command, 'lineno', None) is not None:
+            if self.lines and command.lineno < self.lines[-1]:
+                self.unsorted = True
+            self.lines.append(command.lineno)
+            self.by_line.append(command)
+
+    def in_lines(self, first, last):
+        """Return the commands that start within the lines ``first`` to
+        ``last`` (inclusive; either may be ``None`` for no limit).
+        """
+        if self.unsorted:
+            order = sorted(range(len(self.lines)), key=self.lines.__getitem__)
+            self.lines = [self.lines[i] for i in order]
+            self.by_line = [self.by_line[i] for i in order]
+            self.unsorted = False
+        start = 0 if first is None else bisect_left(self.lines, first)
+        end = len(self.lines) if last is None \
+            else bisect_right(self.lines, last)
+        return self.by_line[start:end]
+
+    def select(self, only=None, skip=None, lines=None):
+        """Return the ids (as in ``id()``) of the commands that pass the
+        filters: those of a plugin in ``only``, not of a plugin in
+        ``skip``, within one of the (first, last) ranges of ``lines``.
+        Filters that are ``None`` let all commands pass.
+
+        Raises ``FilterError`` if ``lines`` is given but the line numbers
+        of the commands are not known, like for those of a plan.
+        """
+        if lines is not None and self.all and not self.lines:
+            raise FilterError('The line numbers of the commands are not '
+                              'known')
+        if only is not None:
+            selected = set(id(command) for name in only
+                           for command in self.by_plugin.get(name, ()))
+        else:
+            selected = set(map(id, self.all))
+        if lines is not None:
+            selected &= set(id(command) for first, last in lines
+                            for command in self.in_lines(first, last))
+        if skip is not None:
+            selected -= set(id(command) for name in skip
+                            for command in self.by_plugin.get(name, ()))
+        return selected
+
+
+def parse_names(value):
+    """Parse a comma separated list of plugin names."""
+    names = [name.strip() for name in value.split(',') if name.strip()]
+    if not names:
+        raise FilterError('No plugin names given')
+    return names
+
+
+def parse_lines(value):
+    """Parse a comma separated list of line ranges, like ``100-200``,
+    ``-50``, ``300-`` or ``42``, into (first, last) tuples.
+    """
+    ranges = []
+    for part in value.split(','):
+        first, dash, last = part.strip().partition('-')
+        try:
+            first = int(first) if first else None
+            last = int(last) if last else None
+        except ValueError:
+            raise FilterError('Invalid line range: %s' % part)
+        if not dash:
+            if first is None:
+                raise FilterError('Invalid line range: %s' % part)
+            last = first
+        ranges.append((first, last))
+    return ranges
@@ -0,0 +1,194 @@
+"""A cache of file system metadata, kept for the duration of a run.
+
+Commands like ``link`` and ``mkdir`` check the state of the file system
+before they change it. A config file with hundreds of links into the
+same few directories would otherwise ``lstat()`` the same paths over and
+over, which is slow on network file systems in particular.
+
+Once a couple of paths within the same directory have been looked up,
+the whole directory is listed in one go, after which lookups of entries
+in that directory, including those that do not exist, are answered from
+memory. Plugins must make their changes through the cache (or call
+``invalidate``), so that it does not go stale.
+
+The cache does not touch the file system itself, but goes through a
+backend (see ``wsconfig.backends``), by default the real one.
+"""
+
+import os
+from os import path
+import stat
+
+
+__all__ = ('StatCache',)
+
+
+try:
+    scandir = os.scandir
+except AttributeError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+# The kinds of entries we distinguish
+MISSING, FILE, DIR, LINK, OTHER = None, 'file', 'dir', 'link', 'other'
+# Exists, but we do not know the kind yet
+UNKNOWN = 'unknown'
+
+
+def kind_of(mode):
+    if stat.S_ISLNK(mode):
+        return LINK
+    if stat.S_ISDIR(mode):
+        return DIR
+    if stat.S_ISREG(mode):
+        return FILE
+    return OTHER
+
+
+class StatCache(object):
+
+    # Number of lookups in a directory after which it is listed as a whole.
+    prefetch_threshold = 3
+
+    def __init__(self, backend=None):
+        if backend is None:
+            from .backends import real as backend
+        self.backend = backend
+        # path -> kind, as ``lstat()`` sees it
+        self.kinds = {}
+        # symlink path -> link target
+        self.links = {}
+        # symlink path -> kind of the final target, following links
+        self.targets = {}
+        # directory -> number of lookups in it
+        self.lookups = {}
+        # directories of which all entries are in ``kinds``
+        self.listed = set()
+
+    def kind(self, filename):
+        """Return the kind of ``filename``, not following symlinks."""
+        filename = path.abspath(filename)
+        kind = self.kinds.get(filename, UNKNOWN)
+        if kind is not UNKNOWN:
+            return kind
+
+        directory = path.dirname(filename)
+        if filename not in self.kinds:
+            if directory in self.listed:
+                return MISSING
+            self.lookups[directory] = self.lookups.get(directory, 0) + 1
+            if self.lookups[directory] >= self.prefetch_threshold and \
+                    self.prefetch(directory):
+                return self.kind(filename)
+
+        kind = self.backend.lstat_kind(filename)
+        self.kinds[filename] = kind
+        return kind
+
+    def prefetch(self, directory):
+        """List ``directory``, and remember the kind of all entries.
+
+        Returns ``False`` if the directory could not be listed.
+        """
+        try:
+            # Kinds may be UNKNOWN, if the backend cannot tell cheaply
+            for name, kind in self.backend.list_kinds(directory):
+                self.kinds.setdefault(path.join(directory, name), kind)
+        except OSError:
+            return False
+        self.listed.add(directory)
+        return True
+
+    def readlink(self, filename):
+        filename = path.abspath(filename)
+        if filename not in self.links:
+            self.links[filename] = self.backend.readlink(filename)
+        return self.links[filename]
+
+    def target_kind(self, filename):
+        """Return the kind of ``filename``, following symlinks."""
+        kind = self.kind(filename)
+        if kind is not LINK:
+            return kind
+        filename = path.abspath(filename)
+        if filename not in self.targets:
+            self.targets[filename] = self.backend.stat_kind(filename)
+        return self.targets[filename]
+
+    def exists(self, filename):
+        return self.target_kind(filename) is not MISSING
+
+    def lexists(self, filename):
+        return self.kind(filename) is not MISSING
+
+    def islink(self, filename):
+        return self.kind(filename) is LINK
+
+    def isdir(self, filename):
+        return self.target_kind(filename) is DIR
+
+    def invalidate(self, filename):
+        """Forget everything about ``filename`` and anything below it."""
+        filename = path.abspath(filename)
+        self._forget(filename)
+        self.listed.discard(path.dirname(filename))
+
+    def _forget(self, filename):
+        if self.kinds.pop(filename, MISSING) is DIR:
+            prefix = filename + os.sep
+            for key in self.kinds.keys():
+                if key.startswith(prefix):
+                    del self.kinds[key]
+            self.listed = set(d for d in self.listed
+                              if d != filename and not d.startswith(prefix))
+        self.links.pop(filename, None)
+        # Links elsewhere might point to or into the path
+        self.targets.clear()
+
+    def _changed(self, filename, kind):
+        """We know what ``filename`` is now, since we just changed it."""
+        self._forget(filename)
+        self.kinds[filename] = kind
+
+    def clear(self):
+        """Forget everything, for when changes were made elsewhere."""
+        self.__init__(self.backend)
+
+    # Changing the file system
+
+    def makedirs(self, directory):
+        directory = path.abspath(directory)
+        created = []
+        parent = directory
+        while not self.lexists(parent):
+            created.append(parent)
+            parent = path.dirname(parent)
+        try:
+            self.backend.makedirs(directory)
+        except OSError:
+            map(self.invalidate, created)
+            raise
+        for filename in created:
+            self._changed(filename, DIR)
+
+    def symlink(self, target, filename):
+        filename = path.abspath(filename)
+        try:
+            self.backend.symlink(target, filename)
+        except OSError:
+            self.invalidate(filename)
+            raise
+        self._changed(filename, LINK)
+        self.links[filename] = target
+
+    def unlink(self, filename):
+        filename = path.abspath(filename)
+        try:
+            self.backend.unlink(filename)
+        except OSError:
+            self.invalidate(filename)
+            raise
+        self._changed(filename, MISSING)
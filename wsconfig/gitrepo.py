@@ -0,0 +1,174 @@
+"""Look at the state of a git repository without running git.
+
+Forking ``git rev-parse`` for every repository of a run, only to find out
+that it is already at the right commit, takes longer than reading the
+few files that tell: ``.git/HEAD``, the loose refs and ``packed-refs``.
+The ``git`` command does that, and only runs git for repositories which
+need to be cloned or fetched.
+
+Tags are peeled to the commit they point to where that is known without
+unpacking objects: from the peeled lines of ``packed-refs``, or from loose
+tag objects. Where it is not, the id of the tag itself is used; for an
+annotated tag, that does not match any commit, so it is fetched again.
+"""
+
+from os import path
+import re
+import zlib
+
+
+__all__ = ('find_git_dir', 'read_ref', 'read_head', 'tag_commit',
+           'read_fetch_head', 'is_sha', 'is_short_sha')
+
+
+sha_re = re.compile(r'^[0-9a-f]{40}$')
+# As ``git log --oneline`` abbreviates them
+short_sha_re = re.compile(r'^[0-9a-f]{7,39}$')
+
+
+def is_sha(ref):
+    """Return whether ``ref`` is a full commit id."""
+    return bool(ref and sha_re.match(ref))
+
+
+def is_short_sha(ref):
+    """Return whether ``ref`` looks like an abbreviated commit id."""
+    return bool(ref and short_sha_re.match(ref))
+
+
+def read_file(filename):
+    try:
+        with open(filename) as f:
+            return f.read()
+    except IOError:
+        return None
+
+
+def find_git_dir(worktree):
+    """Return the git directory of the work tree ``worktree``, or
+    ``None`` if it is not a git repository.
+    """
+    dotgit = path.join(worktree, '.git')
+    if path.isdir(dotgit):
+        return dotgit
+    # A "gitdir: PATH" file, as in submodules and linked work trees
+    content = read_file(dotgit)
+    if content and content.startswith('gitdir:'):
+        return path.join(worktree, content[len('gitdir:'):].strip())
+    return None
+
+
+def common_dir(gitdir):
+    """Return the directory that has the refs of ``gitdir``, which for a
+    linked work tree is that of the main one.
+    """
+    content = read_file(path.join(gitdir, 'commondir'))
+    if content:
+        return path.normpath(path.join(gitdir, content.strip()))
+    return gitdir
+
+
+def packed_refs(gitdir):
+    """Return a dict of ref name -> (id, peeled id or ``None``)."""
+    refs = {}
+    last = None
+    content = read_file(path.join(common_dir(gitdir), 'packed-refs')) or ''
+    for line in content.splitlines():
+        if line.startswith('#') or not line.strip():
+            continue
+        if line.startswith('^'):
+            if last is not None:
+                refs[last] = (refs[last][0], line[1:].strip())
+            continue
+        sha, _, name = line.partition(' ')
+        refs[name.strip()] = (sha, None)
+        last = name.strip()
+    return refs
+
+
+def read_ref(gitdir, name, depth=5):
+    """Return the id ``name`` (``HEAD``, ``refs/heads/master``) points
+    to, following symbolic refs, or ``None`` if it does not exist.
+    """
+    if depth < 0:
+        return None
+    if name == 'HEAD' or not name.startswith('refs/'):
+        directory = gitdir
+    else:
+        directory = common_dir(gitdir)
+    content = read_file(path.join(directory, name))
+    if content is None:
+        return packed_refs(gitdir).get(name, (None, None))[0]
+    content = content.strip()
+    if content.startswith('ref:'):
+        return read_ref(gitdir, content[len('ref:'):].strip(), depth - 1)
+    return content if is_sha(content) else None
+
+
+def read_head(gitdir):
+    """Return the branch checked out in ``gitdir`` (``None`` if HEAD is
+    detached), and the id of the commit HEAD is at (``None`` if there is
+    none yet).
+    """
+    content = (read_file(path.join(gitdir, 'HEAD')) or '').strip()
+    branch = None
+    if content.startswith('ref: refs/heads/'):
+        branch = content[len('ref: refs/heads/'):]
+    return branch, read_ref(gitdir, 'HEAD')
+
+
+def read_loose_object(gitdir, sha):
+    """Return the type and data of the loose object ``sha``, or ``None``
+    if it is packed (or missing).
+    """
+    filename = path.join(common_dir(gitdir), 'objects', sha[:2], sha[2:])
+    try:
+        with open(filename, 'rb') as f:
+            data = zlib.decompress(f.read())
+    except (IOError, zlib.error):
+        return None
+    header, _, body = data.partition('\0')
+    return header.split(' ')[0], body
+
+
+def tag_commit(gitdir, name):
+    """Return the commit the tag ``name`` points to, as far as it is known
+    without unpacking objects, or ``None`` if the tag does not exist.
+    """
+    ref = 'refs/tags/%s' % name
+    packed = packed_refs(gitdir).get(ref)
+    if packed and packed[1]:
+        return packed[1]
+    sha = read_ref(gitdir, ref)
+    # Annotated tags point to a tag object, which points to the commit
+    for i in range(5):
+        if sha is None:
+            return None
+        loose = read_loose_object(gitdir, sha)
+        if loose is None:
+            # Packed: a commit, or a tag we cannot peel here
+            return sha
+        kind, body = loose
+        if kind != 'tag':
+            return sha
+        match = re.match(r'object ([0-9a-f]{40})', body)
+        sha = match.group(1) if match else None
+    return None
+
+
+def read_fetch_head(gitdir):
+    """Return what the last ``git fetch`` of a single ref got: the id,
+    and whether it is a ``branch`` or a ``tag`` (or ``''`` if neither,
+    like for ``HEAD``). Returns ``None`` if there is no ``FETCH_HEAD``.
+    """
+    content = read_file(path.join(gitdir, 'FETCH_HEAD'))
+    if not content:
+        return None
+    for line in content.splitlines():
+        fields = line.split('\t')
+        if len(fields) < 3 or fields[1] == 'not-for-merge':
+            continue
+        description = fields[2]
+        kind = description.split(' ', 1)[0]
+        return fields[0], kind if kind in ('branch', 'tag') else ''
+    return None
@@ -0,0 +1,72 @@
+"""Guards make a command run only if it has something to do.
+
+A guard is written on the line before the command it guards::
+
+    creates ~/bin/tool
+    unless "tool --version | grep -q 2.0"
+    $: make install PREFIX=~
+
+``creates PATH`` skips the command if the path exists, ``unless PROBE``
+if the shell command PROBE succeeds. ``validate`` attaches guards to the
+``guards`` of the command that follows them; when traversing a document,
+guards are not commands of their own.
+
+Probes are meant to be side-effect free checks, so they also run during a
+dry run. Within a run, every probe runs only once: commands that share a
+probe share its result.
+"""
+
+import os
+from os import path
+
+from .plugins import stat_cache, backend_of
+
+
+__all__ = ('GUARDS', 'check_guards')
+
+
+GUARDS = ('creates', 'unless')
+
+
+def check_guard(guard, args, basedir, state, timeout=None):
+    """Return why ``guard`` (a command node) skips its command, or
+    ``None`` if it does not.
+    """
+    if guard.argv[0] == 'creates':
+        filename = path.join(basedir, path.expanduser(args[0]))
+        if stat_cache(state).exists(filename):
+            return '%s exists' % filename
+        return None
+
+    probe = ' '.join(args)
+    probes = state.setdefault('probes', {})
+    key = (basedir, probe)
+    if key not in probes:
+        backend = backend_of(state)
+        with open(os.devnull, 'r+') as devnull:
+            try:
+                process = backend.spawn(
+                    probe, shell=True, cwd=basedir, stdin=devnull,
+                    stdout=devnull, stderr=devnull)
+            except OSError:
+                probes[key] = False
+            else:
+                timed_out = backend.wait(process, timeout)
+                probes[key] = not timed_out and process.returncode == 0
+    if probes[key]:
+        return '"%s" succeeds' % probe
+    return None
+
+
+def check_guards(command, state, resolve):
+    """Return why the guards of ``command`` skip it, or ``None`` if the
+    command should run. ``resolve`` replaces the variables in arguments.
+    Probes are killed after the ``timeout`` of the command in ``state``.
+    """
+    for guard in getattr(command, 'guards', ()):
+        reason = check_guard(guard, resolve(guard.args),
+                             command.plugin.basedir, state,
+                             state.get('timeout'))
+        if reason:
+            return reason
+    return None
@@ -0,0 +1,124 @@
+"""Remember how long commands took, and whether they failed, across runs.
+
+The history is a SQLite database in the wsconfig cache. Commands are
+identified by the document, their position in it, the plugin and the
+arguments (before variables are replaced, so that values like passwords
+are not stored). If a command moved, or the document was renamed, the
+runs of commands with the same plugin and arguments elsewhere are used.
+
+This gives an estimate of how long a run will take, and shows which
+commands are the slow ones.
+"""
+
+import json
+from os import path
+import sqlite3
+import time
+
+from .cache import cache_dir
+
+
+__all__ = ('History',)
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    document TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    plugin TEXT NOT NULL,
+    args TEXT NOT NULL,
+    started REAL NOT NULL,
+    duration REAL NOT NULL,
+    outcome TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_command ON runs (plugin, args);
+'''
+
+
+class History(object):
+
+    # Number of recent successful runs an estimate is based on
+    sample_size = 5
+
+    def __init__(self, document=None, filename=None):
+        """Open the history; ``document`` is the (absolute) filename of
+        the document whose commands are estimated and recorded.
+        """
+        self.document = document
+        self.filename = filename or path.join(cache_dir(), 'history.sqlite')
+        self.db = sqlite3.connect(self.filename, timeout=10)
+        self.db.executescript(SCHEMA)
+
+    @staticmethod
+    def key(command):
+        return command.command, json.dumps(list(command.args))
+
+    def estimate(self, position, command):
+        """Return how long ``command``, at ``position`` in the document,
+        is expected to take, in seconds, or ``None`` if it never ran.
+        """
+        return self.estimates([(position, command)])[0]
+
+    def estimates(self, planned):
+        """Return the estimates for a list of (position, command) tuples.
+        The runs of all of them are read with a single query.
+        """
+        keys = [self.key(command) for _, command in planned]
+        wanted = set(keys)
+        plugins = sorted(set(plugin for plugin, _ in keys))
+        # The recent durations of each command at its position, and
+        # anywhere, newest first
+        here, anywhere = {}, {}
+        rows = self.db.execute(
+            'SELECT document, position, plugin, args, duration FROM runs '
+            "WHERE outcome = 'ok' AND plugin IN (%s) ORDER BY started DESC"
+            % ', '.join('?' * len(plugins)), plugins) if plugins else []
+        for document, position, plugin, args, duration in rows:
+            if (plugin, args) not in wanted:
+                continue
+            samples = [anywhere.setdefault((plugin, args), [])]
+            if document == self.document:
+                samples.append(here.setdefault((position, plugin, args), []))
+            for durations in samples:
+                if len(durations) < self.sample_size:
+                    durations.append(duration)
+        result = []
+        for (position, _), key in zip(planned, keys):
+            durations = here.get((position,) + key) or anywhere.get(key)
+            result.append(sum(durations) / len(durations)
+                          if durations else None)
+        return result
+
+    def record(self, position, command, duration, outcome):
+        """Add a run of ``command``; ``outcome`` is ``ok``, or says how it
+        failed. Call ``commit`` to save.
+        """
+        plugin, args = self.key(command)
+        self.db.execute(
+            'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (self.document, position, plugin, args, time.time(), duration,
+             outcome))
+
+    def commit(self):
+        self.db.commit()
+
+    def slowest(self, limit=10):
+        """Return the commands that take the longest on average, as
+        (plugin, args, average duration, number of runs) tuples.
+        """
+        return [(plugin, json.loads(args), duration, runs) for
+                plugin, args, duration, runs in self.db.execute(
+                    'SELECT plugin, args, avg(duration), count(*) FROM runs '
+                    "WHERE outcome = 'ok' GROUP BY plugin, args "
+                    'ORDER BY avg(duration) DESC LIMIT ?', (limit,))]
+
+    def failing(self, limit=10):
+        """Return the commands that failed most often, as (plugin, args,
+        failures, number of runs) tuples.
+        """
+        return [(plugin, json.loads(args), failures, runs) for
+                plugin, args, failures, runs in self.db.execute(
+                    "SELECT plugin, args, sum(outcome != 'ok') AS failures, "
+                    'count(*) FROM runs GROUP BY plugin, args '
+                    'HAVING failures > 0 ORDER BY failures DESC, '
+                    'count(*) ASC LIMIT ?', (limit,))]
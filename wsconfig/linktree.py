@@ -0,0 +1,243 @@
+"""Link a tree of files into place with as few symlinks as possible, like
+GNU Stow does.
+
+Where an entry of the source tree does not exist in the destination, one
+link to it is created, even if it is a whole directory ("folding"). Only
+where the destination directory already exists are its entries linked
+one by one. If the destination is a link to a directory of another tree
+linked by ``linktree``, it is replaced by a real directory with links to
+the entries of the other one, so that both trees can be linked into it
+("unfolding"). Links to anywhere else were not made by us, and are left
+alone as conflicts.
+
+All the changes are worked out first, and only made if there are no
+conflicts (files in the destination which are not links into the
+source), so a conflict does not leave a tree half linked.
+
+The links created are recorded in a ``LinkManifest``, along with the
+modification times of the source directories that were listed. If
+neither changed since, the next run only reads the links back. Links
+that were created before but are no longer needed, because their
+source was removed, are removed as well.
+"""
+
+import os
+from os import path
+import json
+import tempfile
+
+from .cache import cache_dir
+from .fscache import StatCache, MISSING, DIR, LINK
+
+
+__all__ = ('LinkManifest', 'LinkConflict', 'link_tree')
+
+
+class LinkConflict(Exception):
+    pass
+
+
+class LinkManifest(object):
+    """Remembers the links ``link_tree`` created, per destination and
+    source.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename or path.join(cache_dir(), 'linktree.json')
+        try:
+            with open(self.filename) as f:
+                self.entries = json.load(f)
+        except (IOError, ValueError):
+            self.entries = {}
+
+    def get(self, src, dst):
+        return self.entries.get(dst, {}).get(src, {'links': {}, 'dirs': {}})
+
+    def is_current(self, src, dst):
+        """Return ``True`` if the links for ``dst`` were created from
+        ``src``, and neither the links nor the source directories changed
+        since.
+        """
+        entry = self.entries.get(dst, {}).get(src)
+        if not entry:
+            return False
+        try:
+            for directory, mtime in entry['dirs'].items():
+                if os.stat(directory).st_mtime != mtime:
+                    return False
+            for filename, target in entry['links'].items():
+                if os.readlink(filename) != target:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def sources(self):
+        """Return the source trees links were created from, for any
+        destination.
+        """
+        return set(src for entries in self.entries.values()
+                   for src in entries)
+
+    def set(self, src, dst, links, dirs):
+        self.entries.setdefault(dst, {})[src] = {'links': links, 'dirs': dirs}
+
+    def save(self):
+        fd, tmpname = tempfile.mkstemp(dir=path.dirname(self.filename),
+                                       prefix='.linktree-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmpname, self.filename)
+
+
+class Planner(object):
+    """Works out the changes needed to link ``src`` to ``dst``."""
+
+    def __init__(self, src, dst, fs, previous, sources=()):
+        self.src, self.dst, self.fs = src, dst, fs
+        # Links we created before, which we may replace or remove
+        self.previous = previous
+        # Source trees we linked before, whose links we may unfold
+        self.sources = sources
+        # filename -> link text, for all links that make up the tree
+        self.links = {}
+        # Source directories that were listed -> their mtime
+        self.dirs = {}
+        # Changes, in the order they are to be made
+        self.changes = []
+        # Links which will be there once directories are unfolded
+        self.virtual = {}
+        self.unfolded = set()
+
+    def lookup(self, filename):
+        """Return the kind of ``filename``, and for links, the path the
+        link points to, as they will be once the changes are made.
+        """
+        if filename in self.virtual:
+            return LINK, self.virtual[filename]
+        if path.dirname(filename) in self.unfolded:
+            return MISSING, None
+        kind = self.fs.kind(filename)
+        if kind is LINK:
+            return LINK, path.normpath(path.join(
+                path.dirname(filename), self.fs.readlink(filename)))
+        return kind, None
+
+    def link(self, src, dst):
+        target = path.relpath(src, path.dirname(dst))
+        self.links[dst] = target
+        return target
+
+    def is_linked_tree(self, filename):
+        """Return whether ``filename`` is within one of ``sources``."""
+        return any(filename == source or
+                   filename.startswith(source.rstrip(os.sep) + os.sep)
+                   for source in self.sources)
+
+    def plan(self):
+        self.visit(self.src, self.dst)
+        # Links from before that are no longer part of the tree
+        for filename, target in sorted(self.previous.items()):
+            if filename not in self.links and \
+                    self.fs.islink(filename) and \
+                    self.fs.readlink(filename) == target:
+                self.changes.append(('unlink', filename, None))
+        return self.changes
+
+    def visit(self, src, dst):
+        kind, current = self.lookup(dst)
+        if kind is MISSING:
+            self.changes.append(('link', dst, self.link(src, dst)))
+            return
+
+        if kind is LINK:
+            if current == src:
+                self.links[dst] = path.relpath(src, path.dirname(dst))
+                if dst in self.virtual:
+                    del self.virtual[dst]
+                    self.changes.append(('link', dst, self.links[dst]))
+                return
+            if dst in self.previous and dst not in self.virtual:
+                # One of ours, pointing to where the source used to be
+                self.changes.append(('unlink', dst, None))
+                self.changes.append(('link', dst, self.link(src, dst)))
+                return
+            if path.isdir(src) and self.fs.isdir(current) and \
+                    self.is_linked_tree(current):
+                self.unfold(dst, current)
+                self.descend(src, dst)
+                return
+            raise LinkConflict('%s is a link to %s' % (dst, current))
+
+        if kind is DIR and path.isdir(src):
+            self.descend(src, dst)
+            return
+        raise LinkConflict('%s exists' % dst)
+
+    def unfold(self, dst, current):
+        """Replace the link ``dst`` by a directory with links to the
+        entries of ``current``.
+        """
+        if dst in self.virtual:
+            self.changes.append(('mkdir', dst, None))
+            del self.virtual[dst]
+        else:
+            self.changes.append(('unfold', dst, None))
+        self.unfolded.add(dst)
+        for name in sorted(os.listdir(current)):
+            self.virtual[path.join(dst, name)] = path.join(current, name)
+
+    def descend(self, src, dst):
+        self.dirs[src] = os.stat(src).st_mtime
+        for name in sorted(os.listdir(src)):
+            self.visit(path.join(src, name), path.join(dst, name))
+        # Links of the unfolded directory that the source did not replace
+        for filename in sorted(self.virtual):
+            if path.dirname(filename) == dst:
+                self.changes.append(('link', filename, path.relpath(
+                    self.virtual.pop(filename), dst)))
+
+
+def link_tree(src, dst, fs=None, manifest=None):
+    """Link the entries of ``src`` into ``dst``. Returns a list of
+    (action, filename) tuples for the changes made, where action is
+    ``linked``, ``unfolded`` or ``unlinked``.
+
+    Raises ``LinkConflict`` if the destination has files in the way, or
+    links to directories of trees not recorded in ``manifest``, in which
+    case nothing is changed.
+    """
+    fs = fs or StatCache()
+    src, dst = path.abspath(src), path.abspath(dst)
+    if manifest is not None and manifest.is_current(src, dst):
+        return []
+
+    previous, sources = {}, ()
+    if manifest is not None:
+        previous = manifest.get(src, dst)['links']
+        sources = manifest.sources()
+    planner = Planner(src, dst, fs, previous, sources)
+    changes = planner.plan()
+
+    result = []
+    if not fs.exists(path.dirname(dst)):
+        fs.makedirs(path.dirname(dst))
+    for action, filename, target in changes:
+        if action == 'link':
+            fs.symlink(target, filename)
+            result.append(('linked', filename))
+        elif action == 'unlink':
+            fs.unlink(filename)
+            result.append(('unlinked', filename))
+        elif action == 'unfold':
+            fs.unlink(filename)
+            fs.makedirs(filename)
+            result.append(('unfolded', filename))
+        elif action == 'mkdir':
+            # Unfolding a directory within an unfolded one
+            fs.makedirs(filename)
+            result.append(('unfolded', filename))
+
+    if manifest is not None:
+        manifest.set(src, dst, planner.links, planner.dirs)
+    return result
@@ -0,0 +1,121 @@
+"""Evaluate a document for many sets of tags at once.
+
+Rather than traversing the document once per tag set, every tag is
+represented by a bitmask with one bit per tag set, and the traversal
+carries the mask of tag sets for which the current block is active. A
+tag expression then becomes a couple of integer operations for all tag
+sets at the same time, and a ``define`` sets the tag's bit for exactly
+the tag sets which reach it, so the ordering semantics are the same as
+those of ``traverse_document``.
+"""
+
+from itertools import combinations
+
+from .nodes import Command, And, Or
+from .script import parse_tag, firstpass
+from .guards import GUARDS
+
+
+__all__ = ('evaluate_matrix', 'group_plans', 'expand_matrix')
+
+
+def iter_bits(mask):
+    """Yield the index of every set bit in ``mask``."""
+    index = 0
+    while mask:
+        if mask & 1:
+            yield index
+        mask >>= 1
+        index += 1
+
+
+def evaluate_matrix(document, tag_sets):
+    """For each of ``tag_sets``, determine the commands of ``document``
+    that would run.
+
+    Returns a list of command lists, in the same order as ``tag_sets``.
+    """
+    everyone = (1 << len(tag_sets)) - 1
+    masks = {}
+    for index, tags in enumerate(tag_sets):
+        for tag in tags:
+            masks[tag] = masks.get(tag, 0) | (1 << index)
+
+    def match(expr):
+        if isinstance(expr, And):
+            result = everyone
+            for item in expr.items:
+                result &= match(item)
+                if not result:
+                    break
+            return result
+        elif isinstance(expr, Or):
+            result = 0
+            for item in expr.items:
+                result |= match(item)
+                if result == everyone:
+                    break
+            return result
+        else:
+            required, tag = parse_tag(expr)
+            mask = masks.get(tag, 0)
+            return mask if required else everyone & ~mask
+
+    plans = [[] for _ in tag_sets]
+    def recurse(items, active):
+        for item in items:
+            if isinstance(item, Command):
+                # Same as in traverse_document()
+                if item.argv[0] == 'define':
+                    for tag in item.argv:
+                        masks[tag] = masks.get(tag, 0) | active
+                    continue
+                if item.argv[0] in GUARDS:
+                    continue
+                for index in iter_bits(active):
+                    plans[index].append(item)
+            else:
+                selected = active & match(item.tagexpr.expr)
+                if selected:
+                    recurse(item.items, selected)
+
+    if everyone:
+        recurse(document, everyone)
+    return plans
+
+
+def group_plans(tag_sets, plans):
+    """Group tag sets with identical plans together.
+
+    Returns a list of 2-tuples (plan, list of tag sets), in the order in
+    which the plans first occur.
+    """
+    groups = {}
+    result = []
+    for tags, plan in zip(tag_sets, plans):
+        key = tuple(map(id, plan))
+        if key not in groups:
+            groups[key] = (plan, [])
+            result.append(groups[key])
+        groups[key][1].append(tags)
+    return result
+
+
+def expand_matrix(document, profiles, public_tags=None):
+    """Cross every profile (a set of ``sys:*`` tags) with all the
+    combinations of ``public_tags``.
+
+    If ``public_tags`` is not given, the capitalized tags the document
+    offers on the respective profile are used.
+    """
+    tag_sets = []
+    for profile in profiles:
+        choices = public_tags
+        if choices is None:
+            choices = [tag for tag in firstpass(document, set(profile))
+                       if tag[0].isupper()]
+        choices = sorted(set(choices))
+        for length in range(len(choices) + 1):
+            for chosen in combinations(choices, length):
+                tag_sets.append(frozenset(profile) | frozenset(chosen))
+    return tag_sets
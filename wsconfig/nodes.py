@@ -0,0 +1,117 @@
+"""The nodes of the tree a document is parsed into.
+
+These are kept separate from the grammar, so that code which only deals
+with documents (or the tag scanner, see ``scan``) does not have to pay
+for importing PyParsing and building the grammar.
+"""
+
+
+__all__ = ('Command', 'And', 'Or', 'TagExpr', 'Selector')
+
+
+def intern_str(value):
+    """Tags and command names repeat a lot throughout a document; let all
+    occurrences share a single string object.
+    """
+    return intern(value) if type(value) is str else value
+
+
+class Node(object):
+    """Base class for the nodes of the tree.
+
+    Documents can have a great number of nodes, so they use ``__slots__``
+    and store their children as tuples. ``_fields`` are the slots that make
+    up the structure of the node, which are what equality is based on;
+    other slots (like those that ``validate`` fills in) are ignored.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __eq__(self, other):
+        if type(other) is type(self):
+            for field in self._fields:
+                if getattr(self, field) != getattr(other, field):
+                    return False
+            return True
+        return False
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    def __reduce__(self):
+        return (self.__class__,
+                tuple(getattr(self, field) for field in self._fields))
+
+class Command(Node):
+    # ``plugin`` and ``guards`` are set by ``validate``; ``lineno`` is
+    # where the command starts in the source, if known
+    __slots__ = ('argv', 'plugin', 'guards', 'lineno')
+    _fields = ('argv',)
+    def __init__(self, argv, lineno=None):
+        argv = tuple(argv)
+        # Intern the command name, and the name following a sudo
+        if argv:
+            argv = (intern_str(argv[0]),) + argv[1:]
+            if argv[0] == 'sudo' and len(argv) > 1:
+                argv = argv[:1] + (intern_str(argv[1]),) + argv[2:]
+        self.argv = argv
+        self.lineno = lineno
+    def __reduce__(self):
+        # Keep the line number in cached documents, for ``--lines``
+        return (self.__class__, (self.argv, self.lineno))
+    @property
+    def command(self):
+        """The name of the command, without a ``sudo`` prefix."""
+        return self.argv[1] if self.argv[0] == 'sudo' else self.argv[0]
+    @property
+    def args(self):
+        """The arguments to the command."""
+        return self.argv[2:] if self.argv[0] == 'sudo' else self.argv[1:]
+    def __str__(self):
+        return 'exec(%s)' % " ".join(self.argv)
+    def __repr__(self):
+        return '<%s %s>' % (
+            self.__class__.__name__, list(self.argv)
+        )
+
+class And(Node):
+    __slots__ = _fields = ('items',)
+    def __init__(self, items):
+        self.items = tuple(map(intern_str, items))
+    def __str__(self):
+        return '%s' % " and ".join(map(str, self.items))
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, list(self.items))
+
+class Or(Node):
+    __slots__ = _fields = ('items',)
+    def __init__(self, items):
+        self.items = tuple(items)
+    def __str__(self):
+        return '%s' % " or ".join(map(
+            # Wrap nested ``And``s in brackets if they have more than one item
+            lambda i: "(%s)" % i
+                if (isinstance(i, And) and len(i.items) > 1)
+                else str(i),
+            self.items))
+    def __repr__(self):
+        return '<%s %s>' % (
+            self.__class__.__name__, ' '.join(map(repr, self.items)))
+
+class TagExpr(Node):
+    __slots__ = _fields = ('expr',)
+    def __init__(self, expr):
+        self.expr = expr
+    def __str__(self):
+        return 'if(%s)' % self.expr
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, repr(self.expr))
+
+class Selector(Node):
+    __slots__ = _fields = ('tagexpr', 'items')
+    def __init__(self, tagexpr, items):
+        self.tagexpr = tagexpr
+        self.items = tuple(items)
+    def __str__(self):
+        return '%s -> %s' % (self.tagexpr, self.items)
+    def __repr__(self):
+        return '<%s %s items=%s>' % (
+            self.__class__.__name__, repr(self.tagexpr), map(repr, self.items))
@@ -0,0 +1,311 @@
+"""Simplify a document for the machine it is going to run on.
+
+The ``sys:*`` tags are known as soon as ``init_env`` ran, and cannot be
+changed by the user, so the parts of a document that depend on them can
+be evaluated ahead of time. The optimizer:
+
+- Specializes tag expressions against the system tags: ``sys:*`` tags
+  that are set are dropped from an expression, selectors that require a
+  ``sys:*`` tag which is not set are removed, and selectors which no
+  longer have any condition are replaced by their content.
+- Removes ``define`` commands that have no effect, because no selector
+  that follows them uses the tags they define.
+- Merges adjacent selectors with identical expressions.
+- Removes packages that an earlier command already installs, if that
+  command is guaranteed to run whenever the later one does (it is not in
+  a different block, and has no guards). Guards and ``timeout --next``
+  of a command that is removed as a whole are removed with it.
+
+Guards stay with the command they are written before: a block ending in
+a guard, which ``validate`` rejects, is not merged or inlined into what
+follows.
+
+``sys:*`` tags which the document itself defines are left alone.
+"""
+
+import os
+from os import path
+import hashlib
+import tempfile
+import cPickle as pickle
+
+from .parsing import parse_file, Command, Selector, TagExpr, Or, And
+from .script import parse_tag
+from .guards import GUARDS
+from .plugins import PipPlugin, ApplyError
+from .cache import cache_dir
+
+
+__all__ = ('optimize', 'optimize_file')
+
+
+# Change this when the output of the optimizer changes, to invalidate
+# the cached results.
+VERSION = 5
+
+# Commands whose arguments are a list of packages to install.
+PACKAGE_COMMANDS = ('dpkg', 'pip', 'brew')
+
+
+def iter_items(document):
+    """Yield all nodes of the document, in the order they are traversed."""
+    for item in document:
+        yield item
+        if isinstance(item, Selector):
+            for child in iter_items(item.items):
+                yield child
+
+
+def expr_tags(expr):
+    return set(parse_tag(tag)[1] for and_expr in expr.items
+               for tag in and_expr.items)
+
+
+def is_define(item):
+    return isinstance(item, Command) and item.argv[0] == 'define'
+
+
+def command_name(command):
+    return command.argv[1] if command.argv[0] == 'sudo' else command.argv[0]
+
+
+def is_attached(item):
+    """Return whether ``item`` belongs to the command after it: a guard,
+    or a ``timeout --next``.
+    """
+    return isinstance(item, Command) and (
+        item.argv[0] in GUARDS or
+        item.argv[0] == 'timeout' and item.args[:1] == ('--next',))
+
+
+def ends_with_guard(items):
+    return bool(items) and isinstance(items[-1], Command) and \
+        items[-1].argv[0] in GUARDS
+
+
+def package_args(name, args):
+    """Return where the packages of a package command with ``args`` are
+    installed (the virtualenv, for ``pip``), and the indexes of the
+    arguments that are packages, rather than options or their values.
+
+    ``dpkg`` installs each of its arguments as a package. ``pip`` and
+    ``brew`` pass arguments starting with ``-`` on as options.
+    """
+    if name == 'dpkg':
+        return None, range(len(args))
+    scope, first = None, 0
+    if name == 'pip':
+        try:
+            scope, _, packages = PipPlugin(os.curdir).parse(args)
+        except ApplyError:
+            return None, []
+        first = len(args) - len(packages)
+    return scope, [i for i in range(first, len(args))
+                   if not args[i].startswith('-')]
+
+
+class Optimizer(object):
+
+    def __init__(self, sys_tags):
+        self.sys_tags = set(sys_tags)
+        self.report = []
+
+    def run(self, document):
+        # Tags the document defines itself are not known in advance.
+        self.defined = set(tag for item in iter_items(document)
+                           if is_define(item) for tag in item.argv)
+
+        document = self.specialize(document)
+        document = self.remove_defines(document)
+        document = self.merge(document)
+        document = self.dedup(document, set())
+        return document
+
+    def is_known(self, tag):
+        return tag.startswith('sys:') and tag not in self.defined
+
+    def specialize_expr(self, expr):
+        """Return the simplified ``Or`` expression; ``None`` if it can
+        never match, ``True`` if it always matches.
+        """
+        ands = []
+        for and_expr in expr.items:
+            tags = []
+            for tag in and_expr.items:
+                required, name = parse_tag(tag)
+                if not self.is_known(name):
+                    tags.append(tag)
+                elif (name in self.sys_tags) != required:
+                    break
+            else:
+                if not tags:
+                    return True
+                ands.append(and_expr if len(tags) == len(and_expr.items)
+                            else And(tags))
+        if not ands:
+            return None
+        if len(ands) == len(expr.items) and \
+                all(a is b for a, b in zip(ands, expr.items)):
+            return expr
+        return Or(ands)
+
+    def specialize(self, items):
+        result = []
+        for item in items:
+            if not isinstance(item, Selector):
+                result.append(item)
+                continue
+
+            if ends_with_guard(result):
+                # Leave it to validate to reject the guard
+                result.append(item)
+                continue
+            expr = self.specialize_expr(item.tagexpr.expr)
+            if expr is None:
+                self.report.append('removed %s, it can never match' %
+                                   item.tagexpr)
+            elif expr is True:
+                self.report.append('inlined %s, it always matches' %
+                                   item.tagexpr)
+                result.extend(self.specialize(item.items))
+            else:
+                tagexpr = item.tagexpr if expr is item.tagexpr.expr \
+                    else TagExpr(expr)
+                result.append(Selector(tagexpr, self.specialize(item.items)))
+        return result
+
+    def remove_defines(self, document):
+        """Remove ``define`` commands which are not followed by any
+        selector that uses one of the tags they define.
+        """
+        used_later = set()
+        ineffective = set()
+        for item in reversed(list(iter_items(document))):
+            if isinstance(item, Selector):
+                used_later |= expr_tags(item.tagexpr.expr)
+            elif is_define(item) and not used_later & set(item.argv):
+                ineffective.add(id(item))
+                self.report.append(
+                    'removed "%s", no selector after it uses the tag' %
+                    ' '.join(item.argv))
+
+        def filter_items(items):
+            return [Selector(item.tagexpr, filter_items(item.items))
+                    if isinstance(item, Selector) else item
+                    for item in items if id(item) not in ineffective]
+        return filter_items(document) if ineffective else document
+
+    def merge(self, items):
+        """Merge adjacent selectors with the same expression, unless the
+        first one defines a tag that the expression uses, or ends in a
+        guard, which would then guard a command of the second one.
+        """
+        result = []
+        for item in items:
+            if isinstance(item, Selector):
+                item = Selector(item.tagexpr, self.merge(item.items))
+                previous = result[-1] if result else None
+                if isinstance(previous, Selector) and \
+                        previous.tagexpr == item.tagexpr and \
+                        not ends_with_guard(previous.items):
+                    defined = set(tag for child in iter_items(previous.items)
+                                  if is_define(child) for tag in child.argv)
+                    if not defined & expr_tags(item.tagexpr.expr):
+                        self.report.append(
+                            'merged adjacent selectors %s' % item.tagexpr)
+                        result[-1] = Selector(
+                            item.tagexpr, self.merge(
+                                previous.items + item.items))
+                        continue
+            result.append(item)
+        return result
+
+    def dedup(self, items, installed):
+        """Remove packages from install commands, if they were installed
+        by a previous command in the same or an enclosing block.
+        """
+        installed = set(installed)
+        result = []
+        # The guards and timeouts before the current command
+        attached = []
+        for item in items:
+            if isinstance(item, Selector):
+                result.append(Selector(item.tagexpr,
+                                       self.dedup(item.items, installed)))
+                attached = []
+                continue
+            if is_attached(item):
+                attached.append(item)
+                result.append(item)
+                continue
+
+            name = command_name(item) if len(item.argv) > 1 else None
+            if name in PACKAGE_COMMANDS:
+                prefix = item.argv[:len(item.argv) - len(item.args)]
+                scope, indexes = package_args(name, item.args)
+                removed, seen = set(), set()
+                for i in indexes:
+                    key = (name, scope, item.args[i])
+                    if key in installed or key in seen:
+                        self.report.append('removed duplicate "%s %s"' % (
+                            name, item.args[i]))
+                        removed.add(i)
+                    seen.add(key)
+                # A guard may skip the command
+                if not any(a.argv[0] in GUARDS for a in attached):
+                    installed |= seen
+                if indexes and len(removed) == len(indexes):
+                    # The guards and timeouts would apply to the next
+                    # command instead
+                    del result[len(result) - len(attached):]
+                    attached = []
+                    continue
+                if removed:
+                    item = Command(prefix + tuple(
+                        arg for i, arg in enumerate(item.args)
+                        if i not in removed), item.lineno)
+            attached = []
+            result.append(item)
+        return result
+
+
+def optimize(document, sys_tags):
+    """Optimize ``document`` for a system with ``sys_tags``.
+
+    Returns a 2-tuple (document, report), where ``report`` is a list of
+    messages describing what was changed. This runs on a parsed document,
+    before ``validate``.
+    """
+    optimizer = Optimizer(sys_tags)
+    document = optimizer.run(document)
+    return document, optimizer.report
+
+
+def optimize_file(filename, sys_tags, use_cache=True):
+    """Parse and optimize ``filename``.
+
+    The result is cached per file content and set of system tags, so
+    subsequent calls on the same host do not have to parse the file.
+    """
+    sys_tags = sorted(tag for tag in sys_tags if tag.startswith('sys:'))
+    with open(filename, 'rb') as f:
+        source = f.read()
+    key = hashlib.sha256('\0'.join(
+        [str(VERSION), source] + sys_tags)).hexdigest()
+    cache_file = path.join(cache_dir('optimized'), key)
+
+    if use_cache:
+        try:
+            with open(cache_file, 'rb') as f:
+                return pickle.load(f)
+        except Exception:
+            # Missing, or written by another version; optimize again
+            pass
+
+    result = optimize(list(parse_file(filename)), sys_tags)
+    if use_cache:
+        fd, tmpname = tempfile.mkstemp(dir=path.dirname(cache_file))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, cache_file)
+    return result
@@ -3,8 +3,12 @@
 Currently uses PyParsing. I'm not happy with the error messages it produces.
 """
 
+import re
+
 from pyparsing import *
 
+from .nodes import intern_str, Command, And, Or, TagExpr, Selector
+
 
 __all__ = ('parse_file', 'parse_string', 'print_document',
            'Command', 'And', 'Or', 'TagExpr', 'Selector')
@@ -73,130 +77,100 @@ def minIndentBlock(blockStatementExpr):
         (OneOrMore(CHECK_INDENT + blockStatementExpr + Optional(NL))))
 
 
-items = Forward()
-
 # Characters allowed in commands - all but your syntax elements
 commandchars = "".join([c for c in printables if c not in '{}'])
 
 # List of characters allowed in tags, commands...
 tagchars = alphanums + ':._-'
 
-# A command that will be executed.
-#
-# This is essentially everything until the end of the line, but we split it
-# into multiple words by whitespace, and support quoting. The NotAny() is
-# required, because PyParsing does not backtrack, it seems.
-#
-# The first word needs to start with an alphanumeric character only.
-internal_command = \
-        Word(alphas, alphanums+'_') + \
-        ZeroOrMore(NotAny(lineEnd) + (quotedString | Word(commandchars))) + \
-        (Suppress(lineEnd) | FollowedBy('}'))
-
-# Provide a special syntax for shell commands
-shell_command =\
-    (Suppress(Literal('$:')) - minIndentBlock(SkipTo(lineEnd))) |\
-    (Suppress(Literal('$')) + SkipTo(lineEnd | Literal('}')))
-
-command = shell_command | internal_command
-
-# A selector restricts the commands in it's body to the given tags.
-# I.e. this is the ``tag { commands... }`` syntax structure.
-#
-# The tag expression allows multiple tags separated by whitespace (AND), as
-# well as usage of commas (OR). Brackets for complex expressions are currently
-# not supported. AND takes preference, so: ``tag1, tag2 tag3`` is
-# ``tag1 OR (tag2 AND tag3)``.
-tagexprAnd = OneOrMore(Combine(Optional('!') + Word(alphas, tagchars)))
-tagexprOr = delimitedList(tagexprAnd)
-tagexpr = tagexprOr
-selector = tagexpr - Suppress('{') - items - Suppress('}')
-
-# An item is either a selector or a command
-item = command | selector
-items << ZeroOrMore(item)
-
-# A full document.
-root = items + StringEnd()
-
-# Support comments
-root.ignore(pythonStyleComment)
 
+class LineCounter(object):
+    """Returns the line number of a location in the string being parsed.
 
-################################################################################
-###### Constructing the AST
-######
-###### Attach parser actions to parse into a tree.
-################################################################################
+    Parse actions run mostly in the order of their location, so newlines
+    are counted from the previous location, not from the start of the
+    string each time, as ``pyparsing.lineno`` would. The location may
+    be that of whitespace (or comments) preceding the match, which are
+    skipped.
+    """
 
+    whitespace_re = re.compile(r'(?:\s+|#[^\n]*)*')
 
-class Node(object):
-    def __eq__(self, other):
-        if type(other) is type(self):
-            return self.__dict__ == other.__dict__
-        return False
-    def __ne__(self, other):
-        return not self.__eq__(other)
-
-class Command(Node):
-    def __init__(self, argv):
-        self.argv = argv
-    def __str__(self):
-        return 'exec(%s)' % " ".join(self.argv)
-    def __repr__(self):
-        return '<%s %s>' % (
-            self.__class__.__name__, self.argv
-        )
-
-class And(Node):
-    def __init__(self, items):
-        self.items = items
-    def __str__(self):
-        return '%s' % " and ".join(map(str, self.items))
-    def __repr__(self):
-        return '<%s %s>' % (self.__class__.__name__, self.items)
-
-class Or(Node):
-    def __init__(self, items):
-        self.items = items
-    def __str__(self):
-        return '%s' % " or ".join(map(
-            # Wrap nested ``And``s in brackets if they have more than one item
-            lambda i: "(%s)" % i
-                if (isinstance(i, And) and len(i.items) > 1)
-                else str(i),
-            self.items))
-    def __repr__(self):
-        return '<%s %s>' % (
-            self.__class__.__name__, ' '.join(map(repr, self.items)))
-
-class TagExpr(Node):
-    def __init__(self, expr):
-        self.expr = expr
-    def __str__(self):
-        return 'if(%s)' % self.expr
-    def __repr__(self):
-        return '<%s %s>' % (self.__class__.__name__, repr(self.expr))
-
-class Selector(Node):
-    def __init__(self, tagexpr, items):
-        self.tagexpr = tagexpr
-        self.items = items
-    def __str__(self):
-        return '%s -> %s' % (self.tagexpr, self.items)
-    def __repr__(self):
-        return '<%s %s items=%s>' % (
-            self.__class__.__name__, repr(self.tagexpr), map(repr, self.items))
-
-
-# Restore $, which we have the parser suppress, to indicate shell command
-shell_command.setParseAction(lambda _,__,toks: ['$'] + [''.join(toks[:])])
-# Create nodes for other tokens
-command.setParseAction(lambda _,__,toks: Command(toks[0:]))
-tagexprAnd.setParseAction(lambda _,__,toks: And(toks[0:]))
-tagexpr.setParseAction(lambda _,__,toks: TagExpr(Or(toks[0:])))
-selector.setParseAction(lambda _,__,toks: Selector(toks[0], toks[1:]))
-quotedString.setParseAction(removeQuotes)
+    def __init__(self):
+        self.s, self.loc, self.line = None, 0, 1
+
+    def __call__(self, s, loc):
+        loc = self.whitespace_re.match(s, loc).end()
+        if s is not self.s or loc < self.loc:
+            self.s, self.loc, self.line = s, 0, 1
+        self.line += s.count('\n', self.loc, loc)
+        self.loc = loc
+        return self.line
+
+
+def grammar(line_of):
+    """Return the grammar of a document, with parse actions that build
+    the tree. ``line_of`` returns the line number of a location in the
+    string being parsed.
+    """
+    # Our own copy, with the quotes removed
+    quoted = quotedString.copy().setParseAction(removeQuotes)
+
+    items = Forward()
+
+    # A command that will be executed.
+    #
+    # This is essentially everything until the end of the line, but we split
+    # it into multiple words by whitespace, and support quoting. The NotAny()
+    # is required, because PyParsing does not backtrack, it seems.
+    #
+    # The first word needs to start with an alphanumeric character only.
+    internal_command = \
+            Word(alphas, alphanums+'_') + \
+            ZeroOrMore(NotAny(lineEnd) + (quoted | Word(commandchars))) + \
+            (Suppress(lineEnd) | FollowedBy('}'))
+
+    # Provide a special syntax for shell commands
+    shell_command =\
+        (Suppress(Literal('$:')) - minIndentBlock(SkipTo(lineEnd))) |\
+        (Suppress(Literal('$')) + SkipTo(lineEnd | Literal('}')))
+
+    command = shell_command | internal_command
+
+    # A selector restricts the commands in it's body to the given tags.
+    # I.e. this is the ``tag { commands... }`` syntax structure.
+    #
+    # The tag expression allows multiple tags separated by whitespace (AND),
+    # as well as usage of commas (OR). Brackets for complex expressions are
+    # currently not supported. AND takes preference, so: ``tag1, tag2 tag3``
+    # is ``tag1 OR (tag2 AND tag3)``.
+    tagexprAnd = OneOrMore(Combine(Optional('!') + Word(alphas, tagchars)))
+    tagexprOr = delimitedList(tagexprAnd)
+    tagexpr = tagexprOr
+    selector = tagexpr - Suppress('{') - items - Suppress('}')
+
+    # An item is either a selector or a command
+    item = command | selector
+    items << ZeroOrMore(item)
+
+    # A full document.
+    root = items + StringEnd()
+
+    # Support comments
+    root.ignore(pythonStyleComment)
+
+    # Attach parser actions to parse into a tree.
+    #
+    # Restore $, which we have the parser suppress, to indicate shell command
+    shell_command.setParseAction(lambda _,__,toks: ['$'] + [''.join(toks[:])])
+    # Create nodes for other tokens
+    command.setParseAction(
+        lambda s, loc, toks: Command(toks[0:], line_of(s, loc)))
+    tagexprAnd.setParseAction(lambda _,__,toks: And(toks[0:]))
+    tagexpr.setParseAction(lambda _,__,toks: TagExpr(Or(toks[0:])))
+    selector.setParseAction(lambda _,__,toks: Selector(toks[0], toks[1:]))
+
+    return root
 
 
 def print_document(doc, level=0):
@@ -209,5 +183,33 @@ def print_document(doc, level=0):
             print '%s%s' % (indent, item)
 
 
-parse_string = root.parseString
-parse_file = root.parseFile
+# Grammars no parse is using right now, with the list that holds the
+# ``LineCounter`` of the parse using them. Creating a grammar takes longer
+# than parsing a small document, so they are reused; but only by one parse
+# at a time, such that parses in several threads do not share a counter.
+idle_grammars = []
+
+
+def parse(method, source):
+    try:
+        root, counter = idle_grammars.pop()
+    except IndexError:
+        counter = []
+        root = grammar(lambda s, loc: counter[0](s, loc))
+    counter.append(LineCounter())
+    try:
+        return getattr(root, method)(source)
+    finally:
+        # Do not keep the string alive
+        del counter[:]
+        idle_grammars.append((root, counter))
+
+
+def parse_string(s):
+    """Parse the document in the string ``s``."""
+    return parse('parseString', s)
+
+
+def parse_file(filename):
+    """Parse the document in ``filename`` (or a file object)."""
+    return parse('parseFile', filename)
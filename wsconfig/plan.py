@@ -0,0 +1,99 @@
+"""Compile a document into the list of commands it runs, and load such a
+plan to apply it elsewhere.
+
+A plan is decided on one host (with ``wsconfig file plan Tags... -o
+plan.json``): ``define`` commands and selectors are evaluated for the
+given tags, and variables are replaced by their values. What remains is
+a flat list of commands, each with the directory relative paths are
+resolved against, and the values of variables that commands use other
+than in their arguments (like ``template`` does). Applying it
+(``wsconfig --apply-plan plan.json``) needs neither the source file nor
+the parser. Guards (``creates``,
+``unless``) are kept with the command they guard, since they are checked
+when the plan is applied.
+
+The format is JSON::
+
+    {"version": 1,
+     "tags": ["Dev", "sys:linux", ...],
+     "variables": {"@@name@@": "value", ...},
+     "commands": [{"argv": ["sudo", "link", "a", "b"],
+                   "basedir": "/home/user/config",
+                   "guards": [["creates", "~/bin/tool"]]}, ...]}
+"""
+
+import json
+from os import path
+
+from .nodes import Command
+from .script import traverse_document, substitute, validate, ConfigError
+
+
+__all__ = ('compile_plan', 'write_plan', 'load_plan')
+
+
+VERSION = 1
+
+
+def compile_plan(document, tags, variables):
+    """Return the plan for applying ``document`` (which must have been
+    validated) with ``tags`` and ``variables``, as a dict.
+    """
+    commands = []
+    used_variables = {}
+    for selector, command, _ in traverse_document(document, tags):
+        if not command:
+            continue
+        prefix = command.argv[:len(command.argv) - len(command.args)]
+        args = substitute(command.args, variables)
+        entry = {
+            'argv': list(prefix) + args,
+            'basedir': command.plugin.basedir,
+        }
+        guards = getattr(command, 'guards', ())
+        if guards:
+            entry['guards'] = [
+                [guard.argv[0]] + substitute(guard.args, variables)
+                for guard in guards]
+        commands.append(entry)
+        for name in command.plugin.variables(args):
+            if name in variables:
+                used_variables[name] = variables[name]
+    return {'version': VERSION, 'tags': sorted(tags), 'commands': commands,
+            'variables': used_variables}
+
+
+def write_plan(plan, stream):
+    json.dump(plan, stream, indent=1, sort_keys=True)
+    stream.write('\n')
+
+
+def load_plan(filename, plugins):
+    """Load the plan in ``filename``, and return it as a validated
+    document (a list of commands) that can be applied, along with the
+    tags and variables it was compiled for.
+    """
+    with open(filename, 'rb') as f:
+        try:
+            plan = json.load(f)
+        except ValueError, e:
+            raise ConfigError('%s is not a valid plan: %s' % (filename, e))
+    if plan.get('version') != VERSION:
+        raise ConfigError('%s is a plan of an unsupported version' % filename)
+
+    document = []
+    # Commands with the same basedir can share plugin instances
+    instances = {}
+    for entry in plan['commands']:
+        nodes = [Command([arg.encode('utf-8') for arg in argv])
+                 for argv in entry.get('guards', []) + [entry['argv']]]
+        command = nodes[-1]
+        basedir = entry['basedir'].encode('utf-8')
+        # Validate as if the document was located in the basedir
+        validate(nodes, path.join(basedir, path.basename(filename)),
+                 plugins, instances.setdefault(basedir, {}))
+        document.append(command)
+    tags = set(tag.encode('utf-8') for tag in plan['tags'])
+    variables = dict((name.encode('utf-8'), value.encode('utf-8'))
+                     for name, value in plan.get('variables', {}).items())
+    return document, tags, variables
@@ -1,8 +1,20 @@
 import os
 from os import path
-from subprocess import Popen, list2cmdline
+import re
+from subprocess import list2cmdline
 import subprocess
 import sys
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from .fscache import StatCache
+from .events import bus, Log, Message, FileUpdate, Reminders
+
+# What the plugins need to do their work (the download cache, sync,
+# linktree, the settings stores, reading git repositories, running
+# processes) is imported where they use it. Listing the tags of a file
+# imports this module, and should not pay for any of it.
 
 
 class ApplyError(Exception):
@@ -11,6 +23,39 @@ class ApplyError(Exception):
         self.returncode = process.returncode if process else None
         self.process = process
 
+    # How the command failed, as reported in the ``CommandFail`` event
+    outcome = 'error'
+
+
+class ApplyTimeout(ApplyError):
+    """A command was killed because it did not finish in time."""
+
+    outcome = 'timeout'
+
+    def __init__(self, timeout, process=None):
+        ApplyError.__init__(
+            self, 'Process did not finish within %s seconds' % timeout, process)
+        self.timeout = timeout
+
+
+# Variables, which the user is asked for before a run
+variable_re = re.compile(r'(@@[\w]+@@)')
+
+
+def backend_of(state):
+    """Return the backend the current run makes its changes through."""
+    if 'backend' not in state:
+        from .backends import real
+        state['backend'] = real
+    return state['backend']
+
+
+def stat_cache(state):
+    """Return the ``StatCache`` of the current run."""
+    if 'stat_cache' not in state:
+        state['stat_cache'] = StatCache(backend_of(state))
+    return state['stat_cache']
+
 
 class Plugin(object):
     """Base class for a plugin, implementing a metaclass registry.
@@ -30,6 +75,23 @@ class Plugin(object):
 
     # Can be overwritten on a per-plugin or per-instance base
     sudo = False
+    # Whether ``run`` may leave work pending, to do it for several
+    # commands at once in ``flush``
+    batched = False
+    # What external commands are run with; set before each run from
+    # the state. Until then, the real backend.
+    _backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            from .backends import real
+            return real
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend):
+        self._backend = backend
 
     def __init__(self, basedir, sudo=None):
         self.basedir = basedir
@@ -39,48 +101,146 @@ class Plugin(object):
     def run(self, arguments, state):
         raise NotImplementedError()
 
+    def sources(self, arguments):
+        """Return the files a command with these ``arguments`` reads from,
+        such that changes to them can be detected (see ``watch``).
+        """
+        return []
+
+    def variables(self, arguments):
+        """Return the variables a command with these ``arguments`` uses,
+        other than those in the arguments themselves (which are replaced
+        before the command runs).
+        """
+        return []
+
+    def prepare(self, arguments, state):
+        """Called for all upcoming commands before the run starts, such
+        that plugins can learn what all of their commands will need, and
+        look it up at once.
+        """
+        pass
+
+    def prefetch(self, arguments, prefetcher, state):
+        """Called for all upcoming commands before the run starts. Can
+        submit jobs to the ``Prefetcher`` that prepare for the command,
+        like downloading things. ``state['timeout']`` is the timeout of
+        the command while this is called.
+        """
+        pass
+
+    def flush(self, state):
+        """Do the work that ``run`` left pending, for a plugin that is
+        ``batched``. Called before a command of another plugin runs, and
+        at the end of the run; the commands of this plugin only complete
+        when it returns.
+        """
+        pass
+
     @classmethod
     def log(cls, str):
-        print ""
-        print "====>", str
+        bus.emit(Log(str))
 
-    def execute_proc(self, cmdline, *a, **kw):
-        """Subclasses should use this to run an external command."""
-        if self.sudo:
+    def execute_proc(self, cmdline, state, *a, **kw):
+        """Subclasses should use this to run an external command. Pass
+        ``sudo`` to override whether it runs as root.
+
+        The command may change any file, so the ``StatCache`` of the run
+        in ``state`` is cleared. It is killed after ``state['timeout']``
+        seconds, if set.
+        """
+        if kw.pop('sudo', self.sudo):
             cmdline = ['sudo'] + cmdline[:]
 
         self.log("$ %s" % (list2cmdline(cmdline)
                            if isinstance(cmdline, list) else cmdline))
         try:
-            process = Popen(cmdline, *a, **kw)
+            process = self.backend.spawn(cmdline, *a, **kw)
         except OSError, e:
             raise ApplyError('Failed to run: %s' % e)
-        process.wait()
+        timeout = state.get('timeout')
+        try:
+            timed_out = self.backend.wait(process, timeout)
+        finally:
+            stat_cache(state).clear()
+        if timed_out:
+            raise ApplyTimeout(timeout, process)
         if process.returncode != 0:
             raise ApplyError(
                 'Process returns non-zero code: %s' % process.returncode,
                 process)
         return process
 
-    def execute_impl(self, arguments):
+    def execute_output(self, cmdline, state, input=None, **kw):
+        """Run an external command, and return its output. ``input`` is
+        passed to it on stdin.
+
+        Output and input go through temporary files, which unlike pipes
+        cannot fill up while we wait for the command to finish.
+        """
+        with tempfile.TemporaryFile() as stdout:
+            with tempfile.TemporaryFile() as stdin:
+                if input is not None:
+                    stdin.write(input)
+                    stdin.seek(0)
+                    kw['stdin'] = stdin
+                process = self.execute_proc(cmdline, state, stdout=stdout,
+                                            **kw)
+            stdout.seek(0)
+            output = stdout.read()
+        if not output and process.stdout:
+            # Like a MemoryBackend, which does not write to files
+            output = process.stdout.read()
+        return output
+
+    def execute_quietly(self, cmdline, timeout=None, **kw):
+        """Run an external command in the background, with no output, and
+        without sudo asking for a password. It is killed after ``timeout``
+        seconds.
+        """
+        if self.sudo:
+            cmdline = ['sudo', '-n'] + cmdline[:]
+        with open(os.devnull, 'r+') as devnull:
+            process = self.backend.spawn(
+                cmdline, stdin=devnull, stdout=devnull, stderr=devnull,
+                background=True, **kw)
+        if self.backend.wait(process, timeout):
+            raise ApplyTimeout(timeout, process)
+        if process.returncode != 0:
+            raise ApplyError('%s returns non-zero code: %s' % (
+                list2cmdline(cmdline), process.returncode))
+
+    def execute_impl(self, arguments, state):
         """Subclasses should use this to run their own ``impl`` methods.
 
-        If necessary, will run these methods via sudo.
+        If necessary, will run these methods via sudo. The implementation
+        uses the ``StatCache`` of the run in ``state``, and keeps it up to
+        date, unless it runs in another process.
         """
+        fs = stat_cache(state)
         if not self.sudo:
-            return self.impl(arguments)
+            return self.impl(arguments, fs=fs)
         else:
             # It would be pretty to use an environment variable as an indicator
             # that the script should execute a plugin, but those would be lost
-            # by sudo.
+            # by sudo. For the same reason, the cache to use is passed along.
+            from .cache import cache_dir
             try:
                 cmdline = ['sudo', sys.executable, '%s' % sys.argv[0],
-                             'WSCONFIG_CALL_PLUGIN', self.name] + arguments
-                process = Popen(cmdline)
+                           'WSCONFIG_CALL_PLUGIN', cache_dir(),
+                           self.name] + arguments
+                process = self.backend.spawn(cmdline)
             except OSError, e:
                 raise ApplyError('Failed to run %s: %s' % (
                     list2cmdline(cmdline), e))
-            process.wait()
+            timeout = state.get('timeout')
+            try:
+                timed_out = self.backend.wait(process, timeout)
+            finally:
+                # Whatever the other process changed, we don't know about.
+                fs.clear()
+            if timed_out:
+                raise ApplyTimeout(timeout, process)
             if process.returncode != 0:
                 raise ApplyError('Process returns non-zero code: %s' % process.returncode)
 
@@ -93,8 +253,29 @@ class DpkgPlugin(Plugin):
     sudo = True
 
     def run(self, arguments, state):
-        for package in arguments:
-            self.execute_proc(['apt-get', 'install', '-y', package])
+        prefetcher = state.get('prefetcher')
+        if not prefetcher:
+            for package in arguments:
+                self.execute_proc(['apt-get', 'install', '-y', package],
+                                  state)
+            return
+
+        # Packages are hopefully downloaded already. Do not run apt while
+        # another download is in progress though, it would fail to lock.
+        prefetcher.claim((self.name,) + tuple(arguments))
+        with prefetcher.lock('apt'):
+            for package in arguments:
+                self.execute_proc(['apt-get', 'install', '-y', package],
+                                  state)
+
+    def prefetch(self, arguments, prefetcher, state):
+        timeout = state.get('timeout')
+        prefetcher.submit(
+            (self.name,) + tuple(arguments),
+            lambda: self.execute_quietly(
+                ['apt-get', 'install', '--download-only', '-y', '-q'] +
+                list(arguments), timeout),
+            lock='apt')
 
 
 class Homebrew(Plugin):
@@ -113,7 +294,7 @@ class Homebrew(Plugin):
             # we can fix this via a wrapper that writes to multiple
             # streams: http://stackoverflow.com/a/9130786
             process = self.execute_proc(['brew', 'install'] + arguments,
-                stdout=subprocess.PIPE)
+                state, stdout=subprocess.PIPE)
         except ApplyError, e:
             # If the package is already installed, brew returns
             # a specific error code and message. Check for this,
@@ -122,24 +303,74 @@ class Homebrew(Plugin):
             if e.returncode != 1 or (
                not 'already installed' in stdout):
                 raise
-            print stdout
+            bus.emit(Message(stdout))
 
         else:
             # Output what we captured, though this might be too late
             # (if there was an error).
-            print process.stdout.read()
+            bus.emit(Message(process.stdout.read()))
 
 
 class PipPlugin(Plugin):
     """Pip python package installation.
+
+    With ``--venv DIR``, packages are installed into a virtualenv, which
+    is created the first time. With ``--wheelhouse DIR``, packages are
+    installed from the wheels in that directory, without asking the
+    index; only if that fails, the missing wheels are built (or
+    downloaded) into it first.
     """
 
     name = 'pip'
     sudo = True
 
+    def __init__(self, basedir, sudo=None):
+        Plugin.__init__(self, basedir, sudo)
+        # A virtualenv belongs to the user, unless it says otherwise
+        self.venv_sudo = bool(sudo)
+
+    def parse(self, arguments):
+        options = {'--venv': None, '--wheelhouse': None}
+        arguments = list(arguments)
+        while arguments and arguments[0] in options:
+            if len(arguments) < 2:
+                raise ApplyError('%s requires a value' % arguments[0])
+            options[arguments[0]] = path.join(
+                self.basedir, path.expanduser(arguments[1]))
+            arguments = arguments[2:]
+        if not arguments:
+            raise ApplyError('pip needs a package to install')
+        return options['--venv'], options['--wheelhouse'], arguments
+
     def run(self, arguments, state):
-        for package in arguments:
-            self.execute_proc(['pip', 'install', package])
+        venv, wheelhouse, packages = self.parse(arguments)
+        pip, sudo = 'pip', self.sudo
+        if venv:
+            pip, sudo = path.join(venv, 'bin', 'pip'), self.venv_sudo
+            if not stat_cache(state).exists(pip):
+                self.execute_proc(['virtualenv', venv], state, sudo=sudo)
+                stat_cache(state).invalidate(venv)
+
+        if not wheelhouse:
+            for package in packages:
+                self.execute_proc([pip, 'install', package], state,
+                                  sudo=sudo)
+            return
+
+        install = [pip, 'install', '--no-index', '--find-links', wheelhouse]
+        try:
+            self.execute_proc(install + packages, state, sudo=sudo)
+        except ApplyTimeout:
+            raise
+        except ApplyError:
+            # Some wheels are missing; this is the only step that needs
+            # the index.
+            if not stat_cache(state).exists(wheelhouse):
+                stat_cache(state).makedirs(wheelhouse)
+            self.execute_proc(
+                [pip, 'wheel', '--wheel-dir', wheelhouse, '--find-links',
+                 wheelhouse] + packages, state, sudo=sudo)
+            self.execute_proc(install + packages, state, sudo=sudo)
 
 
 class ShellPlugin(Plugin):
@@ -150,12 +381,7 @@ class ShellPlugin(Plugin):
 
     def run(self, arguments, state):
         assert len(arguments) == 1
-        old_pwd = os.getcwdu()
-        os.chdir(self.basedir)
-        try:
-            self.execute_proc(arguments[0], shell=True)
-        finally:
-            os.chdir(old_pwd)
+        self.execute_proc(arguments[0], state, shell=True, cwd=self.basedir)
 
 
 class LinkPlugin(Plugin):
@@ -165,10 +391,15 @@ class LinkPlugin(Plugin):
     name = 'link'
 
     def run(self, arguments, state):
-        return self.execute_impl([self.basedir] + arguments)
+        return self.execute_impl([self.basedir] + arguments, state)
+
+    def sources(self, arguments):
+        src = arguments[1] if arguments[0] == '-f' else arguments[0]
+        return [path.join(self.basedir, path.expanduser(src))]
 
     @classmethod
-    def impl(cls, arguments):
+    def impl(cls, arguments, fs=None):
+        fs = fs or StatCache()
         basedir = arguments.pop(0)
 
         force = False
@@ -182,24 +413,400 @@ class LinkPlugin(Plugin):
         link = path.relpath(src, path.dirname(dst))
         cls.log('link %s -> %s' % (link, dst))
         # Maybe delete an existing target
-        if path.exists(dst):
+        if fs.exists(dst):
             if force:
-                os.unlink(dst)
+                fs.unlink(dst)
             else:
                 # If the link already exists and points to the correct file, just move on
-                if path.islink(dst) and path.normpath(
-                    path.join(path.dirname(dst), os.readlink(dst))) ==\
+                if fs.islink(dst) and path.normpath(
+                    path.join(path.dirname(dst), fs.readlink(dst))) ==\
                                         path.normpath(src):
                     return
             # Create directories as necessary
+        if not fs.exists(path.dirname(dst)):
+            fs.makedirs(path.dirname(dst))
+
+        try:
+            fs.symlink(link, dst)
+        except OSError, e:
+            bus.emit(Message('%s' % e))
+            return 1
+
+
+class FetchPlugin(Plugin):
+    """Download a file, going through the local download cache.
+    """
+
+    name = 'fetch'
+
+    def run(self, arguments, state):
+        if state.get('prefetcher') and len(arguments) >= 2:
+            state['prefetcher'].claim((self.name, arguments[-2]))
+        return self.execute_impl([self.basedir] + arguments, state)
+
+    def sources(self, arguments):
+        return [url[len('file://'):] for url in arguments[-2:-1]
+                if url.startswith('file://')]
+
+    def prefetch(self, arguments, prefetcher, state):
+        # Download into the cache; the command then copies from there.
+        if len(arguments) < 2:
+            return
+        from .cache import DownloadCache
+        sha256 = arguments[1] if arguments[0] == '--sha256' else None
+        url = arguments[-2]
+        prefetcher.submit((self.name, url),
+                          lambda: DownloadCache().get(url, sha256))
+
+    @classmethod
+    def impl(cls, arguments, fs=None):
+        from .cache import DownloadCache, CacheError, file_sha256
+        basedir = arguments.pop(0)
+
+        sha256 = None
+        if arguments and arguments[0] == '--sha256':
+            if len(arguments) < 2:
+                raise ApplyError('--sha256 requires a value')
+            sha256 = arguments[1]
+            arguments = arguments[2:]
+
+        if len(arguments) != 2:
+            raise ApplyError('fetch needs an url and a destination')
+        url, dst = arguments
+        dst = path.join(basedir, path.expanduser(dst))
+        if dst.endswith(os.sep) or path.isdir(dst):
+            dst = path.join(dst, path.basename(url.rstrip('/')))
+
+        cls.log('fetch %s -> %s' % (url, dst))
+        try:
+            cached = DownloadCache().get(url, sha256)
+        except CacheError, e:
+            raise ApplyError('%s' % e)
+
+        # Only touch the destination if the content is different.
+        if path.exists(dst) and \
+                path.getsize(dst) == path.getsize(cached) and \
+                file_sha256(dst) == path.basename(cached):
+            return
+
+        try:
+            with open(cached, 'rb') as src:
+                write_atomically(dst, src)
+        finally:
+            if fs is not None:
+                fs.invalidate(dst)
+
+
+class GitPlugin(Plugin):
+    """Clone a git repository, or bring it up to date.
+
+    Whether a repository is at the wanted commit is read from its files,
+    without running git, so a repository pinned to a commit or tag that
+    is checked out already costs nothing. The others are cloned or
+    fetched. With a prefetcher, existing repositories are fetched in the
+    background, so that several of them are transferred at the same time.
+    """
+
+    name = 'git'
+
+    OPTIONS = ('--ref', '--depth', '--reference')
+
+    def parse(self, arguments):
+        options = dict.fromkeys(self.OPTIONS)
+        arguments = list(arguments)
+        while arguments and arguments[0] in options:
+            if len(arguments) < 2:
+                raise ApplyError('%s requires a value' % arguments[0])
+            options[arguments[0]] = arguments[1]
+            arguments = arguments[2:]
+        if len(arguments) != 2:
+            raise ApplyError('git needs a repository url and a directory')
+        if options['--depth'] is not None and \
+                not options['--depth'].isdigit():
+            raise ApplyError('--depth must be a number')
+        # It would be taken for a branch, which the remote does not have
+        from .gitrepo import is_short_sha
+        if is_short_sha(options['--ref']):
+            raise ApplyError('--ref %s looks like an abbreviated commit id, '
+                             'give all 40 characters' % options['--ref'])
+        if options['--reference']:
+            options['--reference'] = path.join(
+                self.basedir, path.expanduser(options['--reference']))
+        url, directory = arguments
+        return options, url, path.join(self.basedir,
+                                       path.expanduser(directory))
+
+    def transfer(self, options, url, worktree):
+        """Return the git command that clones or fetches ``worktree``, or
+        ``None`` if it is at the wanted commit already.
+        """
+        from .gitrepo import find_git_dir, read_head, tag_commit, is_sha
+        ref = options['--ref']
+        shallow = ['--depth', options['--depth']] if options['--depth'] \
+            else []
+        gitdir = find_git_dir(worktree)
+        if gitdir is None:
+            cmdline = ['git', 'clone'] + shallow
+            if options['--reference']:
+                cmdline += ['--reference', options['--reference']]
+            if ref and not is_sha(ref):
+                cmdline += ['--branch', ref]
+            return cmdline + ['--', url, worktree]
+
+        head = read_head(gitdir)[1]
+        fetch = ['git', '-C', worktree, 'fetch'] + shallow
+        if is_sha(ref):
+            return None if head == ref else fetch + ['--tags', 'origin']
+        if ref and head is not None and tag_commit(gitdir, ref) == head:
+            return None
+        # A branch may have moved; only the remote knows
+        if ref:
+            return fetch + ['--tags', 'origin', ref]
+        return fetch + ['origin', 'HEAD']
+
+    def update(self, options, worktree, state):
+        """Check out what was cloned or fetched."""
+        from .gitrepo import find_git_dir, read_ref, read_head, \
+            read_fetch_head, is_sha
+        ref = options['--ref']
+        gitdir = find_git_dir(worktree)
+        if gitdir is None:
+            raise ApplyError('%s is not a git repository' % worktree)
+        git = lambda *args: self.execute_proc(
+            ['git', '-C', worktree] + list(args), state)
+        branch, head = read_head(gitdir)
+        if is_sha(ref):
+            if head != ref:
+                git('checkout', '-q', '--detach', ref)
+            return
+
+        fetched = read_fetch_head(gitdir)
+        if fetched is None:
+            # Just cloned
+            return
+        sha, kind = fetched
+        if kind == 'tag' or (not ref and not branch):
+            if sha != head:
+                git('checkout', '-q', '--detach', sha)
+        elif ref and branch != ref:
+            if read_ref(gitdir, 'refs/heads/%s' % ref) is None:
+                git('checkout', '-q', '-b', ref, sha)
+                return
+            git('checkout', '-q', ref)
+            git('merge', '-q', '--ff-only', sha)
+        elif sha != head:
+            git('merge', '-q', '--ff-only', sha)
+
+    def run(self, arguments, state):
+        options, url, worktree = self.parse(arguments)
+        prefetcher = state.get('prefetcher')
+        if not prefetcher or not prefetcher.claim((self.name, worktree)):
+            cmdline = self.transfer(options, url, worktree)
+            if cmdline is None:
+                self.log('%s is up to date' % worktree)
+                return
+            self.execute_proc(cmdline, state, cwd=self.basedir)
+        try:
+            self.update(options, worktree, state)
+        finally:
+            stat_cache(state).invalidate(worktree)
+
+    def prefetch(self, arguments, prefetcher, state):
+        try:
+            options, url, worktree = self.parse(arguments)
+        except ApplyError:
+            return
+        # Only fetches into repositories that exist. A clone creates the
+        # directory, which the guards of the command may test; it waits
+        # for the command to run, after them.
+        cmdline = self.transfer(options, url, worktree)
+        if cmdline is None or cmdline[1] == 'clone':
+            return
+        # Nobody would see a password prompt
+        env = dict(os.environ, GIT_TERMINAL_PROMPT='0')
+        timeout = state.get('timeout')
+        prefetcher.submit((self.name, worktree),
+                          lambda: self.execute_quietly(
+                              cmdline, timeout, cwd=self.basedir, env=env))
+
+
+def write_atomically(dst, src):
+    """Replace ``dst`` with the content of the file object ``src``, such
+    that ``dst`` never has partial content. Keeps the mode of ``dst``.
+    """
+    if not path.exists(path.dirname(dst)):
+        os.makedirs(path.dirname(dst))
+    fd, tmpname = tempfile.mkstemp(dir=path.dirname(dst), prefix='.wsconfig-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(src, f)
+        if path.exists(dst):
+            shutil.copymode(dst, tmpname)
+        else:
+            os.chmod(tmpname, 0644)
+        os.rename(tmpname, dst)
+    except:
+        if path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+
+class TemplatePlugin(Plugin):
+    """Render a file, replacing the variables in it, and write it to the
+    destination, but only if the content is different.
+    """
+
+    name = 'template'
+
+    def paths(self, arguments):
+        if len(arguments) != 2:
+            raise ApplyError('template needs a source and a destination')
+        src, dst = [path.join(self.basedir, path.expanduser(arg))
+                    for arg in arguments]
+        if dst.endswith(os.sep) or path.isdir(dst):
+            dst = path.join(dst, path.basename(src))
+        return src, dst
+
+    def sources(self, arguments):
+        return self.paths(arguments)[:1]
+
+    def variables(self, arguments):
+        try:
+            with open(self.paths(arguments)[0], 'rb') as f:
+                return variable_re.findall(f.read())
+        except (IOError, ApplyError):
+            return []
+
+    def run(self, arguments, state):
+        src, dst = self.paths(arguments)
+        try:
+            with open(src, 'rb') as f:
+                template = f.read()
+        except IOError, e:
+            raise ApplyError('Cannot read template: %s' % e)
+        variables = state['variables']
+        content = variable_re.sub(
+            lambda m: variables.get(m.group(1), m.group(1)), template)
+
+        self.log('template %s -> %s' % (src, dst))
+        if 'content_manifest' not in state:
+            from .cache import ContentManifest
+            state['content_manifest'] = ContentManifest()
+        manifest = state['content_manifest']
+        changed = not manifest.matches(dst, content)
+        if changed:
+            if self.sudo:
+                # Pass the rendered content to the privileged process
+                fd, tmpname = tempfile.mkstemp(prefix='wsconfig-template-')
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(content)
+                    self.execute_impl([tmpname, dst], state)
+                finally:
+                    os.unlink(tmpname)
+            else:
+                write_atomically(dst, StringIO(content))
+                stat_cache(state).invalidate(dst)
+            manifest.record(dst, content)
+        bus.emit(FileUpdate(dst, changed))
+
+    @classmethod
+    def impl(cls, arguments, fs=None):
+        src, dst = arguments
+        with open(src, 'rb') as f:
+            write_atomically(dst, f)
+
+
+class SyncPlugin(Plugin):
+    """Copy a file or directory, skipping files that are up to date.
+    """
+
+    name = 'sync'
+
+    def run(self, arguments, state):
+        return self.execute_impl([self.basedir] + arguments, state)
+
+    def sources(self, arguments):
+        arguments = [arg for arg in arguments if not arg.startswith('--')]
+        return [path.join(self.basedir, path.expanduser(arguments[0]))] \
+            if len(arguments) == 2 else []
+
+    @classmethod
+    def impl(cls, arguments, fs=None):
+        basedir = arguments.pop(0)
+        options = set(arg for arg in arguments if arg.startswith('--'))
+        arguments = [arg for arg in arguments if not arg.startswith('--')]
+        if options - set(['--delete', '--checksum']):
+            raise ApplyError('Unknown options: %s' % ', '.join(
+                sorted(options - set(['--delete', '--checksum']))))
+        if len(arguments) != 2:
+            raise ApplyError('sync needs a source and a destination')
+
+        src, dst = [path.join(basedir, path.expanduser(arg))
+                    for arg in arguments]
+        if dst.endswith(os.sep) or \
+                (path.isdir(dst) and not path.isdir(src)):
+            dst = path.join(dst, path.basename(src.rstrip(os.sep)))
+        src, dst = src.rstrip(os.sep), dst.rstrip(os.sep)
         if not path.exists(path.dirname(dst)):
             os.makedirs(path.dirname(dst))
 
+        from .cache import ContentManifest
+        from .sync import sync as sync_tree
+        cls.log('sync %s -> %s' % (src, dst))
+        manifest = ContentManifest() if '--checksum' in options else None
+        try:
+            changes = sync_tree(src, dst, delete='--delete' in options,
+                           manifest=manifest)
+        except (OSError, IOError), e:
+            raise ApplyError('%s' % e)
+        finally:
+            if manifest is not None:
+                manifest.save()
+            if fs is not None:
+                fs.invalidate(dst)
+        for action, filename in changes:
+            bus.emit(FileUpdate(filename, True))
+
+
+class LinkTreePlugin(Plugin):
+    """Link the entries of a directory into another one, with as few
+    symbolic links as possible.
+    """
+
+    name = 'linktree'
+
+    def run(self, arguments, state):
+        return self.execute_impl([self.basedir] + arguments, state)
+
+    def sources(self, arguments):
+        return [path.join(self.basedir, path.expanduser(arguments[0]))] \
+            if len(arguments) == 2 else []
+
+    @classmethod
+    def impl(cls, arguments, fs=None):
+        basedir = arguments.pop(0)
+        if len(arguments) != 2:
+            raise ApplyError('linktree needs a source and a destination')
+        src, dst = [path.join(basedir, path.expanduser(arg)).rstrip(os.sep)
+                    for arg in arguments]
+        if not path.isdir(src):
+            raise ApplyError('%s is not a directory' % src)
+
+        from .linktree import link_tree, LinkManifest, LinkConflict
+        cls.log('linktree %s -> %s' % (src, dst))
+        manifest = LinkManifest()
         try:
-            os.symlink(link, dst)
+            changes = link_tree(src, dst, fs=fs or StatCache(),
+                                manifest=manifest)
+        except LinkConflict, e:
+            raise ApplyError('Cannot link %s: %s' % (src, e))
         except OSError, e:
-            print e
-            return 1
+            raise ApplyError('%s' % e)
+        finally:
+            manifest.save()
+        for action, filename in changes:
+            bus.emit(FileUpdate(filename, True))
 
 
 class EnsureLinePlugin(Plugin):
@@ -213,15 +820,20 @@ class EnsureLinePlugin(Plugin):
             raise ValueError('Need exactly two arguments')
 
         filename, line =  arguments
-        self.execute_impl([path.join(self.basedir, path.expanduser(filename)), line])
+        self.execute_impl(
+            [path.join(self.basedir, path.expanduser(filename)), line], state)
 
     @classmethod
-    def impl(cls, arguments):
+    def impl(cls, arguments, fs=None):
         filename, line =  arguments
-        with open(filename, 'a+') as f:
-            f.seek(0)
-            if not line in map(lambda s: s.rstrip('\n\r'), f.readlines()):
-                f.write('%s\n' % line)
+        fs = fs or StatCache()
+        try:
+            content = fs.backend.read(filename)
+        except IOError:
+            content = ''
+        if not line in content.splitlines():
+            fs.backend.append(filename, '%s\n' % line)
+        fs.invalidate(filename)
 
 
 class MkdirPlugin(Plugin):
@@ -231,18 +843,19 @@ class MkdirPlugin(Plugin):
     name = 'mkdir'
 
     def run(self, arguments, state):
+        fs = stat_cache(state)
         for dir in arguments:
             abspath = path.join(self.basedir, path.expanduser(dir))
-            if not path.exists(abspath):
+            if not fs.exists(abspath):
                 self.log('mkdir %s' % abspath)
-                self.execute_impl([abspath])
+                self.execute_impl([abspath], state)
             else:
                 self.log('%s exists' % abspath)
 
     @classmethod
-    def impl(cls, arguments):
+    def impl(cls, arguments, fs=None):
         assert len(arguments) == 1
-        os.makedirs(arguments[0])
+        (fs or StatCache()).makedirs(arguments[0])
 
 
 class RemindPlugin(Plugin):
@@ -253,14 +866,241 @@ class RemindPlugin(Plugin):
 
     @classmethod
     def post_apply_handler(cls, state):
-        print ""
-        print "ATTENTION! Do not forget to: "
-        for reminder in state[cls]['reminders']:
-            print " *", reminder
-        print ""
+        bus.emit(Reminders(state[cls]['reminders']))
 
     def run(self, arguments, state):
         state.setdefault(self.__class__, {'reminders': []})
         state[self.__class__]['reminders'].append(' '.join(arguments))
         if not RemindPlugin.post_apply_handler in state['post_apply']:
             state['post_apply'].append(RemindPlugin.post_apply_handler)
+
+
+class ServicePlugin(Plugin):
+    """Enable and start systemd units, unless they already are.
+
+    The state of all units that ``service`` commands in the run name is
+    read with a single ``systemctl show``, the first time one runs.
+    """
+
+    name = 'service'
+    sudo = True
+
+    # Unit file states in which there is nothing to enable
+    ENABLED = ('enabled', 'enabled-runtime', 'static', 'generated',
+               'indirect', 'alias', 'transient')
+    # Active states in which there is nothing to start
+    ACTIVE = ('active', 'activating', 'reloading')
+    # Unit types, which end the name of a unit
+    TYPES = ('service', 'socket', 'device', 'mount', 'automount', 'swap',
+             'target', 'path', 'timer', 'slice', 'scope')
+
+    def parse(self, arguments):
+        options = set(arg for arg in arguments if arg.startswith('--'))
+        units = [arg for arg in arguments if not arg.startswith('--')]
+        if options - set(['--enable', '--start']):
+            raise ApplyError('Unknown options: %s' % ', '.join(
+                sorted(options - set(['--enable', '--start']))))
+        if not units:
+            raise ApplyError('service needs a unit')
+        # Without options, do both
+        options = options or set(['--enable', '--start'])
+        return '--enable' in options, '--start' in options, units
+
+    @classmethod
+    def full_name(cls, unit):
+        """Add ``.service`` to a unit name without a type, as systemctl
+        does.
+        """
+        if unit.rpartition('.')[2] in cls.TYPES:
+            return unit
+        return unit + '.service'
+
+    def units(self, state):
+        return state.setdefault(self.__class__, {
+            'wanted': [], 'snapshot': None})
+
+    def prepare(self, arguments, state):
+        try:
+            units = self.parse(arguments)[2]
+        except ApplyError:
+            return
+        self.units(state)['wanted'].extend(units)
+
+    def snapshot(self, units, state):
+        """Return the unit file state and active state of the units in
+        the run, by unit name.
+        """
+        data = self.units(state)
+        if data['snapshot'] is not None and \
+                all(unit in data['snapshot'] for unit in units):
+            return data['snapshot']
+        names = []
+        for unit in data['wanted'] + units:
+            if unit not in names:
+                names.append(unit)
+        text = self.execute_output(
+            ['systemctl', 'show',
+             '--property=Id,Names,UnitFileState,ActiveState', '--'] + names,
+            state, sudo=False)
+        # One block of properties per unit it could load. A unit is
+        # known by its full name and its aliases, rather than by what
+        # was given; units without a block have no state.
+        states = {}
+        for block in text.strip().split('\n\n'):
+            properties = dict(line.split('=', 1) for line in
+                              block.splitlines() if '=' in line)
+            for unit in [properties.get('Id', '')] + \
+                    properties.get('Names', '').split():
+                states[unit] = (properties.get('UnitFileState', ''),
+                                properties.get('ActiveState', ''))
+        snapshot = {}
+        for name in names:
+            snapshot[name] = states.get(name) or \
+                states.get(self.full_name(name), ('', ''))
+        data['snapshot'] = snapshot
+        return snapshot
+
+    def run(self, arguments, state):
+        enable, start, units = self.parse(arguments)
+        snapshot = self.snapshot(units, state)
+        missing = ('', '')
+        to_enable = [unit for unit in units if enable and
+                     snapshot.get(unit, missing)[0] not in self.ENABLED]
+        to_start = [unit for unit in units if start and
+                    snapshot.get(unit, missing)[1] not in self.ACTIVE]
+        if to_enable:
+            self.execute_proc(['systemctl', 'enable', '--'] + to_enable,
+                              state)
+        if to_start:
+            self.execute_proc(['systemctl', 'start', '--'] + to_start,
+                              state)
+        for unit in units:
+            if unit not in to_enable + to_start:
+                self.log('%s is up to date' % unit)
+            file_state, active_state = snapshot.get(unit, missing)
+            snapshot[unit] = ('enabled' if unit in to_enable else file_state,
+                              'active' if unit in to_start else active_state)
+
+
+class SettingPlugin(Plugin):
+    """Change a desktop setting, like ``gconftool-2 -s`` or ``defaults
+    write`` would, unless it already has the value.
+
+    The store is chosen by the ``sys:*`` tags of the run, or given with
+    ``--store``. All keys of a store that the run refers to are read at
+    once. The values that change are written together when the next
+    command of another plugin runs, or the run ends; only then do the
+    commands complete, so that a checkpoint lists those that did write.
+    """
+
+    name = 'setting'
+    batched = True
+
+    # Store for systems with these tags, tried in order
+    DEFAULT_STORES = [('sys:macos', 'defaults'), ('sys:linux', 'dconf')]
+
+    def parse(self, arguments, state):
+        from .settings import STORES, TYPES
+        store = None
+        if arguments[:1] == ['--store']:
+            if len(arguments) < 2 or arguments[1] not in STORES:
+                raise ApplyError('--store must be one of: %s' % ', '.join(
+                    sorted(STORES)))
+            store, arguments = arguments[1], arguments[2:]
+        if len(arguments) != 3:
+            raise ApplyError('setting needs a key, a type and a value')
+        key, type, value = arguments
+        if type not in TYPES:
+            raise ApplyError('The type must be one of: %s' % ', '.join(TYPES))
+        if store is None:
+            tags = state.get('tags', ())
+            for tag, name in self.DEFAULT_STORES:
+                if tag in tags:
+                    store = name
+                    break
+            else:
+                raise ApplyError('No settings store for this system, '
+                                 'use --store')
+        return self.store(store, state), key, type, value
+
+    def store(self, name, state):
+        from .settings import STORES
+        stores = state.setdefault(self.__class__, {})
+        if name not in stores:
+            stores[name] = STORES[name](
+                lambda cmdline, input=None: self.execute_output(
+                    cmdline, state, input=input))
+        return stores[name]
+
+    def prepare(self, arguments, state):
+        try:
+            store, key, type, value = self.parse(arguments, state)
+        except ApplyError:
+            return
+        store.want(key)
+
+    def run(self, arguments, state):
+        from .settings import SettingsError
+        store, key, type, value = self.parse(arguments, state)
+        try:
+            changed = store.set(key, type, value)
+        except SettingsError, e:
+            raise ApplyError('%s' % e)
+        self.log('%s %s %s' % (
+            key, 'set to' if changed else 'already is', value))
+
+    def flush(self, state):
+        from .settings import SettingsError
+        for name, store in sorted(state.get(self.__class__, {}).items()):
+            try:
+                store.flush()
+            except SettingsError, e:
+                raise ApplyError('%s' % e)
+
+
+class TimeoutPlugin(Plugin):
+    """Limit how long external commands may run.
+
+    ``timeout SECONDS`` applies to all commands that follow,
+    ``timeout SECONDS PLUGIN...`` to those of the given plugins, and
+    ``timeout --next SECONDS`` to the next command only.
+
+    Like ``define``, these take effect as the document is traversed (see
+    ``update``), also where the command itself is skipped, because it
+    completed before or was filtered. Running it only checks it.
+    """
+
+    name = 'timeout'
+
+    def parse(self, arguments):
+        next_only = arguments[:1] == ['--next']
+        if next_only:
+            arguments = arguments[1:]
+        try:
+            seconds = float(arguments[0])
+        except (IndexError, ValueError):
+            raise ApplyError('timeout requires a number of seconds')
+        return next_only, seconds, arguments[1:]
+
+    def update(self, arguments, timeouts):
+        """Apply the command to ``timeouts``, a dict of plugin name (or
+        ``None`` for all) -> seconds. Returns the timeout of the next
+        command, if that is all it sets.
+        """
+        next_only, seconds, plugins = self.parse(arguments)
+        if next_only:
+            return seconds
+        for plugin in plugins or [None]:
+            timeouts[plugin] = seconds
+        return None
+
+    def run(self, arguments, state):
+        self.parse(arguments)
+
+
+def command_timeout(command, timeouts):
+    """Return the timeout that applies to ``command`` (a node whose
+    plugin is set) given ``timeouts`` (see ``TimeoutPlugin.update``), or
+    ``None``.
+    """
+    return timeouts.get(command.plugin.name, timeouts.get(None))
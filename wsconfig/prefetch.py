@@ -0,0 +1,114 @@
+"""Do the slow, side-effect free part of upcoming commands in the
+background, while earlier commands run.
+
+Before an apply starts, every command that will run is given the chance
+to submit jobs (see ``Plugin.prefetch``); ``dpkg`` for example downloads
+its packages. A fixed number of threads work through these jobs in the
+order they were submitted. When a command then runs, it ``claim``s its
+job: if it did not start yet, it is cancelled, and if it is running, the
+command waits for it to finish.
+
+Jobs that must not run at the same time as each other, or as the
+foreground command (apt holds a lock on its archive directory), can
+share a named lock.
+"""
+
+import threading
+import Queue
+
+
+__all__ = ('Prefetcher',)
+
+
+class Job(object):
+
+    def __init__(self, key, func, lock):
+        self.key = key
+        self.func = func
+        self.lock = lock
+        self.started = False
+        self.cancelled = False
+        self.error = None
+        self.finished = threading.Event()
+
+
+class Prefetcher(object):
+
+    def __init__(self, jobs=2):
+        self.queue = Queue.Queue()
+        self.jobs = {}
+        self.locks = {}
+        self.mutex = threading.Lock()
+        self.threads = []
+        for i in range(jobs):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def lock(self, name):
+        """Return the lock called ``name``."""
+        with self.mutex:
+            return self.locks.setdefault(name, threading.Lock())
+
+    def submit(self, key, func, lock=None):
+        """Run ``func`` in the background, unless a job with the same
+        ``key`` was already submitted. If ``lock`` is given, the job
+        holds the lock of that name while it runs.
+        """
+        with self.mutex:
+            if key in self.jobs:
+                return
+            job = self.jobs[key] = Job(key, func, lock)
+        self.queue.put(job)
+
+    def claim(self, key):
+        """The foreground is about to do what the job ``key`` prepares.
+
+        Cancels the job if it has not started, or waits for it to finish
+        if it has. Returns ``True`` if the job completed successfully.
+        """
+        with self.mutex:
+            job = self.jobs.get(key)
+            if job is None:
+                return False
+            if not job.started:
+                job.cancelled = True
+                return False
+        job.finished.wait()
+        return job.error is None
+
+    def shutdown(self):
+        """Cancel all jobs that have not started, and wait for the
+        running ones.
+        """
+        with self.mutex:
+            for job in self.jobs.values():
+                if not job.started:
+                    job.cancelled = True
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            with self.mutex:
+                if job.cancelled:
+                    continue
+                job.started = True
+            try:
+                if job.lock:
+                    with self.lock(job.lock):
+                        job.func()
+                else:
+                    job.func()
+            except Exception, e:
+                # Prefetching is an optimization only; the command
+                # itself will run into the same problem and report it.
+                job.error = e
+            finally:
+                job.finished.set()
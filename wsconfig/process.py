@@ -0,0 +1,156 @@
+"""Run external commands such that they can be stopped as a whole.
+
+Every command runs in a process group of its own. If it takes too long,
+or the user presses Ctrl-C, the whole group is terminated - including
+whatever the command itself started - rather than leaving processes
+behind.
+
+While a command runs, its group is given the terminal, so that it can
+still ask for input (like ``sudo`` does for passwords). Ctrl-C is then
+delivered to the command rather than to us; when the command dies from
+it, ``wait`` raises ``KeyboardInterrupt`` on its behalf.
+
+Commands started in the background, from other threads, use
+``spawn_background`` instead: they never get the terminal, and no Python
+code of ours runs in the forked child.
+"""
+
+import os
+import sys
+import signal
+import threading
+import time
+from subprocess import Popen
+
+
+__all__ = ('spawn', 'spawn_background', 'wait', 'kill_group')
+
+
+# Seconds to give a process group to exit after SIGTERM, before SIGKILL
+KILL_GRACE = 5.0
+
+# Starts a session, and so a process group, then executes the command
+# given as arguments.
+DETACH = 'import os, sys; os.setsid(); os.execvp(sys.argv[1], sys.argv[1:])'
+
+
+def controlling_terminal():
+    """Return the file descriptor of the terminal we have in the
+    foreground, or ``None``.
+    """
+    # Changing signal handlers is only possible in the main thread.
+    if threading.current_thread().name != 'MainThread':
+        return None
+    try:
+        fd = sys.stdin.fileno()
+        if os.isatty(fd) and os.tcgetpgrp(fd) == os.getpgrp():
+            return fd
+    except (AttributeError, ValueError, OSError):
+        pass
+    return None
+
+
+def set_foreground(fd, pgrp):
+    # Unless ignored, SIGTTOU stops a background process that does this.
+    old = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+        os.tcsetpgrp(fd, pgrp)
+    except OSError:
+        pass
+    finally:
+        signal.signal(signal.SIGTTOU, old)
+
+
+def spawn(cmdline, *a, **kw):
+    """Like ``Popen``, but start the process in a new process group,
+    which has the terminal, if any.
+    """
+    terminal = controlling_terminal()
+
+    def preexec():
+        os.setpgrp()
+        if terminal is not None:
+            set_foreground(terminal, os.getpgrp())
+
+    kw['preexec_fn'] = preexec
+    process = Popen(cmdline, *a, **kw)
+    process.terminal = terminal
+    # Do the same here, as we do not know whether the child got to it yet.
+    try:
+        os.setpgid(process.pid, process.pid)
+    except OSError:
+        pass
+    if terminal is not None:
+        set_foreground(terminal, process.pid)
+    return process
+
+
+def spawn_background(cmdline, *a, **kw):
+    """Like ``spawn``, for commands started by another thread than the
+    main one, like the jobs of a ``Prefetcher``. The process gets a
+    session of its own, and with it a process group, but no terminal.
+
+    A ``preexec_fn`` is not safe to use while other threads run: it runs
+    in the forked child, where a lock another thread held at the time of
+    the fork (the import lock, say) is never released. Instead, the child
+    executes a new interpreter, which starts the session before it
+    executes the command.
+    """
+    if kw.pop('shell', False):
+        cmdline = ['/bin/sh', '-c', cmdline]
+    process = Popen([sys.executable, '-E', '-S', '-c', DETACH] +
+                    list(cmdline), *a, **kw)
+    process.terminal = None
+    return process
+
+
+def kill_group(process, grace=KILL_GRACE):
+    """Terminate the process group of ``process``, forcibly if it does
+    not exit within ``grace`` seconds.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+        return
+    deadline = time.time() + grace
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def wait(process, timeout=None):
+    """Wait for a process started by ``spawn``.
+
+    Returns ``True`` if it had to be killed because it did not finish
+    within ``timeout`` seconds.
+    """
+    timer = None
+    timed_out = []
+    if timeout:
+        def expire():
+            timed_out.append(True)
+            kill_group(process)
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+    try:
+        process.wait()
+    except KeyboardInterrupt:
+        kill_group(process)
+        process.wait()
+        raise
+    finally:
+        if timer:
+            timer.cancel()
+            if timed_out:
+                # Let it finish killing what is left of the group
+                timer.join()
+        if process.terminal is not None:
+            set_foreground(process.terminal, os.getpgrp())
+    if process.terminal is not None and process.returncode == -signal.SIGINT:
+        # Ctrl-C went to the process; the user meant to stop us.
+        raise KeyboardInterrupt()
+    return bool(timed_out)
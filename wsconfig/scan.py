@@ -0,0 +1,137 @@
+"""Find the selectors and ``define`` commands of a document, quickly.
+
+Listing the tags a document supports (``wsconfig file``, which shell
+completion runs on every TAB) only needs the selectors and the ``define``
+commands, which is what ``firstpass`` looks at. Instead of running the
+full grammar, this scans the document line by line, following the same
+rules the parser does to tell selectors, commands and shell blocks apart,
+and returns a tree that only contains ``Selector`` nodes and ``define``
+commands. PyParsing is not imported.
+
+If the scanner runs into something it does not understand, it raises a
+``ScanError``; the document should then go through the parser, which will
+report the problem properly.
+"""
+
+import re
+
+from .nodes import Command, And, Or, TagExpr, Selector
+
+
+__all__ = ('scan_file', 'scan_string', 'ScanError')
+
+
+class ScanError(Exception):
+    pass
+
+
+# A quoted string, matching what PyParsing's ``quotedString`` does
+QUOTED = r'''"(?:[^"\n\r\\]|(?:"")|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*"|''' \
+         r"""'(?:[^'\n\r\\]|(?:'')|(?:\\(?:[^x]|x[0-9a-fA-F]+)))*'"""
+
+# The next token of a command line, after spaces: a comment, which runs to
+# the end of the line, a quoted string, or a word.
+token_re = re.compile(r'[ \t]*(?:(#[^\n]*)|(%s)|([^\s{}]+))' % QUOTED)
+
+spaces_re = re.compile(r'[ \t]*')
+
+# Whitespace and comments between items
+skip_re = re.compile(r'(?:\s+|#[^\n]*)*')
+
+# The rest of a single line shell command
+shell_re = re.compile(r'[^\n}]*')
+
+# A command name; what follows it directly is the first argument
+name_re = re.compile(r'[A-Za-z][A-Za-z0-9_]*')
+
+tag_re = re.compile(r'!?[A-Za-z][A-Za-z0-9:._-]*$')
+
+
+def column(s, pos):
+    """The 1-based column of ``pos``, as PyParsing's ``col()`` has it."""
+    return pos - s.rfind('\n', 0, pos)
+
+
+def parse_tagexpr(text):
+    ands = []
+    for part in text.split(','):
+        tags = part.split()
+        if not tags or not all(tag_re.match(tag) for tag in tags):
+            raise ScanError('Invalid tag expression: %s' % text.strip())
+        ands.append(And(tags))
+    return TagExpr(Or(ands))
+
+
+def scan_string(s):
+    """Return the selectors and ``define`` commands in ``s``, as a tree of
+    nodes like the parser produces.
+    """
+    # The items of the current selector, and those of its parents
+    stack = [(None, [])]
+    pos = 0
+    end = len(s)
+
+    while True:
+        pos = skip_re.match(s, pos).end()
+        if pos >= end:
+            break
+
+        if s[pos] == '}':
+            if len(stack) == 1:
+                raise ScanError('Unexpected "}" at line %d' % (
+                    s.count('\n', 0, pos) + 1))
+            tagexpr, items = stack.pop()
+            stack[-1][1].append(Selector(tagexpr, items))
+            pos += 1
+
+        elif s.startswith('$:', pos):
+            # A shell block continues on all lines indented further than
+            # the colon.
+            indent = column(s, pos + 1)
+            newline = s.find('\n', pos)
+            pos = end if newline == -1 else newline
+            while True:
+                next = skip_re.match(s, pos).end()
+                if next >= end or column(s, next) <= indent:
+                    break
+                newline = s.find('\n', next)
+                pos = end if newline == -1 else newline
+
+        elif s[pos] == '$':
+            pos = shell_re.match(s, pos).end()
+
+        else:
+            # A command, or a selector if a "{" follows on the same line
+            start = pos
+            argv = []
+            while True:
+                match = token_re.match(s, pos)
+                if not match:
+                    break
+                pos = match.end()
+                comment, quoted, word = match.groups()
+                if comment:
+                    break
+                argv.append(quoted[1:-1] if quoted else word)
+            pos = spaces_re.match(s, pos).end()
+            if s[pos:pos + 1] == '{':
+                stack.append((parse_tagexpr(s[start:pos]), []))
+                pos += 1
+            elif not argv:
+                raise ScanError('Unexpected "%s" at line %d' % (
+                    s[pos], s.count('\n', 0, pos) + 1))
+            else:
+                name = name_re.match(argv[0])
+                if name and name.group(0) == 'define':
+                    if name.end() < len(argv[0]):
+                        argv[:1] = ['define', argv[0][name.end():]]
+                    stack[-1][1].append(Command(argv))
+
+    if len(stack) > 1:
+        raise ScanError('Missing "}"')
+    return stack[0][1]
+
+
+def scan_file(filename):
+    with open(filename, 'rb') as f:
+        return scan_string(f.read())
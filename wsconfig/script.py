@@ -2,12 +2,21 @@
 
 import sys, os
 import re
+import time
 import platform
 from os import path
 import argparse
 
-from .plugins import Plugin, ApplyError
-from .parsing import parse_file, Selector, Command, Or, And
+from .plugins import (
+    Plugin, ApplyError, TimeoutPlugin, command_timeout, variable_re,
+    backend_of)
+from .fscache import StatCache
+from .events import (
+    bus, Message, RunStart, RunEnd, CommandStart, CommandEnd, CommandSkip,
+    CommandFail, Progress, JsonlWriter)
+from .nodes import Selector, Command, Or, And
+from .guards import GUARDS, check_guards
+from .filters import CommandIndex, FilterError, parse_names, parse_lines
 
 
 class ConfigError(Exception):
@@ -82,32 +91,53 @@ def init_env():
     return set(map(lambda tag: "sys:%s" % tag, tags))
 
 
-def validate(document, filename, plugins):
+def validate(document, filename, plugins, _instances=None, _index=None):
     """Validate ``document``, and resolve plugin references. This needs to
     run before a document can be applied.
 
-    Raises errors if invalid plugins are referenced.
+    Raises errors if invalid plugins are referenced. Returns a
+    ``CommandIndex`` of the commands in the document.
     """
     basedir = path.curdir \
         if not filename else path.abspath(path.dirname(filename))
 
+    # Plugins keep no per-command state, so commands that use the same
+    # plugin in the same way share an instance.
+    instances = {} if _instances is None else _instances
+    index = CommandIndex() if _index is None else _index
+
+    # Guards are attached to the command that follows them
+    guards = []
+
     for item in document:
+        if guards and not (isinstance(item, Command) and
+                           item.argv[0] != 'define'):
+            raise ConfigError('%s must be followed by a command' %
+                              guards[-1].argv[0])
+
         if isinstance(item, Command):
             # define behavior is hardcoded
             if item.argv[0] in ('define',):
                 item.plugin = None
                 continue
 
+            if item.argv[0] in GUARDS:
+                if item.argv[0] == 'creates' and len(item.args) != 1:
+                    raise ConfigError('creates takes exactly one path')
+                if item.argv[0] == 'unless' and not item.args:
+                    raise ConfigError('unless needs a command to run')
+                item.plugin = None
+                guards.append(item)
+                continue
+            item.guards = tuple(guards)
+            guards = []
+
             # Resolve a sudo in front of the command
             if item.argv[0] == 'sudo':
                 if len(item.argv) == 1:
                     raise ConfigError('sudo must be followed by a command')
-                item.command = item.argv[1]
-                item.args = item.argv[2:]
                 sudo = True
             else:
-                item.command = item.argv[0]
-                item.args = item.argv[1:]
                 sudo = None
 
             try:
@@ -115,10 +145,19 @@ def validate(document, filename, plugins):
             except KeyError:
                 raise ConfigError('"%s" not a valid plugin' % item.command)
             else:
-                item.plugin = plugin_class(basedir, sudo=sudo)
+                key = (plugin_class, sudo)
+                if key not in instances:
+                    instances[key] = plugin_class(basedir, sudo=sudo)
+                item.plugin = instances[key]
+            index.add(item)
 
         elif isinstance(item, Selector):
-            validate(item.items, filename, plugins)
+            validate(item.items, filename, plugins, instances, index)
+
+    if guards:
+        raise ConfigError('%s must be followed by a command' %
+                          guards[-1].argv[0])
+    return index
 
 
 def parse_tag(tag):
@@ -182,6 +221,9 @@ def traverse_document(document, tags):
                 if command.argv[0] == 'define':
                     tags.update(command.argv)
                     continue
+                # Guards are part of the command they guard
+                if command.argv[0] in GUARDS:
+                    continue
 
             yield selector, command, tags
 
@@ -253,8 +295,6 @@ def firstpass(document, init_tags):
     return discovered_tags
 
 
-variable_re = re.compile(r'(@@[\w]+@@)')
-
 def find_variables(document, tags):
     """Find all the variables (%%var%% syntax) used in the document,
     given the particular set of tags, return a set of all vars found.
@@ -264,48 +304,342 @@ def find_variables(document, tags):
         if not command:
             continue
 
-        for arg in command.args:
-            matches = variable_re.findall(arg)
-            vars_found |= set(matches)
+        for node in (command,) + getattr(command, 'guards', ()):
+            for arg in node.args:
+                vars_found |= set(variable_re.findall(arg))
+        # Like those in the files a ``template`` renders
+        if getattr(command, 'plugin', None):
+            vars_found |= set(command.plugin.variables(list(command.args)))
 
     return vars_found
 
 
-def apply_document(document, tags, state, dry_run=False):
+def substitute(args, variables):
+    """Replace the variables in ``args`` with their values. Variables
+    without a value are left as they are.
+    """
+    def replacer(match):
+        return variables.get(match.group(1), match.group(1))
+    return [variable_re.sub(replacer, arg) for arg in args]
+
+
+def ask_variables(document, tags, variables):
+    """Ask the user for the values of all variables used in ``document``
+    which are not yet in ``variables``.
+    """
+    used_variables = find_variables(document, tags) - set(variables)
+    if used_variables:
+        print "Please provide some values:"
+        for var in used_variables:
+            value = raw_input("  %s " % var)
+            variables[var] = value
+    return variables
+
+
+def ask_continue(error):
+    """Ask the user whether to continue after a command failed."""
+    while True:
+        yn = raw_input('Do you want to continue (y/n)? [y] ')
+        if not yn in ('y', 'n', ''):
+            continue
+        if yn == 'n':
+            sys.exit(1)
+        return True
+
+
+def apply_document(document, tags, state, dry_run=False, only=None,
+                   checkpoint=None, prefetcher=None, history=None,
+                   on_failure=ask_continue):
     """Run all the commands in ``document``, filtered by ``tags``.
 
     As the document is processed, runtime state can be kept
-    in ``state``.
-    """
-    def var_replacer(match):
-        return state['variables'][match.groups()[0]]
+    in ``state``. Plugins find ``tags`` there as well, and the ``timeout``
+    of the command that runs. The timeouts to start with are taken from
+    ``state['timeouts']`` (see ``TimeoutPlugin.update``), which
+    ``timeout`` commands in the document do not change.
 
-    for selector, command, tags in traverse_document(document, tags):
-        if command:
-            # Replace variables in the arguments
-            args = [
-                re.sub(variable_re, var_replacer, arg)
-                for arg in command.args
-            ]
+    If ``only`` is given, it is a set of command ids (as in ``id()``);
+    other commands are skipped. Tags they define still take effect.
+
+    If a ``checkpoint`` is given, commands it lists as completed are
+    skipped, and commands that complete are added to it. Commands of a
+    ``batched`` plugin complete when it flushes: before a command of
+    another plugin (or one with guards) runs, when a command fails, and
+    at the end of the run.
+
+    If a ``prefetcher`` is given, the commands that are going to run
+    can prepare themselves in the background.
+
+    If a ``History`` is given, the duration and outcome of the commands
+    are recorded in it, and it is used to report the progress of the run.
+
+    Commands whose guards (``creates``, ``unless``) say there is nothing
+    to do are skipped, also during a dry run.
+
+    When a command fails, ``on_failure`` is called with the error, and
+    returns whether to continue with the next command. By default, the
+    user is asked.
+    """
+    def resolve(command):
+        # Replace variables in the arguments
+        return substitute(command.args, state['variables'])
+
+    # File system lookups are cached for the duration of the run
+    state['stat_cache'] = StatCache(backend_of(state))
+    state['tags'] = tags
+
+    # Determine the commands to run, and their positions in the document.
+    # Timeouts are worked out along the way, like tags, such that skipping
+    # a command never changes the timeout of the ones after it.
+    planned = []
+    position = -1
+    timeouts = dict(state.get('timeouts', {}))
+    next_timeout = None
+    command_timeouts = {}
+    for selector, command, _ in traverse_document(document, tags):
+        if not command:
+            continue
+        position += 1
+        if isinstance(command.plugin, TimeoutPlugin):
+            try:
+                seconds = command.plugin.update(resolve(command), timeouts)
+            except ApplyError:
+                # Reported when the command runs
+                seconds = None
+            if seconds is not None:
+                next_timeout = seconds
+        else:
+            command_timeouts[position] = command_timeout(
+                command, timeouts) if next_timeout is None else next_timeout
+            next_timeout = None
+        if only is not None and id(command) not in only:
+            bus.emit(CommandSkip(
+                position, command, list(command.args), 0.0, 'filtered'))
+            continue
+        if checkpoint and position in checkpoint.completed:
+            bus.emit(CommandSkip(
+                position, command, list(command.args), 0.0, 'completed'))
+            continue
+        planned.append((position, command))
+
+    if not dry_run:
+        for position, command in planned:
+            command.plugin.prepare(resolve(command), state)
+
+    if prefetcher and not dry_run:
+        state['prefetcher'] = prefetcher
+        for position, command in planned:
+            state['timeout'] = command_timeouts.get(position)
+            command.plugin.prefetch(resolve(command), prefetcher, state)
+
+    # How long the commands took before. For those that never ran, guess
+    # they take as long as the average of the others.
+    estimates = None
+    if history and not dry_run:
+        estimates = history.estimates(planned)
+        known = [estimate for estimate in estimates if estimate is not None]
+        if known:
+            average = sum(known) / len(known)
+            estimates = [average if estimate is None else estimate
+                         for estimate in estimates]
+        else:
+            estimates = None
+
+    # Commands of a ``batched`` plugin that ran, but only complete when
+    # it flushes, as (position, command, args, duration) tuples
+    unflushed = []
+
+    def complete(position, command, args, duration):
+        bus.emit(CommandEnd(position, command, args, duration))
+        if history:
+            history.record(position, command, duration, 'ok')
+        if checkpoint:
+            checkpoint.done(position)
+
+    def flush():
+        # Completes the unflushed commands, or fails them. Returns the
+        # error, if any.
+        if not unflushed:
+            return None
+        batch = unflushed[:]
+        del unflushed[:]
+        started = time.time()
+        try:
+            for plugin in set(command.plugin for _, command, _, _ in batch):
+                plugin.flush(state)
+        except ApplyError, e:
+            duration = time.time() - started
+            for position, command, args, took in batch:
+                bus.emit(CommandFail(position, command, args,
+                                     took + duration, e, e.outcome))
+                if history:
+                    history.record(position, command, took + duration,
+                                   e.outcome)
+            bus.flush()
+            return e
+        duration = time.time() - started
+        for position, command, args, took in batch:
+            complete(position, command, args, took + duration)
+        return None
+
+    failed = False
+    run_started = time.time()
+    bus.emit(RunStart(len(planned)))
+    try:
+        for index, (position, command) in enumerate(planned):
+            args = resolve(command)
+            if history and not dry_run:
+                bus.emit(Progress(index, len(planned),
+                                  sum(estimates[index:]) if estimates
+                                  else None))
+
+            # Pending work is done before any other command, or guard,
+            # might depend on it
+            batching = unflushed and type(unflushed[0][1].plugin)
+            if batching and (type(command.plugin) is not batching or
+                             getattr(command, 'guards', None)):
+                error = flush()
+                if error:
+                    failed = True
+                    if not on_failure(error):
+                        break
+
+            state['timeout'] = command_timeouts.get(position)
+            if not dry_run:
+                command.plugin.backend = backend_of(state)
+            reason = check_guards(command, state, lambda args: substitute(
+                args, state['variables']))
+            if reason:
+                bus.emit(CommandSkip(position, command, args, 0.0, reason))
+                if checkpoint and not dry_run:
+                    checkpoint.done(position)
+                continue
 
             if dry_run:
-                print command
+                bus.emit(CommandSkip(position, command, args, 0.0, 'dry-run'))
                 continue
 
             # Run the plugin
+            bus.emit(CommandStart(position, command, args))
+            started = time.time()
             try:
                 result = command.plugin.run(args, state)
                 if result:
                     raise ApplyError('Plugin failed.')
             except ApplyError, e:
-                print "%s" % e
-                while True:
-                    yn = raw_input('Do you want to continue (y/n)? [y] ')
-                    if not yn in ('y', 'n', ''):
-                        continue
-                    if yn == 'n':
-                        sys.exit(1)
+                failed = True
+                duration = time.time() - started
+                # What ran before is done regardless
+                flush()
+                bus.emit(CommandFail(position, command, args, duration, e,
+                                     e.outcome))
+                if history:
+                    history.record(position, command, duration, e.outcome)
+                bus.flush()
+                if not on_failure(e):
                     break
+            else:
+                duration = time.time() - started
+                if command.plugin.batched:
+                    unflushed.append((position, command, args, duration))
+                else:
+                    complete(position, command, args, duration)
+        if flush():
+            failed = True
+    finally:
+        bus.emit(RunEnd(time.time() - run_started, failed))
+        if history:
+            history.commit()
+        if checkpoint:
+            checkpoint.close()
+        if state.pop('prefetcher', None):
+            prefetcher.shutdown()
+
+    # Keep the checkpoint if there were failures, so they can be retried.
+    if checkpoint and not failed and not dry_run:
+        checkpoint.finish()
+
+
+def run_apply(document, filename, source, tags, state, namespace,
+              index=None):
+    """Apply ``document``, read from ``filename`` (with content
+    ``source``), the way the command line options in ``namespace`` ask.
+    ``index`` is the ``CommandIndex`` of the document, for the options
+    that filter which commands run. Returns the exit code.
+    """
+    only = None
+    if namespace.only or namespace.skip or namespace.lines:
+        try:
+            only = (index or CommandIndex()).select(
+                namespace.only, namespace.skip, namespace.lines)
+        except FilterError as e:
+            print 'Error: %s' % e
+            return 1
+
+    # Keep track of the commands that completed, to be able to resume
+    checkpoint = None
+    if not namespace.dry_run:
+        from .checkpoint import Checkpoint
+        checkpoint = Checkpoint.for_document(
+            filename, source, tags, state['variables'],
+            resume=namespace.resume)
+        if namespace.resume:
+            bus.emit(Message('Resuming, skipping %d completed commands.' %
+                             len(checkpoint.completed)))
+
+    prefetcher = None
+    if namespace.prefetch_jobs:
+        from .prefetch import Prefetcher
+        prefetcher = Prefetcher(namespace.prefetch_jobs)
+
+    # Learn how long commands take, to tell how long the next run will
+    history = None
+    if not namespace.dry_run:
+        from .history import History
+        history = History(path.abspath(filename))
+
+    # Actually run all commands
+    apply_document(document, tags, state, dry_run=namespace.dry_run,
+                   only=only, checkpoint=checkpoint, prefetcher=prefetcher,
+                   history=history)
+
+    # Execute post apply handlers. Commands like ``remind`` set those up.
+    for callable in state['post_apply']:
+        callable(state)
+    bus.flush()
+    return 0
+
+
+def print_history(history):
+    print 'Slowest commands:'
+    for plugin, args, duration, runs in history.slowest():
+        print '  %7.1fs  %s %s  (%d runs)' % (
+            duration, plugin, ' '.join(args), runs)
+    print ''
+    print 'Most failures:'
+    for plugin, args, failures, runs in history.failing():
+        print '  %3d of %3d runs  %s %s' % (
+            failures, runs, plugin, ' '.join(args))
+
+
+def print_tags(found_tags):
+    print 'Optional tags for you to pass to apply:'
+    for tag in found_tags:
+        if tag[0].isupper():
+            print '  %s' % tag
+
+
+def events_stream():
+    """Return a stream on the original stdout, for JSON events only.
+
+    Everything else that would go to stdout - the output of commands,
+    which inherit it, prompts, and whatever else is printed - is sent to
+    stderr from now on, so that the events can still be parsed.
+    """
+    sys.stdout.flush()
+    stream = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return stream
 
 
 def main(argv):
@@ -330,7 +664,9 @@ def main(argv):
     #      in this scenario, as opposed to the approach now, where it is
     #      essential to run any command as root.
     if len(argv) > 1 and argv[1] == 'WSCONFIG_CALL_PLUGIN':
-        return plugins[argv[2]].impl(argv[3:])
+        # The cache of the user who runs wsconfig, not that of root
+        os.environ['WSCONFIG_CACHE'] = argv[2]
+        return plugins[argv[3]].impl(argv[4:])
 
     # It's amazing how very much this CLI interface is exactly how I wanted it,
     # after the amount of handwringing I did, thinking argparse couldn't do it
@@ -343,32 +679,114 @@ def main(argv):
     # is a bit better still:
     usage_string = '''
   %(prog)s --defaults
+  %(prog)s --validate file [file ...]
+  %(prog)s --history
   %(prog)s file
-  %(prog)s file apply [tags [tags ...]]'''
+  %(prog)s file apply [tags [tags ...]]
+  %(prog)s file watch [tags [tags ...]]
+  %(prog)s file matrix [--profile tags ...] [tags [tags ...]]
+  %(prog)s [-o plan.json] file plan [tags [tags ...]]
+  %(prog)s --apply-plan plan.json'''
 
     parser = argparse.ArgumentParser(usage=usage_string)
     parser.add_argument('--dry-run', action='store_true',
                         help='Show the commands that would be run.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an apply that was interrupted, '
+                             'skipping the commands that completed.')
+    parser.add_argument('--only', type=parse_names, metavar='PLUGINS',
+                        help='Only run the commands of these plugins, like '
+                             '"link,ensure_line".')
+    parser.add_argument('--skip', type=parse_names, metavar='PLUGINS',
+                        help='Do not run the commands of these plugins.')
+    parser.add_argument('--lines', type=parse_lines, metavar='RANGES',
+                        help='Only run the commands on these lines of the '
+                             'file, like "100-200" or "-50,300-".')
+    parser.add_argument('--prefetch-jobs', type=int, default=0, metavar='N',
+                        help='While commands run, download what upcoming '
+                             'commands need (like packages) in N background '
+                             'jobs. Requires sudo not to ask for a password.')
+    parser.add_argument('--timeout', type=float, metavar='SECONDS',
+                        help='Kill commands that run longer than this.')
+    parser.add_argument('--timeout-for', action='append', default=[],
+                        metavar='PLUGIN=SECONDS',
+                        help='Kill commands of the given plugin (like "dpkg" '
+                             'or "$") that run longer than this. Can be '
+                             'given multiple times.')
+    parser.add_argument('--log-format', choices=('human', 'jsonl'),
+                        default='human',
+                        help='Report progress for humans, or as one JSON '
+                             'object per line.')
+    parser.add_argument('--optimize', action='store_true',
+                        help='Remove the parts of the file that cannot run '
+                             'on this system before processing it, and '
+                             'report them.')
+    parser.add_argument('--profile', action='append', metavar='TAGS',
+                        help='With "matrix", a set of system tags, separated '
+                             'by whitespace, to evaluate the file for. Can be '
+                             'given multiple times. Defaults to the tags '
+                             'of this system. With "plan", the system tags '
+                             'of the host the plan is for.')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='With "plan", write the plan to this file '
+                             'rather than to stdout.')
     group = parser.add_argument_group(title='modes')
     group.add_argument('--defaults', action='store_true',
                         help='Show the system default tags')
+    group.add_argument('--validate', nargs='+', metavar='FILE',
+                        help='Check that the given files parse and only '
+                             'use known commands, in parallel, and report '
+                             'all errors.')
+    group.add_argument('--history', action='store_true',
+                        help='Show the commands that took longest, and '
+                             'those that failed most often, in past runs.')
+    group.add_argument('--jobs', type=int, metavar='N',
+                        help='Number of processes --validate uses. Defaults '
+                             'to the number of CPUs.')
+    group.add_argument('--apply-plan', metavar='FILE',
+                        help='Apply a plan written by "plan", rather than '
+                             'a config file.')
     group.add_argument('file',  nargs='?',
         help='The config file to use. If you only specify this, '
              'you will be given a list of tags that the file supports')
-    # Is rendered as {apply} in help text, which is I suppose good enough as
-    # an indication that it should be given as a literal string.
-    group.add_argument('apply', nargs='?', choices=('apply',),
+    # Is rendered as {apply,watch,matrix} in help text, which is I suppose
+    # good enough as an indication that it should be given as a literal string.
+    group.add_argument('action', nargs='?',
+        choices=('apply', 'watch', 'matrix', 'plan'),
         help='Specify the keyword "apply" to actually run the '+
-             'commands in the given file')
+             'commands in the given file, or "watch" to run them, and '+
+             'then again whenever the file changes. "matrix" shows the '+
+             'commands that would run for every combination of tags. '+
+             '"plan" writes the commands that would run, to apply '+
+             'them elsewhere')
     group.add_argument('tags', nargs='*',
         help='Define these tags when applying the config file')
 
     namespace = parser.parse_args(argv[1:])
-    if not (bool(namespace.defaults) != bool(namespace.file)):
-        print 'Error: Either specify --defaults, or a file to process.'
+    modes = [namespace.defaults, namespace.validate, namespace.history,
+             namespace.apply_plan, namespace.file]
+    if len(filter(bool, modes)) != 1:
+        print 'Error: Either specify --defaults, --validate, --history, ' \
+              '--apply-plan, or a file to process.'
         parser.print_help()
         return 1
 
+    if namespace.log_format == 'jsonl':
+        bus.handlers[:] = [JsonlWriter(events_stream())]
+
+    # Timeouts per plugin name, ``None`` being the default. The document
+    # can change them with the ``timeout`` command.
+    timeouts = {None: namespace.timeout}
+    for option in namespace.timeout_for:
+        plugin, _, seconds = option.rpartition('=')
+        try:
+            if not plugin:
+                raise ValueError(option)
+            timeouts[plugin] = float(seconds)
+        except ValueError:
+            print 'Error: Invalid --timeout-for: %s' % option
+            return 1
+
     # Get the tags that are defined by default
     tags = init_env()
 
@@ -377,11 +795,84 @@ def main(argv):
             print tag
         return 0
 
-    # Parse the configuration file
-    document = parse_file(namespace.file)
+    if namespace.history:
+        from .history import History
+        print_history(History())
+        return 0
+
+    if namespace.validate:
+        from .batch import check_files
+        failed = 0
+        for filename, error, _ in check_files(
+                namespace.validate, tags, namespace.jobs):
+            if error:
+                failed += 1
+                print 'FAIL %s: %s' % (filename, error)
+            else:
+                print 'OK   %s' % filename
+        print '%d of %d files failed validation.' % (
+            failed, len(namespace.validate))
+        return 1 if failed else 0
+
+    if namespace.apply_plan:
+        from .plan import load_plan
+        document, tags, variables = load_plan(namespace.apply_plan, plugins)
+        with open(namespace.apply_plan, 'rb') as f:
+            source = f.read()
+        state = {'post_apply': [], 'variables': variables,
+                 'timeouts': timeouts}
+        return run_apply(document, namespace.apply_plan, source, tags,
+                         state, namespace, CommandIndex(document))
+
+    # A plan is for the host given by --profile, if any
+    if namespace.action == 'plan' and namespace.profile:
+        tags = set(' '.join(namespace.profile).split())
+
+    # To list the tags, only the selectors are needed, which the scanner
+    # finds without parsing the whole file. If it fails, the parser will
+    # tell the user what is wrong.
+    if not namespace.action and not namespace.optimize:
+        from .scan import scan_file, ScanError
+        try:
+            document = scan_file(namespace.file)
+        except ScanError:
+            pass
+        else:
+            print_tags(firstpass(document, tags | set(namespace.tags)))
+            return 0
+
+    # Parse the configuration file. If requested, simplify it for this
+    # system, which also lets us tell the user about useless code.
+    if namespace.optimize and namespace.action != 'matrix':
+        from .optimize import optimize_file
+        document, report = optimize_file(
+            namespace.file, tags | set(namespace.tags))
+        for message in report:
+            bus.emit(Message('Optimizer: %s' % message))
+    else:
+        from .parsing import parse_file
+        document = parse_file(namespace.file)
 
     # Validate the document, add command implementations to the tree
-    validate(document, namespace.file, plugins)
+    index = validate(document, namespace.file, plugins)
+
+    if namespace.action == 'matrix':
+        from .matrix import expand_matrix, evaluate_matrix, group_plans
+        profiles = [set(profile.split()) for profile in namespace.profile] \
+            if namespace.profile else [tags]
+        tag_sets = expand_matrix(document, profiles, namespace.tags or None)
+        groups = group_plans(tag_sets, evaluate_matrix(document, tag_sets))
+        for plan, plan_tag_sets in groups:
+            print 'Plan for %d combination(s):' % len(plan_tag_sets)
+            for combination in plan_tag_sets:
+                print '  %s' % ' '.join(sorted(combination))
+            print 'runs:'
+            for command in plan:
+                print '  %s' % command
+            print ''
+        print '%d combinations, %d distinct plans' % (
+            len(tag_sets), len(groups))
+        return 0
 
     # Add the tags the user specified to the list of defined tags
     tags.update(namespace.tags)
@@ -392,32 +883,41 @@ def main(argv):
     # If the user is not yet running an apply, present him with the tags
     # that the firstpass discovered (only those which start with an uppercase
     # letter, per our convention).
-    if not namespace.apply:
-        print 'Optional tags for you to pass to apply:'
-        for tag in found_tags:
-            if tag[0].isupper():
-                print '  %s' % tag
+    if not namespace.action:
+        print_tags(found_tags)
         return 0
 
     # With the tags we are to use at hand, find the variables that will
     # be required, and let the user provide a value before starting a
     # process that ideally could run unattended.
-    initialized_variables = {}
-    used_variables = find_variables(document, tags)
-    if used_variables:
-        print "Please provide some values:"
-        for var in used_variables:
-            value = raw_input("  %s " % var)
-            initialized_variables[var] = value
-
-    # Actually run all commands
-    state = {'post_apply': [], 'variables': initialized_variables}
-    apply_document(document, tags, state, dry_run=namespace.dry_run)
+    initialized_variables = ask_variables(document, tags, {})
+
+    state = {'post_apply': [], 'variables': initialized_variables,
+             'timeouts': timeouts}
+    if namespace.action == 'plan':
+        from .plan import compile_plan, write_plan
+        plan = compile_plan(document, tags, initialized_variables)
+        if namespace.output:
+            with open(namespace.output, 'w') as f:
+                write_plan(plan, f)
+        else:
+            write_plan(plan, sys.stdout)
+        return 0
 
-    # Execute post apply handlers. Commands like ``remind`` set those up.
-    for callable in state['post_apply']:
-        callable(state)
+    if namespace.action == 'watch':
+        from .watch import watch
+        try:
+            watch(namespace.file, tags, plugins, state,
+                  dry_run=namespace.dry_run)
+        except KeyboardInterrupt:
+            pass
+        return 0
 
+    with open(namespace.file, 'rb') as f:
+        source = f.read()
+    return run_apply(document, namespace.file,
+                     source + ('\0optimized' * namespace.optimize),
+                     tags, state, namespace, index)
 
 def run():
     sys.exit(main(sys.argv) or 0)
@@ -0,0 +1,141 @@
+"""Use wsconfig from a long-running program, rather than the command line.
+
+A ``Session`` holds a config file, parsed and validated, along with the
+system tags, the values of variables, and the state kept between runs.
+It never asks anything: what happens during an apply is reported to an
+observer, and missing variables are an error. The observer is subscribed
+to ``bus`` next to its other handlers, so a program that does not want
+the console output removes the ``HumanRenderer`` from ``bus.handlers``
+once, at startup.
+
+Results of ``discover_tags`` and ``plan`` are memoized per set of tags
+(and variable values). Before every call, the session checks whether the
+file changed, in which case it is parsed again and the memoized results
+are dropped::
+
+    session = Session('workstation.conf', variables={'@@user@@': 'me'})
+    while True:
+        if session.plan(['Dev']):
+            session.apply(['Dev'], observer=log_event)
+        time.sleep(60)
+"""
+
+import os
+
+from .plugins import Plugin
+from .events import bus, CommandFail
+from .script import (
+    init_env, validate, firstpass, find_variables, apply_document,
+    ConfigError)
+
+
+__all__ = ('Session',)
+
+
+class Session(object):
+
+    def __init__(self, filename, variables=None, sys_tags=None, plugins=None):
+        self.filename = filename
+        self.variables = dict(variables or {})
+        self.sys_tags = set(init_env() if sys_tags is None else sys_tags)
+        self.plugins = Plugin.__class__.PLUGINS if plugins is None \
+            else plugins
+        # State kept between runs, like the manifest of written files
+        self.state = {'post_apply': [], 'variables': self.variables}
+        self._document = None
+        self._signature = None
+        self._memo = {}
+
+    @property
+    def document(self):
+        """The parsed and validated document, up to date with the file."""
+        st = os.stat(self.filename)
+        signature = (st.st_mtime, st.st_size, st.st_ino)
+        if signature != self._signature:
+            from .parsing import parse_file
+            document = parse_file(self.filename)
+            validate(document, self.filename, self.plugins)
+            self._document, self._signature = document, signature
+            self._memo.clear()
+        return self._document
+
+    def _tags(self, tags):
+        return self.sys_tags | set(tags)
+
+    def _memoized(self, name, tags, func):
+        document = self.document
+        key = (name, frozenset(tags), frozenset(self.variables.items()))
+        if key not in self._memo:
+            self._memo[key] = func(document)
+        return self._memo[key]
+
+    def discover_tags(self, tags=()):
+        """Return the tags the document uses which could be given in
+        addition to ``tags``, like ``wsconfig file`` lists them.
+        """
+        tags = self._tags(tags)
+        return self._memoized('discover_tags', tags,
+                              lambda document: firstpass(document, tags))
+
+    def missing_variables(self, tags=()):
+        """Return the variables the commands that run with ``tags`` use,
+        but which have no value yet.
+        """
+        tags = self._tags(tags)
+        return self._memoized(
+            'missing_variables', tags, lambda document:
+            find_variables(document, tags) - set(self.variables))
+
+    def plan(self, tags=()):
+        """Return the commands that would run with ``tags``, as dicts with
+        the ``argv`` (with variables replaced) and ``basedir`` of each.
+        """
+        from .plan import compile_plan
+        self._check_variables(tags)
+        tags = self._tags(tags)
+        return self._memoized(
+            'plan', tags, lambda document:
+            compile_plan(document, tags, self.variables)['commands'])
+
+    def _check_variables(self, tags):
+        missing = self.missing_variables(tags)
+        if missing:
+            raise ConfigError('No values for the variables: %s' %
+                              ', '.join(sorted(missing)))
+
+    def apply(self, tags=(), observer=None, dry_run=False, keep_going=True):
+        """Run the commands for ``tags``.
+
+        ``observer`` is called with every event (see ``wsconfig.events``)
+        the run emits. A failing command does not stop the run, unless
+        ``keep_going`` is false. Returns the ``CommandFail`` events of the
+        commands that failed.
+        """
+        self._check_variables(tags)
+        document = self.document
+        self.state['variables'] = self.variables
+        failures = []
+
+        def collect(event):
+            if isinstance(event, CommandFail):
+                failures.append(event)
+            if observer:
+                observer(event)
+
+        bus.subscribe(collect)
+        try:
+            apply_document(document, self._tags(tags), self.state,
+                           dry_run=dry_run,
+                           on_failure=lambda error: keep_going)
+            for callable in self.state['post_apply']:
+                callable(self.state)
+        finally:
+            bus.unsubscribe(collect)
+            # Start the next run with a fresh state, other than what is
+            # meant to be kept
+            for key in self.state.keys():
+                if key not in ('variables', 'post_apply', 'timeouts',
+                               'content_manifest', 'backend'):
+                    del self.state[key]
+            del self.state['post_apply'][:]
+        return failures
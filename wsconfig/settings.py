@@ -0,0 +1,257 @@
+"""Read and write desktop settings in bulk.
+
+A store is a settings database: dconf and GConf on Linux, and the
+``defaults`` system on Mac OS. Each reads all the keys a run refers to
+with as few commands as possible (``dconf dump`` once, say), keeps
+track of the keys whose values differ, and writes those with one command
+when flushed (``dconf load``).
+
+Values are compared in the form the store prints them in. Where that is
+ambiguous (``1`` or ``1.0``), a value may be written even though it did
+not change, which does no harm.
+"""
+
+import os
+from os import path
+import plistlib
+import tempfile
+from xml.etree import ElementTree
+from xml.parsers.expat import ExpatError
+
+
+__all__ = ('STORES', 'TYPES', 'SettingsError')
+
+
+TYPES = ('string', 'int', 'bool', 'float')
+
+
+class SettingsError(ValueError):
+    pass
+
+
+def parse_bool(value):
+    if value.lower() in ('true', 'yes', 'on', '1'):
+        return True
+    if value.lower() in ('false', 'no', 'off', '0'):
+        return False
+    raise SettingsError('Not a boolean: %s' % value)
+
+
+def convert(type, value):
+    """Return ``value`` (a string) as a Python value of ``type``."""
+    try:
+        return {'string': str, 'int': int, 'float': float,
+                'bool': parse_bool}[type](value)
+    except ValueError:
+        raise SettingsError('Not a valid %s: %s' % (type, value))
+
+
+def common_directory(keys):
+    """Return the deepest directory that contains all ``keys``."""
+    directory = path.dirname(path.commonprefix(
+        [path.dirname(key) + '/' for key in keys]))
+    return directory.rstrip('/') + '/'
+
+
+class Store(object):
+    """Base class of the stores. ``run`` runs a command line, with
+    optional input, and returns its output (see
+    ``Plugin.execute_output``).
+    """
+
+    def __init__(self, run):
+        self.run = run
+        # Keys the run refers to, which are read together
+        self.wanted = set()
+        # Current values, in the form ``encode`` returns
+        self.values = None
+        # key -> (type, value) to write
+        self.pending = {}
+
+    def want(self, key):
+        self.wanted.add(key)
+
+    def get(self, key):
+        if self.values is None or key not in self.read_keys:
+            self.read_keys = self.wanted | set([key])
+            self.values = self.read(self.read_keys)
+        return self.values.get(key)
+
+    def set(self, key, type, value):
+        """Arrange for ``key`` to be set to ``value``. Returns whether it
+        changes.
+        """
+        encoded = self.encode(type, convert(type, value))
+        if self.pending.get(key, (None, self.get(key)))[1] == encoded:
+            return False
+        self.pending[key] = (type, encoded)
+        return True
+
+    def flush(self):
+        """Write the values that changed."""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        self.write(pending)
+        for key, (type, encoded) in pending.items():
+            self.values[key] = encoded
+
+    def read(self, keys):
+        """Return the current values of ``keys`` (and possibly others),
+        by key.
+        """
+        raise NotImplementedError()
+
+    def encode(self, type, value):
+        raise NotImplementedError()
+
+    def write(self, values):
+        """Write ``values``, a dict of key -> (type, encoded value)."""
+        raise NotImplementedError()
+
+
+class DconfStore(Store):
+    """dconf keys are paths like ``/org/gnome/desktop/interface/gtk-theme``;
+    values are GVariants, as ``dconf dump`` prints them.
+    """
+
+    name = 'dconf'
+
+    def read(self, keys):
+        directory = common_directory(keys)
+        values = {}
+        section = None
+        for line in self.run(['dconf', 'dump', directory]).splitlines():
+            if line.startswith('[') and line.endswith(']'):
+                section = line[1:-1].strip('/')
+            elif '=' in line and section is not None:
+                name, value = line.split('=', 1)
+                base = directory + section + '/' if section else directory
+                values[base + name] = value
+        return values
+
+    def encode(self, type, value):
+        if type == 'string':
+            return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+        if type == 'bool':
+            return 'true' if value else 'false'
+        return repr(value) if type == 'float' else str(value)
+
+    def write(self, values):
+        sections = {}
+        for key, (type, encoded) in values.items():
+            directory, name = key.rsplit('/', 1)
+            sections.setdefault(directory.strip('/'), []).append(
+                '%s=%s' % (name, encoded))
+        keyfile = ''.join('[%s]\n%s\n\n' % (
+            section or '/', '\n'.join(sorted(lines)))
+            for section, lines in sorted(sections.items()))
+        self.run(['dconf', 'load', '/'], input=keyfile)
+
+
+class GconfStore(Store):
+    """GConf keys are paths like ``/apps/metacity/general/theme``."""
+
+    name = 'gconf'
+
+    def read(self, keys):
+        output = self.run(['gconftool-2', '--dump', common_directory(keys)])
+        values = {}
+        try:
+            root = ElementTree.fromstring(output or '<gconfentryfile/>')
+        except (SyntaxError, ExpatError), e:
+            raise SettingsError('Cannot read the GConf dump: %s' % e)
+        for entrylist in root.findall('entrylist'):
+            base = entrylist.get('base', '/').rstrip('/') + '/'
+            for entry in entrylist.findall('entry'):
+                value = entry.find('value')
+                if value is None or not len(value):
+                    continue
+                # Lists and pairs are not supported, and never match
+                if value[0].tag in TYPES:
+                    values[base + entry.findtext('key')] = (
+                        value[0].tag, value[0].text or '')
+        return values
+
+    def encode(self, type, value):
+        if type == 'bool':
+            return type, 'true' if value else 'false'
+        return type, str(value)
+
+    def write(self, values):
+        directories = {}
+        for key, (type, encoded) in values.items():
+            directory, name = key.rsplit('/', 1)
+            directories.setdefault(directory or '/', []).append(
+                (name, encoded))
+        root = ElementTree.Element('gconfentryfile')
+        for directory, entries in sorted(directories.items()):
+            entrylist = ElementTree.SubElement(root, 'entrylist',
+                                               base=directory)
+            for name, (type, text) in sorted(entries):
+                entry = ElementTree.SubElement(entrylist, 'entry')
+                ElementTree.SubElement(entry, 'key').text = name
+                value = ElementTree.SubElement(entry, 'value')
+                ElementTree.SubElement(value, type).text = text
+
+        fd, filename = tempfile.mkstemp(prefix='wsconfig-gconf-',
+                                        suffix='.xml')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(ElementTree.tostring(root))
+            self.run(['gconftool-2', '--load', filename])
+        finally:
+            os.unlink(filename)
+
+
+class DefaultsStore(Store):
+    """Mac OS ``defaults``; keys are written as ``DOMAIN/KEY``, like
+    ``com.apple.dock/autohide``. Domains are read with ``defaults
+    export``, and written back as a whole with ``defaults import``.
+
+    Other programs may change a domain in the meantime, so it is
+    exported again right before the changes are merged into it and it
+    is imported.
+    """
+
+    name = 'defaults'
+
+    @staticmethod
+    def split(key):
+        if '/' not in key:
+            raise SettingsError('Not a DOMAIN/KEY: %s' % key)
+        return key.rsplit('/', 1)
+
+    def export(self, domain):
+        """Return all values of ``domain``, by name."""
+        output = self.run(['defaults', 'export', domain, '-'])
+        try:
+            return plistlib.readPlistFromString(output) \
+                if output.strip() else {}
+        except (ExpatError, ValueError), e:
+            raise SettingsError('Cannot read %s: %s' % (domain, e))
+
+    def read(self, keys):
+        values = {}
+        for domain in sorted(set(self.split(key)[0] for key in keys)):
+            for name, value in self.export(domain).items():
+                values['%s/%s' % (domain, name)] = value
+        return values
+
+    def encode(self, type, value):
+        return value
+
+    def write(self, values):
+        domains = {}
+        for key, (type, value) in values.items():
+            domain, name = self.split(key)
+            domains.setdefault(domain, {})[name] = value
+        for domain, changes in sorted(domains.items()):
+            current = self.export(domain)
+            current.update(changes)
+            self.run(['defaults', 'import', domain, '-'],
+                     input=plistlib.writePlistToString(current))
+
+
+STORES = dict((store.name, store)
+              for store in (DconfStore, GconfStore, DefaultsStore))
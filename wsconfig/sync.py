@@ -0,0 +1,272 @@
+"""Make a directory tree (or a single file) a copy of another one, only
+copying what changed.
+
+Files are considered up to date if size and modification time match
+(copies get the modification time of their source), or, in checksum
+mode, if their content hashes match. Hashes are kept in a
+``ContentManifest``, so that only files which changed need to be read.
+
+File data is copied without passing through Python where the system
+allows it: by cloning the file (a reflink, on file systems like btrfs
+and XFS), else with ``copy_file_range()`` or ``sendfile()``. Each
+copies as much as it can; if one is not supported, the next one
+continues from where it stopped, and a plain read/write loop is the
+last resort.
+"""
+
+import os
+from os import path
+import errno
+import shutil
+import tempfile
+
+from .fscache import scandir, kind_of, MISSING, FILE, DIR, LINK
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+__all__ = ('sync', 'copy_file')
+
+
+# ioctl(dst_fd, FICLONE, src_fd) makes dst share the blocks of src
+FICLONE = 0x40049409
+
+# Errors meaning "cannot do that here", rather than a failed copy
+UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+# How much to copy per call
+CHUNK_SIZE = 1 << 30
+
+
+def load_libc():
+    try:
+        import ctypes
+    except ImportError:
+        return None
+    try:
+        libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    except OSError:
+        # Not glibc: let ctypes look for it (which may run ldconfig)
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                               use_errno=True)
+        except OSError:
+            return None
+    for name, argtypes in [
+            ('copy_file_range', [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                 ctypes.c_void_p, ctypes.c_size_t,
+                                 ctypes.c_uint]),
+            ('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_size_t])]:
+        func = getattr(libc, name, None)
+        if func is not None:
+            func.argtypes = argtypes
+            func.restype = ctypes.c_ssize_t
+    return libc
+
+
+# The C library, once something needed it: loading it is not free, and
+# most runs copy no file at all.
+loaded_libc = []
+
+
+def libc_function(name):
+    """Return the function ``name`` of the C library, or ``None``."""
+    if not loaded_libc:
+        loaded_libc.append(load_libc())
+    return getattr(loaded_libc[0], name, None)
+
+
+def clone(src_fd, dst_fd, size):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except IOError, e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+    return True
+
+
+def copy_with(func, args, size):
+    """Call a ``copy_file_range``-like ``func`` until ``size`` bytes are
+    copied. Returns ``False`` if it is not supported.
+    """
+    if func is None:
+        return False
+    copied = 0
+    while copied < size:
+        result = func(*(args + [min(CHUNK_SIZE, size - copied)]))
+        if result < 0:
+            import ctypes
+            error = ctypes.get_errno()
+            if error in UNSUPPORTED:
+                return False
+            raise OSError(error, os.strerror(error))
+        if result == 0:
+            break
+        copied += result
+    return True
+
+
+def copy_range(src_fd, dst_fd, size):
+    func = libc_function('copy_file_range')
+    if func is None:
+        return False
+    return copy_with(lambda *a: func(*(a + (0,))),
+                     [src_fd, None, dst_fd, None], size)
+
+
+def send_file(src_fd, dst_fd, size):
+    return copy_with(libc_function('sendfile'),
+                     [dst_fd, src_fd, None], size)
+
+
+def read_write(src_fd, dst_fd, size):
+    while True:
+        data = os.read(src_fd, 1 << 20)
+        if not data:
+            return True
+        while data:
+            data = data[os.write(dst_fd, data):]
+
+
+# In the order they are tried
+METHODS = [('clone', clone), ('copy_file_range', copy_range),
+           ('sendfile', send_file), ('read/write', read_write)]
+
+
+def copy_data(src_fd, dst_fd, size):
+    """Copy the content of ``src_fd`` to ``dst_fd``. Returns the name of
+    the method that did (the last part of) the work.
+    """
+    for name, method in METHODS:
+        remaining = size - os.lseek(src_fd, 0, os.SEEK_CUR)
+        if method(src_fd, dst_fd, remaining):
+            return name
+
+
+def copy_file(src, dst):
+    """Replace ``dst`` with a copy of ``src``, including its mode and
+    modification time. Returns how the data was copied.
+    """
+    fd, tmpname = tempfile.mkstemp(dir=path.dirname(dst), prefix='.wsconfig-')
+    try:
+        try:
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                method = copy_data(src_fd, fd, os.fstat(src_fd).st_size)
+            finally:
+                os.close(src_fd)
+        finally:
+            os.close(fd)
+        shutil.copystat(src, tmpname)
+        os.rename(tmpname, dst)
+    except:
+        if path.lexists(tmpname):
+            os.unlink(tmpname)
+        raise
+    return method
+
+
+def lkind(filename):
+    try:
+        return kind_of(os.lstat(filename).st_mode)
+    except OSError:
+        return MISSING
+
+
+def listing(directory):
+    """Return a dict of the entries in ``directory``, and their kind."""
+    if scandir:
+        entries = {}
+        for entry in scandir(directory):
+            if entry.is_symlink():
+                entries[entry.name] = LINK
+            elif entry.is_dir(follow_symlinks=False):
+                entries[entry.name] = DIR
+            elif entry.is_file(follow_symlinks=False):
+                entries[entry.name] = FILE
+            else:
+                entries[entry.name] = None
+        return entries
+    return dict((name, lkind(path.join(directory, name)))
+                for name in os.listdir(directory))
+
+
+def remove(filename):
+    if lkind(filename) is DIR:
+        shutil.rmtree(filename)
+    else:
+        os.unlink(filename)
+
+
+def up_to_date(src, dst, manifest):
+    try:
+        src_stat, dst_stat = os.stat(src), os.lstat(dst)
+    except OSError:
+        return False
+    if kind_of(dst_stat.st_mode) is not FILE or \
+            src_stat.st_size != dst_stat.st_size:
+        return False
+    if manifest is not None:
+        return manifest.digest(src) == manifest.digest(dst)
+    return abs(src_stat.st_mtime - dst_stat.st_mtime) < 0.001
+
+
+def sync(src, dst, delete=False, manifest=None, kind=None):
+    """Make ``dst`` a copy of ``src``. Returns a list of (action, filename)
+    tuples for the changes made, where action is ``copied``, ``linked``,
+    ``created`` or ``deleted``.
+
+    With ``delete``, entries in ``dst`` directories which are not in the
+    corresponding ``src`` directory are removed. If a ``manifest`` is
+    given, files are compared by their content hash.
+    """
+    changes = []
+    kind = kind or lkind(src)
+    if kind is DIR:
+        if lkind(dst) is not DIR:
+            if lkind(dst) is not MISSING:
+                remove(dst)
+            os.mkdir(dst)
+            shutil.copymode(src, dst)
+            changes.append(('created', dst))
+        entries = listing(src)
+        if delete:
+            for name in sorted(set(listing(dst)) - set(entries)):
+                remove(path.join(dst, name))
+                changes.append(('deleted', path.join(dst, name)))
+        for name, entry_kind in sorted(entries.items()):
+            if entry_kind is not None:
+                changes.extend(sync(path.join(src, name), path.join(dst, name),
+                                    delete, manifest, entry_kind))
+
+    elif kind is LINK:
+        target = os.readlink(src)
+        if lkind(dst) is LINK and os.readlink(dst) == target:
+            return changes
+        if lkind(dst) is not MISSING:
+            remove(dst)
+        os.symlink(target, dst)
+        changes.append(('linked', dst))
+
+    elif kind is FILE:
+        if up_to_date(src, dst, manifest):
+            return changes
+        if lkind(dst) is DIR:
+            remove(dst)
+        copy_file(src, dst)
+        if manifest is not None:
+            manifest.remember(dst, manifest.digest(src))
+        changes.append(('copied', dst))
+
+    elif kind is MISSING:
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), src)
+    return changes
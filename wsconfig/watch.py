@@ -0,0 +1,163 @@
+"""Watch a config file, and re-apply it whenever it changes.
+
+Only commands that are new are run again. To decide what is new, every
+command that is reached during traversal is identified by a key: the
+selectors it is nested in, its arguments, the modification times of the
+files it reads (see ``Plugin.sources``), and how many identical commands
+came before it. A command whose key was not reached during the previous
+run is run again. This also covers commands which were previously not
+reached, for example because a ``define`` was added. Commands that failed
+count as not reached, so they are run again the next time.
+"""
+
+import os
+from os import path
+import time
+
+from pyparsing import ParseBaseException
+
+from .parsing import parse_file, Selector
+from .events import bus, Message, CommandEnd, CommandSkip
+from .plugins import ApplyError
+from .script import (
+    traverse_document, validate, apply_document, ask_variables, ConfigError)
+
+
+__all__ = ('reached_commands', 'changed_commands', 'completed_commands',
+           'watch')
+
+
+def mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+def command_sources(command):
+    """Return the files ``command`` reads from, or ``None`` if its
+    arguments are not valid, such that they cannot be told.
+    """
+    try:
+        return command.plugin.sources(command.args)
+    except (ApplyError, LookupError, ValueError):
+        return None
+
+
+def reached_commands(document, tags):
+    """Return a dict, mapping the ids of all commands that would run given
+    ``tags`` to the key that identifies them. Commands with invalid
+    arguments are reported and left out, so they do not run.
+    """
+    scopes = {}
+    def collect_scopes(items, scope):
+        for item in items:
+            if isinstance(item, Selector):
+                collect_scopes(item.items, scope + (str(item.tagexpr),))
+            else:
+                scopes[id(item)] = scope
+    collect_scopes(document, ())
+
+    keys = {}
+    counts = {}
+    for selector, command, _ in traverse_document(document, tags):
+        if not command:
+            continue
+        sources = command_sources(command)
+        if sources is None:
+            bus.emit(Message('Skipping %s, its arguments are invalid' %
+                             ' '.join(command.argv)))
+            continue
+        sources = tuple((s, mtime(s)) for s in sources)
+        key = (scopes[id(command)], tuple(command.argv), sources)
+        counts[key] = counts.get(key, 0) + 1
+        keys[id(command)] = key + (counts[key],)
+    return keys
+
+
+def changed_commands(previous, current):
+    """Given two results of ``reached_commands``, return the set of
+    command ids in ``current`` that were not reached previously.
+    """
+    previous_keys = set(previous.values())
+    return set(id_ for id_, key in current.items()
+               if key not in previous_keys)
+
+
+def completed_commands(current, changed, succeeded):
+    """Return the part of ``current`` (a result of ``reached_commands``)
+    that counts as reached once the ``changed`` commands ran, of which
+    those in ``succeeded`` did not fail. The others are to run again.
+    """
+    return dict((id_, key) for id_, key in current.items()
+                if id_ not in changed or id_ in succeeded)
+
+
+def watched_files(filename, document, tags):
+    """The config file itself, and all the sources of reached commands.
+    """
+    files = set([path.abspath(filename)])
+    for selector, command, _ in traverse_document(document, tags):
+        if command:
+            files.update(command_sources(command) or ())
+    return files
+
+
+def wait_for_change(files, interval=0.5, debounce=0.5):
+    """Block until one of ``files`` changes, then until there were no
+    further changes for ``debounce`` seconds, such that a burst of saves
+    only causes a single run.
+    """
+    snapshot = dict((f, mtime(f)) for f in files)
+    while all(mtime(f) == m for f, m in snapshot.items()):
+        time.sleep(interval)
+    while True:
+        snapshot = dict((f, mtime(f)) for f in files)
+        time.sleep(debounce)
+        if all(mtime(f) == m for f, m in snapshot.items()):
+            return
+
+
+def watch(filename, tags, plugins, state, dry_run=False, interval=0.5,
+          debounce=0.5):
+    """Apply ``filename``, then wait for changes, and apply whatever
+    changed. Runs until interrupted.
+    """
+    previous = {}
+    document = None
+    while True:
+        try:
+            new_document = parse_file(filename)
+            validate(new_document, filename, plugins)
+        except (ParseBaseException, ConfigError), e:
+            bus.emit(Message("Not applying, the file is invalid: %s" % e))
+        else:
+            document = new_document
+            ask_variables(document, tags, state['variables'])
+            current = reached_commands(document, tags)
+            changed = changed_commands(previous, current)
+            succeeded = set()
+            def collect(event):
+                if isinstance(event, (CommandEnd, CommandSkip)):
+                    succeeded.add(id(event.command))
+            bus.subscribe(collect)
+            try:
+                apply_document(document, tags, state, dry_run=dry_run,
+                               only=changed)
+            finally:
+                bus.unsubscribe(collect)
+            previous = completed_commands(current, changed, succeeded)
+
+            for callable in state['post_apply']:
+                callable(state)
+            # Start the next run with a fresh state, other than the variables
+            # and the timeouts given on the command line.
+            for key in state.keys():
+                if key not in ('variables', 'post_apply', 'timeouts'):
+                    del state[key]
+            del state['post_apply'][:]
+
+        files = watched_files(filename, document, tags) \
+            if document is not None else [path.abspath(filename)]
+        bus.emit(Message("\nWatching %d files for changes..." % len(files)))
+        wait_for_change(files, interval, debounce)